@@ -7,5 +7,46 @@ class UgridToolsConstants(object):
     POLYGON_BREAK_VALUE = -8
     #: Default polygon node threshold.
     NODE_THRESHOLD = 5000
+    #: Number of decimals used when rounding node coordinates to find shared nodes.
+    CONNECTIVITY_DECIMALS = 8
+    #: Number of cells along each axis of the coarse occupancy grid used to find halo faces when computing connectivity
+    #: in parallel. See :func:`utools.io.helpers.get_halo_faces`.
+    HALO_GRID_SIZE = 64
+    #: Directory for serialized spatial indexes of sources in directories that are not writable. If ``None``, use a
+    #: ``utools_rtree`` directory in the system temporary directory. Use a shared directory when running with MPI on
+    #: multiple nodes. See :func:`utools.io.helpers.get_rtree_path`.
+    RTREE_DIRECTORY = None
+    #: Default maximum size in bytes of a weight cache directory.
+    WEIGHT_CACHE_MAX_NBYTES = 10 * 1024 ** 3
+    #: Node count at which the quadratic term of the element conversion cost equals the linear term. Fitted to the
+    #: element timings in :mod:`utools.profile.timing_data`.
+    SECTION_COST_NODE_SCALE = 1000
+    #: Default number of features in a block read by :meth:`utools.io.geom_cabinet.GeomCabinet.iter_blocks`.
+    FEATURE_BLOCK_SIZE = 10000
+    #: Default maximum number of recursive splits used when splitting polygons by node threshold.
+    SPLIT_MAX_DEPTH = 4
+    #: Default maximum number of recursive splits used by the ``'quadtree'`` split method.
+    QUADTREE_MAX_DEPTH = 16
+    #: Default method used to split polygons by node threshold. See
+    #: :func:`utools.io.helpers.get_split_polygon_by_node_threshold`.
+    SPLIT_METHOD = 'grid'
+    #: Number of records dispatched together when splitting polygons by node threshold in a process pool.
+    SPLIT_CHUNK_SIZE = 64
+    #: Chunk length of unlimited dimensions when streaming a conversion to an ESMF format file.
+    STREAM_CHUNK_SIZE = 8192
+    #: Named NetCDF output profiles for ESMF format files. Chunk lengths are keyed by dimension name and clipped to the
+    #: dimension sizes. See :func:`utools.io.helpers.get_esmf_format_profile`.
+    ESMF_FORMAT_PROFILES = {
+        # Contiguous, uncompressed variables without fill values written ahead of the data.
+        'fast-write': {'format': 'NETCDF4', 'fill': False, 'contiguous': True},
+        # Maximum compression with byte shuffling. The integer connectivity compresses the most.
+        'small-file': {'format': 'NETCDF4', 'fill': False, 'zlib': True, 'shuffle': True, 'complevel': 9,
+                       'chunk_lengths': {'nodeCount': 2 ** 17, 'elementCount': 2 ** 17, 'connectionCount': 2 ** 18}},
+        # ESMF reads contiguous element ranges on each PET. Large chunks along the element and connection dimensions
+        # keep the number of chunk reads small while light compression reduces the bytes read from disk.
+        'esmf-read-optimized': {'format': 'NETCDF4', 'fill': False, 'zlib': True, 'shuffle': True, 'complevel': 1,
+                                'chunk_lengths': {'nodeCount': 2 ** 19, 'elementCount': 2 ** 19,
+                                                  'connectionCount': 2 ** 21}}
+    }
 
     PROJECT_PREFIX = 'utools'
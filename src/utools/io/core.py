@@ -7,7 +7,10 @@ def from_geometry_manager(gm, mesh_name='mesh', use_ragged_arrays=False, with_co
 
 
 def from_shapefile(path, name_uid, mesh_name='mesh', path_rtree=None, use_ragged_arrays=False, with_connectivity=True,
-                   allow_multipart=False, node_threshold=None, driver_kwargs=None, debug=False, dest_crs=None):
+                   allow_multipart=False, node_threshold=None, driver_kwargs=None, debug=False, dest_crs=None,
+                   pack=False, esmf_layout=False, balance=False, split_method=None, split_processes=None,
+                   connectivity_method='touches', geometry_cache_nbytes=None,
+                   pack_decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS):
     """
     Create a flexible mesh from a target shapefile.
 
@@ -25,6 +28,21 @@ def from_shapefile(path, name_uid, mesh_name='mesh', path_rtree=None, use_ragged
     :param path_rtree: Path to a serialized spatial index object created using ``rtree``. Use :func:`pyugrid.flexible_mesh.helpers.create_rtree_file`
      to create a persistent ``rtree`` spatial index file.
     :type path_rtree: str
+    :param bool pack: If ``True``, de-duplicate shared coordinates. See :func:`utools.io.helpers.get_packed_nodes`.
+    :param int pack_decimals: Number of decimals used when rounding coordinates to find shared nodes if ``pack`` is
+     ``True``. Decrease to merge shared nodes with slightly different coordinates.
+    :param bool esmf_layout: If ``True``, only create the flat ESMF element connectivity (``'element_conn'`` and
+     ``'num_element_conn'``). The ``'face'`` value is ``None``.
+    :param bool balance: If ``True``, balance the estimated conversion cost across ranks. See
+     :func:`utools.io.helpers.get_face_variables`.
+    :param str split_method: The method used to split elements exceeding ``node_threshold``. See
+     :func:`utools.io.helpers.get_split_polygon_by_node_threshold`.
+    :param int split_processes: Number of local processes used to split elements exceeding ``node_threshold``. See
+     :class:`utools.io.geom_manager.GeometryManager`.
+    :param str connectivity_method: The method used to find neighboring faces. Use ``'nodes'`` for connectivity in
+     parallel. See :func:`utools.io.helpers.get_face_variables`.
+    :param int geometry_cache_nbytes: If provided, keep up to this many bytes of decoded geometries in memory. Finding
+     touching faces reads neighboring geometries again. See :class:`utools.io.geom_manager.GeometryManager`.
     :rtype: :class:`pyugrid.flexible_mesh.core.FlexibleMesh`
     """
     # tdk: update doc
@@ -37,24 +55,57 @@ def from_shapefile(path, name_uid, mesh_name='mesh', path_rtree=None, use_ragged
 
     log.debug('creating geometry manager')
     log.debug(('driver_kwargs', driver_kwargs))
+    # Only the unique identifier is used from the source attributes.
     gm = GeometryManager(name_uid, path=path, path_rtree=path_rtree, allow_multipart=allow_multipart,
-                         node_threshold=node_threshold, slc=slc, driver_kwargs=driver_kwargs, dest_crs=dest_crs)
+                         node_threshold=node_threshold, slc=slc, driver_kwargs=driver_kwargs, dest_crs=dest_crs,
+                         properties=[], split_method=split_method, split_processes=split_processes,
+                         geometry_cache_nbytes=geometry_cache_nbytes)
     log.debug('geometry manager created')
 
-    ret = get_flexible_mesh(gm, mesh_name, use_ragged_arrays, with_connectivity=with_connectivity)
+    ret = get_flexible_mesh(gm, mesh_name, use_ragged_arrays, with_connectivity=with_connectivity,
+                            connectivity_method=connectivity_method, pack=pack, esmf_layout=esmf_layout,
+                            balance=balance, pack_decimals=pack_decimals)
     log.debug('mesh collection returned')
 
+    if node_threshold is not None:
+        log_split_node_counts(gm)
+
     return ret
 
 
-def get_flexible_mesh(gm, mesh_name, use_ragged_arrays, with_connectivity=True):
+def log_split_node_counts(gm):
+    """
+    Log a histogram of the node counts of split element pieces on the root rank. This is a collective operation.
+
+    :param gm: The geometry manager used to create the mesh.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    """
+    from utools.io.helpers import get_node_count_report
+    from utools.io.mpi import MPI_COMM, MPI_RANK
+
+    gathered = MPI_COMM.gather(gm.split_node_counts)
+    if MPI_RANK == 0:
+        node_counts = [n for split_node_counts in gathered for v in split_node_counts.values() for n in v]
+        n_split = sum([len(split_node_counts) for split_node_counts in gathered])
+        log.info('Split {} elements into {} pieces'.format(n_split, len(node_counts)))
+        log.info(get_node_count_report(node_counts))
+
+
+def get_flexible_mesh(gm, mesh_name, use_ragged_arrays, with_connectivity=True, connectivity_method='touches',
+                      pack=False, esmf_layout=False, balance=False,
+                      pack_decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS):
     from helpers import get_variables
 
-    result = get_variables(gm, use_ragged_arrays=use_ragged_arrays, with_connectivity=with_connectivity)
+    result = get_variables(gm, use_ragged_arrays=use_ragged_arrays, with_connectivity=with_connectivity,
+                           connectivity_method=connectivity_method, pack=pack, esmf_layout=esmf_layout,
+                           balance=balance, pack_decimals=pack_decimals)
 
     ret = {}
-    face_nodes, face_edges, edge_nodes, nodes, face_links, face_ids, face_coordinates, face_areas, section = result
+    face_nodes, face_edges, edge_nodes, nodes, face_links, face_ids, face_coordinates, face_areas, section, \
+    element_conn, num_element_conn = result
     ret['face'] = face_nodes
+    ret['element_conn'] = element_conn
+    ret['num_element_conn'] = num_element_conn
     ret['face_edges'] = face_edges
     ret['edge_nodes'] = edge_nodes
     ret['nodes'] = nodes
@@ -1,11 +1,22 @@
 import os
+import struct
 from collections import OrderedDict
 from copy import deepcopy
+from glob import glob
 
 import fiona
+import numpy as np
 import ogr
 from shapely import wkb
 
+from utools.constants import UgridToolsConstants
+from utools.io.mpi import MPI_COMM, MPI_RANK
+
+# Layer metadata keyed by absolute path and feature class. See get_layer_metadata.
+_LAYER_METADATA = {}
+# Little-endian WKB for a polygon without rings. Used for features without a geometry.
+_EMPTY_POLYGON_WKB = struct.pack('<BII', 1, 3, 0)
+
 
 class GeomCabinet(object):
     """
@@ -30,10 +41,9 @@ class GeomCabinet(object):
                     ret.append(os.path.splitext(fn)[0])
         return ret
 
-    def get_meta(self, key=None, path=None):
+    def get_meta(self, key=None, path=None, driver_kwargs=None):
         path = path or self.get_shp_path(key)
-        with fiona.open(path, 'r') as source:
-            return source.meta
+        return get_layer_metadata(path, driver_kwargs=driver_kwargs)['meta']
 
     def get_shp_path(self, key):
         return self._get_path_(key, ext='shp')
@@ -53,7 +63,7 @@ class GeomCabinet(object):
             raise ValueError(msg)
 
     def iter_geoms(self, key=None, select_uid=None, path=None, load_geoms=True, uid=None, select_sql_where=None,
-                   slc=None, dest_crs=None, driver_kwargs=None):
+                   slc=None, dest_crs=None, driver_kwargs=None, properties=None):
         """
         See documentation for :class:`~ocgis.GeomCabinetIterator`.
         """
@@ -69,38 +79,34 @@ class GeomCabinet(object):
         shp_path = self._get_path_by_key_or_direct_path_(key=key, path=path)
 
         # get the source CRS
-        meta = self.get_meta(path=shp_path)
+        meta = self.get_meta(path=shp_path, driver_kwargs=driver_kwargs)
 
         # open the target shapefile
         ds = ogr.Open(shp_path)
         try:
             # return the features iterator
             features = self._get_features_object_(ds, uid=uid, select_uid=select_uid, select_sql_where=select_sql_where,
-                                                  driver_kwargs=driver_kwargs)
-            for ctr, feature in enumerate(features):
-                # With a slice passed, ...
-                if slc is not None:
-                    # ... iterate until start is reached.
-                    if ctr < slc[0]:
-                        continue
-                    # ... stop if we have reached the stop.
-                    elif ctr == slc[1]:
-                        raise StopIteration
-
-                ogr_geom = feature.GetGeometryRef()
-                if dest_crs is not None:
-                    ogr_geom.TransformTo(dest_crs)
-
+                                                  driver_kwargs=driver_kwargs, properties=properties,
+                                                  load_geoms=load_geoms)
+            for ctr, feature in self._iter_features_(features, slc=slc):
                 if load_geoms:
+                    ogr_geom = feature.GetGeometryRef()
+                    if dest_crs is not None:
+                        ogr_geom.TransformTo(dest_crs)
                     yld = {'geom': wkb.loads(ogr_geom.ExportToWkb())}
                 else:
                     yld = {}
                 items = feature.items()
-                properties = OrderedDict([(key, items[key]) for key in feature.keys()])
-                yld.update({'properties': properties})
+                # Ignored fields are still listed by the feature but have no values.
+                if properties is None:
+                    keys = feature.keys()
+                else:
+                    keys = [k for k in feature.keys() if k == uid or k in properties]
+                record_properties = OrderedDict([(key, items[key]) for key in keys])
+                yld.update({'properties': record_properties})
 
                 if ctr == 0:
-                    uid, add_uid = get_uid_from_properties(properties, uid)
+                    uid, add_uid = get_uid_from_properties(record_properties, uid)
                     # The properties schema needs to be updated to account for the adding of a unique identifier.
                     if add_uid:
                         meta['schema']['properties'][uid] = 'int'
@@ -109,10 +115,10 @@ class GeomCabinet(object):
 
                 # add the unique identifier if required
                 if add_uid:
-                    properties[uid] = ctr + 1
+                    record_properties[uid] = ctr + 1
                 # ensure the unique identifier is an integer
                 else:
-                    properties[uid] = int(properties[uid])
+                    record_properties[uid] = int(record_properties[uid])
 
                 yield yld
             try:
@@ -126,6 +132,94 @@ class GeomCabinet(object):
             ds.Destroy()
             ds = None
 
+    def iter_blocks(self, uid, key=None, path=None, block_size=UgridToolsConstants.FEATURE_BLOCK_SIZE,
+                    select_uid=None, select_sql_where=None, slc=None, dest_crs=None, driver_kwargs=None):
+        """
+        Iterate over blocks of features as columnar arrays. Geometries are parsed directly from OGR WKB without
+        creating Shapely objects or property dictionaries. Only polygon and multipolygon geometries are supported.
+        Features without a geometry are returned as empty geometries with no parts.
+
+        >>> for block in GeomCabinet().iter_blocks('UGID', path='/path/to/shapefile.shp'):
+        ...     print block['uid'].shape[0], block['coordinates'].shape[0]
+
+        :param str uid: The name of the integer attribute containing the unique identifier.
+        :param int block_size: The maximum number of features in each block.
+
+        See :class:`~utools.io.geom_cabinet.GeomCabinetIterator` for documentation on other parameters.
+
+        :returns: The dictionary returned by :func:`~utools.io.geom_cabinet.get_columnar_geometries` with an added
+         ``'uid'`` key containing the unique identifier vector.
+        :rtype: dict
+        :raises: ValueError
+        """
+
+        shp_path = self._get_path_by_key_or_direct_path_(key=key, path=path)
+
+        ds = ogr.Open(shp_path)
+        try:
+            features = self._get_features_object_(ds, uid=uid, select_uid=select_uid, select_sql_where=select_sql_where,
+                                                  driver_kwargs=driver_kwargs, properties=[])
+            uid_index = None
+            uids = []
+            wkbs = []
+            for ctr, feature in self._iter_features_(features, slc=slc):
+                if uid_index is None:
+                    uid_index = feature.GetFieldIndex(uid)
+                    if uid_index < 0:
+                        msg = 'The unique identifier "{0}" was not found in the feature fields.'.format(uid)
+                        raise ValueError(msg)
+
+                ogr_geom = feature.GetGeometryRef()
+                if ogr_geom is None:
+                    # Null geometries are empty geometries with no parts.
+                    wkbs.append(_EMPTY_POLYGON_WKB)
+                else:
+                    if dest_crs is not None:
+                        ogr_geom.TransformTo(dest_crs)
+                    wkbs.append(ogr_geom.ExportToWkb(ogr.wkbNDR))
+                uids.append(feature.GetField(uid_index))
+
+                if len(wkbs) == block_size:
+                    yield get_columnar_block(uids, wkbs)
+                    uids = []
+                    wkbs = []
+
+            if len(wkbs) > 0:
+                yield get_columnar_block(uids, wkbs)
+        finally:
+            ds.Destroy()
+            ds = None
+
+    @staticmethod
+    def _iter_features_(features, slc=None):
+        """
+        Iterate over features from the current read position.
+
+        :param features: The layer returned by :meth:`~utools.io.geom_cabinet.GeomCabinet._get_features_object_`.
+        :type features: :class:`osgeo.ogr.Layer`
+        :param sequence slc: A two-element integer sequence ``[start, stop]`` of feature indices. If the driver supports
+         fast random reads, reading starts directly at ``start``. Otherwise, features before ``start`` are skipped.
+        :returns: Tuples of ``(feature index, feature)``.
+        """
+
+        ctr = 0
+        if slc is not None and slc[0] > 0 and features.TestCapability(ogr.OLCFastSetNextByIndex):
+            if features.SetNextByIndex(slc[0]) == 0:
+                ctr = slc[0]
+            else:
+                features.ResetReading()
+
+        # Iterating a layer directly restarts reading from the first feature.
+        while True:
+            if slc is not None and ctr >= slc[1]:
+                break
+            feature = features.GetNextFeature()
+            if feature is None:
+                break
+            if slc is None or ctr >= slc[0]:
+                yield ctr, feature
+            ctr += 1
+
     def _get_path_by_key_or_direct_path_(self, key=None, path=None):
         """
         :param str key:
@@ -147,7 +241,8 @@ class GeomCabinet(object):
         return shp_path
 
     @staticmethod
-    def _get_features_object_(ds, uid=None, select_uid=None, select_sql_where=None, driver_kwargs=None):
+    def _get_features_object_(ds, uid=None, select_uid=None, select_sql_where=None, driver_kwargs=None, properties=None,
+                              load_geoms=True):
         """
         :param ds: Path to shapefile.
         :type ds: Open OGR dataset object
@@ -166,6 +261,9 @@ class GeomCabinet(object):
         | OpenFileGDB | ``'feature_class'``  | String feature class name to choose. |
         +-------------+----------------------+--------------------------------------+
 
+        :param sequence properties: Names of the attributes to read in addition to ``uid``. Other attributes are
+         ignored by the driver and not decoded. If ``None``, read all attributes.
+        :param bool load_geoms: If ``False``, the driver does not decode geometries.
         :returns: A layer object with selection applied if ``select_uid`` is not ``None``.
         :rtype: :class:`osgeo.ogr.Layer`
         """
@@ -195,6 +293,21 @@ class GeomCabinet(object):
             features = ds.ExecuteSQL(sql)
         else:
             features = lyr
+
+        ignored = []
+        if properties is not None:
+            defn = features.GetLayerDefn()
+            keep = set(properties)
+            keep.add(uid)
+            for idx in range(defn.GetFieldCount()):
+                name = defn.GetFieldDefn(idx).GetName()
+                if name not in keep:
+                    ignored.append(name)
+        if not load_geoms:
+            ignored.append('OGR_GEOMETRY')
+        if len(ignored) > 0:
+            features.SetIgnoredFields(ignored)
+
         return features
 
 
@@ -239,12 +352,17 @@ class GeomCabinetIterator(object):
     >>> slc = [0, 5]
 
     :type slice: sequence
+    :param sequence properties: Names of the attributes to read in addition to ``uid``. Unneeded attributes are not
+     decoded by the driver. If ``None``, read all attributes.
+
+    >>> properties = ['STATE_NAME']
+
     :raises: ValueError, RuntimeError
     :rtype: dict
     """
 
     def __init__(self, key=None, select_uid=None, path=None, load_geoms=True, uid=None, select_sql_where=None,
-                 slc=None, dest_crs=None, driver_kwargs=None):
+                 slc=None, dest_crs=None, driver_kwargs=None, properties=None):
         self.key = key
         self.path = path
         self.select_uid = select_uid
@@ -254,6 +372,7 @@ class GeomCabinetIterator(object):
         self.slc = slc
         self.dest_crs = dest_crs
         self.driver_kwargs = driver_kwargs
+        self.properties = properties
         self.sc = GeomCabinet()
 
     def __iter__(self):
@@ -263,7 +382,8 @@ class GeomCabinetIterator(object):
 
         for row in self.sc.iter_geoms(key=self.key, select_uid=self.select_uid, path=self.path,
                                       load_geoms=self.load_geoms, uid=self.uid, select_sql_where=self.select_sql_where,
-                                      slc=self.slc, dest_crs=self.dest_crs, driver_kwargs=self.driver_kwargs):
+                                      slc=self.slc, dest_crs=self.dest_crs, driver_kwargs=self.driver_kwargs,
+                                      properties=self.properties):
             yield row
 
     def __len__(self):
@@ -274,6 +394,8 @@ class GeomCabinetIterator(object):
             ret = self.slc[1] - self.slc[0]
         elif self.select_uid is not None:
             ret = len(self.select_uid)
+        elif self.select_sql_where is None:
+            ret = get_layer_metadata(shp_path, driver_kwargs=self.driver_kwargs)['count']
         else:
             # get the geometries
             ds = ogr.Open(shp_path)
@@ -288,6 +410,225 @@ class GeomCabinetIterator(object):
         return ret
 
 
+def get_layer_metadata(path, driver_kwargs=None, bcast=False):
+    """
+    Get metadata for the layer read from a geometry container. Metadata is cached by path and feature class and read
+    again if the modification time or size of the container's files changes. Metadata for sources without files (i.e.
+    database connection strings or virtual file system paths) is not cached.
+
+    :param str path: Path to the geometry container.
+    :param dict driver_kwargs: GDAL driver-specific arguments. See
+     :meth:`~utools.io.geom_cabinet.GeomCabinet._get_features_object_`.
+    :param bool bcast: If ``True``, only the root rank reads the metadata and broadcasts it to the other ranks. This is a
+     collective operation.
+    :returns: A dictionary with keys:
+
+    ========== ================================================================
+    Key        Value
+    ========== ================================================================
+    ``count``  The number of features in the layer.
+    ``meta``   The ``fiona`` metadata dictionary (driver, schema, and CRS).
+    ``extent`` The layer bounds as ``(min x, min y, max x, max y)``.
+    ``stamp``  The modification time and total size of the container's files or ``None``.
+    ========== ================================================================
+
+    :rtype: dict
+    """
+
+    driver_kwargs = driver_kwargs or {}
+    feature_class = driver_kwargs.get('feature_class')
+    key = (os.path.abspath(path), feature_class)
+
+    if bcast and MPI_RANK != 0:
+        ret = None
+    else:
+        stamp = get_path_stamp(path)
+        ret = _LAYER_METADATA.get(key)
+        if ret is None or stamp is None or ret['stamp'] != stamp:
+            kwargs = {} if feature_class is None else {'layer': str(feature_class)}
+            with fiona.open(path, 'r', **kwargs) as source:
+                ret = {'count': len(source), 'meta': source.meta, 'extent': source.bounds, 'stamp': stamp}
+    if bcast:
+        ret = MPI_COMM.bcast(ret)
+    if ret['stamp'] is not None:
+        _LAYER_METADATA[key] = ret
+
+    # Callers may modify the returned metadata.
+    return deepcopy(ret)
+
+
+def get_path_stamp(path):
+    """
+    :param str path: Path to a directory geometry container or a file. For a file, all files with the same name and a
+     different extension are included (i.e. shapefile sidecar files). Files with longer names are not included.
+    :returns: The maximum modification time and total size of the geometry container's files or ``None`` if there are
+     no files (i.e. a database connection string).
+    :rtype: tuple
+    """
+
+    if os.path.isdir(path):
+        paths = [os.path.join(path, fn) for fn in os.listdir(path)]
+    else:
+        stem = os.path.splitext(path)[0]
+        paths = [p for p in glob(stem + '.*') if os.path.splitext(p)[0] == stem]
+    if len(paths) == 0:
+        return None
+    stats = [os.stat(p) for p in paths]
+    return max([s.st_mtime for s in stats]), sum([s.st_size for s in stats])
+
+
+def get_columnar_block(uids, wkbs):
+    ret = get_columnar_geometries(wkbs)
+    ret['uid'] = np.array(uids, dtype=np.int64)
+    return ret
+
+
+def get_columnar_geometries(wkbs):
+    """
+    Parse polygon and multipolygon WKB into flat coordinate and offset arrays. Shapely geometry objects are not
+    created. Ring coordinates are kept as stored, including the repeated closing coordinate. Z and M values are dropped.
+
+    :param sequence wkbs: Sequence of WKB strings.
+    :returns: A dictionary with keys:
+
+    ====================== ======================================================================================
+    Key                    Value
+    ====================== ======================================================================================
+    ``'coordinates'``      Coordinates for all rings with shape ``(n_coordinates, 2)``.
+    ``'ring_offsets'``     Start index in ``'coordinates'`` of each ring with shape ``(n_rings + 1,)``.
+    ``'part_offsets'``     Start index in ``'ring_offsets'`` of each polygon part with shape ``(n_parts + 1,)``.
+    ``'geometry_offsets'`` Start index in ``'part_offsets'`` of each geometry with shape ``(n_geometries + 1,)``.
+    ====================== ======================================================================================
+
+    The exterior ring of a polygon part is the first ring of the part.
+
+    :rtype: dict
+    :raises: ValueError
+    """
+
+    buf = b''.join(wkbs)
+    rings = []
+    part_sizes = []
+    geometry_sizes = []
+
+    pos = 0
+    for _ in range(len(wkbs)):
+        geometry_type, endian, dim, pos = _read_wkb_header_(buf, pos)
+        if geometry_type == 3:
+            pos = _read_wkb_polygon_(buf, pos, endian, dim, rings, part_sizes)
+            geometry_sizes.append(1)
+        elif geometry_type == 6:
+            n_parts = struct.unpack_from(endian + 'I', buf, pos)[0]
+            pos += 4
+            for _ in range(n_parts):
+                part_type, part_endian, part_dim, pos = _read_wkb_header_(buf, pos)
+                if part_type != 3:
+                    raise ValueError('Multipolygon parts must be polygons. Geometry type: {}'.format(part_type))
+                pos = _read_wkb_polygon_(buf, pos, part_endian, part_dim, rings, part_sizes)
+            geometry_sizes.append(n_parts)
+        else:
+            raise ValueError('Only polygon and multipolygon geometries are supported. Geometry type: {}'.format(
+                geometry_type))
+
+    ret = {'ring_offsets': get_offsets_from_sizes([r[1] for r in rings]),
+           'part_offsets': get_offsets_from_sizes(part_sizes),
+           'geometry_offsets': get_offsets_from_sizes(geometry_sizes)}
+
+    if len(rings) == 0:
+        ret['coordinates'] = np.zeros((0, 2), dtype=np.float64)
+    elif len(set([(r[2], r[3]) for r in rings])) == 1:
+        # Gather the coordinate bytes for all rings at once and reinterpret them as doubles.
+        endian, dim = rings[0][2:]
+        starts = np.array([r[0] for r in rings], dtype=np.int64)
+        nbytes = np.array([r[1] for r in rings], dtype=np.int64) * dim * 8
+        byte_offsets = get_offsets_from_sizes(nbytes)
+        byte_index = np.arange(byte_offsets[-1], dtype=np.int64) + np.repeat(starts - byte_offsets[:-1], nbytes)
+        raw = np.frombuffer(buf, dtype=np.uint8)[byte_index]
+        ret['coordinates'] = raw.view(endian + 'f8').reshape(-1, dim)[:, 0:2].astype(np.float64)
+    else:
+        coordinates = [np.frombuffer(buf, dtype=endian + 'f8', count=n * dim, offset=start).reshape(-1, dim)[:, 0:2]
+                       for start, n, endian, dim in rings]
+        ret['coordinates'] = np.vstack(coordinates).astype(np.float64)
+
+    return ret
+
+
+def get_columnar_bounds(block):
+    """
+    :param dict block: Columnar geometries returned by :func:`~utools.io.geom_cabinet.get_columnar_geometries`.
+    :returns: The bounds ``(min x, min y, max x, max y)`` for each geometry with shape ``(n_geometries, 4)``. Bounds for
+     empty geometries are ``nan``.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    geometry_offsets = block['geometry_offsets']
+    coordinate_offsets = block['ring_offsets'][block['part_offsets'][geometry_offsets]]
+    ret = np.zeros((geometry_offsets.shape[0] - 1, 4), dtype=np.float64)
+    ret[:] = np.nan
+
+    starts = coordinate_offsets[:-1]
+    select = coordinate_offsets[1:] > starts
+    if np.any(select):
+        coordinates = block['coordinates']
+        ret[select, 0:2] = np.minimum.reduceat(coordinates, starts[select], axis=0)
+        ret[select, 2:4] = np.maximum.reduceat(coordinates, starts[select], axis=0)
+    return ret
+
+
+def get_columnar_sizes(block):
+    """
+    :param dict block: Columnar geometries returned by :func:`~utools.io.geom_cabinet.get_columnar_geometries`.
+    :returns: A tuple ``(node_counts, part_counts)`` for each geometry. Node counts are for part exteriors without the
+     repeated closing coordinate. Holes and parts without rings are not counted.
+    :rtype: tuple of :class:`numpy.ndarray`
+    """
+
+    part_offsets = block['part_offsets']
+    ring_offsets = block['ring_offsets']
+    geometry_offsets = block['geometry_offsets']
+
+    # The first ring of each part is its exterior.
+    has_rings = part_offsets[1:] > part_offsets[:-1]
+    exteriors = part_offsets[:-1][has_rings]
+    part_node_counts = np.zeros(part_offsets.shape[0] - 1, dtype=np.int64)
+    part_node_counts[has_rings] = ring_offsets[exteriors + 1] - ring_offsets[exteriors] - 1
+
+    # Sum over the parts of each geometry using cumulative sums to allow geometries without parts.
+    node_offsets = get_offsets_from_sizes(part_node_counts)
+    node_counts = node_offsets[geometry_offsets[1:]] - node_offsets[geometry_offsets[:-1]]
+    part_count_offsets = get_offsets_from_sizes(has_rings)
+    part_counts = part_count_offsets[geometry_offsets[1:]] - part_count_offsets[geometry_offsets[:-1]]
+    return node_counts, part_counts
+
+
+def get_offsets_from_sizes(sizes):
+    ret = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=ret[1:])
+    return ret
+
+
+def _read_wkb_header_(buf, pos):
+    endian = '<' if struct.unpack_from('B', buf, pos)[0] == 1 else '>'
+    geometry_type = struct.unpack_from(endian + 'I', buf, pos + 1)[0]
+    # Both ISO (e.g. 1003) and extended (e.g. 0x80000003) type codes are used for geometries with Z or M values.
+    dim = 2 + int(bool(geometry_type & 0x80000000)) + int(bool(geometry_type & 0x40000000))
+    geometry_type &= 0x0FFFFFFF
+    dim += {0: 0, 1: 1, 2: 1, 3: 2}[geometry_type // 1000]
+    return geometry_type % 1000, endian, dim, pos + 5
+
+
+def _read_wkb_polygon_(buf, pos, endian, dim, rings, part_sizes):
+    n_rings = struct.unpack_from(endian + 'I', buf, pos)[0]
+    pos += 4
+    for _ in range(n_rings):
+        n_points = struct.unpack_from(endian + 'I', buf, pos)[0]
+        pos += 4
+        rings.append((pos, n_points, endian, dim))
+        pos += n_points * dim * 8
+    part_sizes.append(n_rings)
+    return pos
+
+
 def get_gdal_driver(ds):
     driver = ds.GetDriver()
     return driver.GetName()
@@ -1,12 +1,18 @@
+import itertools
 import os
+from collections import OrderedDict, deque
 from copy import copy
+from multiprocessing import Pool
 
 from osgeo import ogr, osr
 from shapely.geometry import shape
 from shapely.geometry.base import BaseMultipartGeometry
 
+from utools.constants import UgridToolsConstants
 from utools.io.geom_cabinet import GeomCabinetIterator, GeomCabinet
-from utools.io.helpers import get_node_count, get_split_polygon_by_node_threshold
+from utools.io.helpers import get_node_count, get_split_polygon_by_node_threshold, get_rtree_path, \
+    get_rtree_is_current, create_rtree_file, get_geometry_nbytes
+from utools.io.mpi import MPI_COMM, MPI_RANK
 
 ogr.UseExceptions()
 osr.UseExceptions()
@@ -16,10 +22,20 @@ class GeometryManager(object):
     """
     Provides iteration, validation, and other management routines for collecting vector geometries from record lists or
     flat files.
+
+    :param int geometry_cache_nbytes: If provided, keep up to this many bytes of decoded file records in memory. See
+     :class:`~utools.io.geom_manager.GeometryCache`.
+    :param str split_method: The method used to split records with more nodes than ``node_threshold``. See
+     :func:`~utools.io.helpers.get_split_polygon_by_node_threshold`.
+    :param int split_processes: If greater than one, split records with more nodes than ``node_threshold`` using a
+     local pool with this many processes. Records are still returned in order. Intended for runs without MPI as the
+     pool forks the current process. The pool is only started once a record needs splitting. Records selected by
+     unique identifier are split in the current process.
     """
 
     def __init__(self, name_uid, path=None, records=None, path_rtree=None, allow_multipart=False, node_threshold=None,
-                 dest_crs=None, driver_kwargs=None, slc=None):
+                 dest_crs=None, driver_kwargs=None, slc=None, properties=None, geometry_cache_nbytes=None,
+                 split_method=None, split_processes=None):
         if path_rtree is not None:
             assert os.path.exists(path_rtree + '.idx')
 
@@ -32,6 +48,16 @@ class GeometryManager(object):
         self.dest_crs = dest_crs
         self.driver_kwargs = driver_kwargs
         self.slc = slc
+        self.properties = properties
+        self.split_method = split_method
+        self.split_processes = split_processes
+        #: Node counts of the pieces of split records keyed by unique identifier.
+        self.split_node_counts = {}
+
+        if geometry_cache_nbytes is None or records is not None:
+            self.geometry_cache = None
+        else:
+            self.geometry_cache = GeometryCache(geometry_cache_nbytes)
 
         self._has_provided_records = False if records is None else True
 
@@ -44,19 +70,142 @@ class GeometryManager(object):
 
     @property
     def meta(self):
-        return GeomCabinet(path=self.path).get_meta(path=self.path)
+        return GeomCabinet(path=self.path).get_meta(path=self.path, driver_kwargs=self.driver_kwargs)
 
     def get_spatial_index(self):
+        """
+        Get a spatial index for the geometries. If ``path_rtree`` is not provided for a file source, the index is
+        stored at :func:`~utools.io.helpers.get_rtree_path` and rebuilt when the source changes. If the index cannot be
+        written, it is built in memory. Building the index is a collective operation.
+
+        :rtype: :class:`utools.io.spatial_index.SpatialIndex`
+        """
         from spatial_index import SpatialIndex
 
-        si = SpatialIndex(path=self.path_rtree)
-        # Only add new records to the index if we are working in-memory.
-        if self.path_rtree is None:
-            for uid, record in self.iter_records(return_uid=True):
-                si.add(uid, record['geom'])
+        if self.path_rtree is not None:
+            si = SpatialIndex(path=self.path_rtree)
+        elif self.records is None:
+            path_rtree = MPI_COMM.bcast(get_rtree_path(self) if MPI_RANK == 0 else None)
+            is_current = MPI_COMM.bcast(get_rtree_is_current(self, path_rtree) if MPI_RANK == 0 else None)
+            # Opening a missing index file creates an empty index.
+            if is_current and all(MPI_COMM.allgather(os.path.exists(path_rtree + '.idx'))):
+                si = SpatialIndex(path=path_rtree)
+            else:
+                si = create_rtree_file(self, path_rtree)
+        else:
+            # Only add new records to the index if we are working in-memory.
+            stream = ((uid, record['geom'].bounds, None) for uid, record in self.iter_records(return_uid=True))
+            si = SpatialIndex(stream=stream)
         return si
 
     def iter_records(self, return_uid=False, select_uid=None, slc=None, dest_crs=None):
+        # Records are only cached for the manager's coordinate system.
+        if dest_crs is None:
+            cache = self.geometry_cache
+        else:
+            cache = None
+
+        if cache is not None and select_uid is not None:
+            to_iter = self._iter_cached_records_(cache, select_uid)
+        else:
+            to_iter = self._iter_decoded_records_(select_uid=select_uid, slc=slc, dest_crs=dest_crs)
+            if cache is not None:
+                to_iter = self._iter_caching_records_(cache, to_iter)
+
+        for record in to_iter:
+            if return_uid:
+                uid = record['properties'][self.name_uid]
+                yld = (uid, record)
+            else:
+                yld = record
+            yield yld
+
+    def _iter_cached_records_(self, cache, select_uid):
+        # Collect cached records first so they cannot be evicted while loading the missing records.
+        cached = {uid: cache.get(uid) for uid in select_uid if uid in cache}
+        missing = [uid for uid in select_uid if uid not in cached]
+        if len(missing) > 0:
+            # Slice the selection explicitly so a manager slice is not applied to the selected records.
+            for record in self._iter_decoded_records_(select_uid=missing, slc=[0, len(missing)]):
+                uid = record['properties'][self.name_uid]
+                cache.put(uid, record)
+                cached[uid] = record
+        for uid in select_uid:
+            if uid in cached:
+                yield cached[uid]
+
+    def _iter_caching_records_(self, cache, records):
+        for record in records:
+            cache.put(record['properties'][self.name_uid], record)
+            yield record
+
+    def _iter_decoded_records_(self, select_uid=None, slc=None, dest_crs=None):
+        to_iter = self._iter_validated_records_(select_uid=select_uid, slc=slc, dest_crs=dest_crs)
+
+        # Modify the geometry if a node threshold is provided. This breaks the polygon object into pieces with the
+        # approximate node count.
+        if self.node_threshold is None:
+            ret = to_iter
+        elif self.split_processes is None or self.split_processes <= 1 or select_uid is not None:
+            # Selections are small, often a single record, and not worth starting a pool.
+            ret = self._iter_split_records_(to_iter)
+        else:
+            ret = self._iter_split_records_pool_(to_iter)
+        return ret
+
+    def _iter_split_records_(self, records):
+        for record in records:
+            if get_node_count(record['geom']) > self.node_threshold:
+                geom = get_split_polygon_by_node_threshold(record['geom'], self.node_threshold,
+                                                           split_method=self.split_method)
+                self._set_split_geometry_(record, geom)
+            yield record
+
+    def _iter_split_records_pool_(self, records):
+        records = iter(records)
+        # Only fork the pool once a chunk has records to split.
+        pool = None
+        try:
+            # Chunks of records with their pending splits. Records are read while earlier chunks are split.
+            pending = deque()
+            while True:
+                chunk = list(itertools.islice(records, UgridToolsConstants.SPLIT_CHUNK_SIZE))
+                if len(chunk) > 0:
+                    to_split = [ii for ii, r in enumerate(chunk) if get_node_count(r['geom']) > self.node_threshold]
+                    if len(to_split) > 0:
+                        if pool is None:
+                            pool = Pool(self.split_processes)
+                        args = [(chunk[ii]['geom'], self.node_threshold, self.split_method) for ii in to_split]
+                        result = pool.map_async(_split_geometry_, args, chunksize=1)
+                    else:
+                        result = None
+                    pending.append((chunk, to_split, result))
+                # Limit the number of chunks held in memory.
+                while len(pending) > self.split_processes or (len(chunk) == 0 and len(pending) > 0):
+                    chunk_done, to_split, result = pending.popleft()
+                    if result is not None:
+                        for ii, geom in zip(to_split, result.get()):
+                            self._set_split_geometry_(chunk_done[ii], geom)
+                    for record in chunk_done:
+                        yield record
+                if len(chunk) == 0:
+                    break
+            if pool is not None:
+                pool.close()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+
+    def _set_split_geometry_(self, record, geom):
+        record['geom'] = geom
+        uid = record['properties'][self.name_uid]
+        self.split_node_counts[uid] = [get_node_count(p) for p in geom]
+
+    def _iter_validated_records_(self, select_uid=None, slc=None, dest_crs=None):
         # Use records attached to the object or load records from source data.
         to_iter = self.records or self._get_records_(select_uid=select_uid, slc=slc, dest_crs=dest_crs)
 
@@ -69,25 +218,14 @@ class GeometryManager(object):
                 # Only use the geometry objects from here. Maintaining the list of coordinates is superfluous.
                 record.pop('geometry')
             self._validate_record_(record)
-
-            # Modify the geometry if a node threshold is provided. This breaks the polygon object into pieces with the
-            # approximate node count.
-            if self.node_threshold is not None and get_node_count(record['geom']) > self.node_threshold:
-                record['geom'] = get_split_polygon_by_node_threshold(record['geom'], self.node_threshold)
-
-            if return_uid:
-                uid = record['properties'][self.name_uid]
-                yld = (uid, record)
-            else:
-                yld = record
-            yield yld
+            yield record
 
     def _get_records_(self, select_uid=None, slc=None, dest_crs=None):
         slc = slc or self.slc
         dest_crs = dest_crs or self.dest_crs
 
         gi = GeomCabinetIterator(path=self.path, uid=self.name_uid, select_uid=select_uid, slc=slc, dest_crs=dest_crs,
-                                 driver_kwargs=self.driver_kwargs)
+                                 driver_kwargs=self.driver_kwargs, properties=self.properties)
         return gi
 
     def _validate_record_(self, record):
@@ -98,3 +236,73 @@ class GeometryManager(object):
             msg = 'Only singlepart geometries allowed. Perhaps "utools.convert_multipart_to_singlepart" would be ' \
                   'useful?'
             raise ValueError(msg)
+
+
+def _split_geometry_(args):
+    # Module level for pickling by the split process pool.
+    geom, node_threshold, split_method = args
+    return get_split_polygon_by_node_threshold(geom, node_threshold, split_method=split_method)
+
+
+class GeometryCache(object):
+    """
+    Least recently used cache of decoded records keyed by unique identifier. The cache size is estimated from the
+    number of geometry coordinates.
+
+    :param int max_nbytes: Maximum estimated size of the cached geometries in bytes.
+    """
+
+    def __init__(self, max_nbytes):
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+
+    def __contains__(self, uid):
+        ret = uid in self._records
+        if ret:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return ret
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, uid):
+        """
+        :param int uid: The record's unique identifier.
+        :returns: A copy of the cached record. The geometry object is shared.
+        :rtype: dict
+        :raises: KeyError
+        """
+
+        # Move the record to the most recently used position.
+        entry = self._records.pop(uid)
+        self._records[uid] = entry
+        return get_record_copy(entry[0])
+
+    def put(self, uid, record):
+        """
+        :param int uid: The record's unique identifier.
+        :param dict record: The decoded record with a ``'geom'`` key.
+        """
+
+        nbytes = get_geometry_nbytes(record['geom'])
+        if nbytes > self.max_nbytes:
+            return
+        if uid in self._records:
+            self.nbytes -= self._records.pop(uid)[1]
+        self._records[uid] = (get_record_copy(record), nbytes)
+        self.nbytes += nbytes
+
+        while self.nbytes > self.max_nbytes:
+            _, (_, evicted_nbytes) = self._records.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+
+def get_record_copy(record):
+    ret = record.copy()
+    ret['properties'] = record['properties'].copy()
+    return ret
@@ -1,15 +1,20 @@
+import hashlib
 import itertools
+import json
+import os
+import tempfile
 from collections import deque, OrderedDict
 
 import fiona
 import netCDF4 as nc
 import numpy as np
 from numpy.ma import MaskedArray
-from shapely.geometry import shape, mapping, Polygon, MultiPolygon
+from shapely.geometry import shape, mapping, Polygon, MultiPolygon, box
 from shapely.geometry.base import BaseMultipartGeometry
 from shapely.geometry.polygon import orient
+from shapely.prepared import prep
 
-from mpi import MPI_RANK, create_sections, MPI_COMM, MPI_SIZE, dgather
+from mpi import MPI_RANK, create_sections, MPI_COMM, MPI_SIZE, dgather, hgather, MPI_ENABLED, get_offsets, vgather
 from utools.addict import Dict
 from utools.constants import UgridToolsConstants
 from utools.logging import log
@@ -78,12 +83,13 @@ def get_coordinate_dict_variables(cdict, n_coords, polygon_break_value=None, idx
     :param int polygon_break_value: Negative integer value to use for breaks between multi-geometries.
     :param int idx_start: Start index to use for computing node mappings. Useful in parallel when maintaining global
      mappings.
-    :return: A tuple of coordinate dictionary derived variables.
+    :return: A tuple of coordinate dictionary derived variables. The element connectivity uses the flat ESMF layout.
 
-        0 --> Node index mapping to coordinate array.
-        1 --> Coordinates array.
-        2 --> Edge node index mapping to coordinate array.
-    :rtype: tuple (array-like, array-like, array-like)
+        0 --> Node indices for all elements with polygon break values between element parts (``elementConn``).
+        1 --> Number of node indices and polygon break values for each element (``numElementConn``).
+        2 --> Coordinates array.
+        3 --> Edge node index mapping to coordinate array.
+    :rtype: tuple (array-like, array-like, array-like, array-like)
 
     >>> cdict = {5: [np.array([[1., 2], [3., 4.]]), np.array([[1., 2], [3., 4.], [5., 6.]])]}
     >>> n_coords = 5
@@ -92,30 +98,69 @@ def get_coordinate_dict_variables(cdict, n_coords, polygon_break_value=None, idx
     """
     polygon_break_value = polygon_break_value or UgridToolsConstants.POLYGON_BREAK_VALUE
     dtype_int = np.int32
-    face_nodes = np.zeros(len(cdict), dtype=object)
 
-    global_idx_start = idx_start
-    for idx_face_nodes, coordinates_list in enumerate(cdict.itervalues()):
-        if idx_face_nodes == 0:
-            coordinates = np.zeros((n_coords, 2), dtype=coordinates_list[0].dtype)
-            edge_nodes = np.zeros_like(coordinates, dtype=dtype_int)
+    n_faces = len(cdict)
+    n_parts = sum([len(coordinates_list) for coordinates_list in cdict.itervalues()])
+    # Each part after the first in an element is preceded by a polygon break value.
+    n_connections = n_coords + n_parts - n_faces
 
+    if n_faces > 0:
+        dtype_float = cdict.itervalues().next()[0].dtype
+    else:
+        dtype_float = float
+    coordinates = np.zeros((n_coords, 2), dtype=dtype_float)
+    element_conn = np.zeros(n_connections, dtype=dtype_int)
+    num_element_conn = np.zeros(n_faces, dtype=dtype_int)
+    is_break = np.zeros(n_connections, dtype=bool)
+    part_start = np.zeros(n_parts, dtype=np.int64)
+    part_stop = np.zeros(n_parts, dtype=np.int64)
+
+    # Copy coordinates and record offsets in a single pass. Node indices are filled in afterwards.
+    idx_node = 0
+    idx_conn = 0
+    idx_part = 0
+    for idx_face, coordinates_list in enumerate(cdict.itervalues()):
+        conn_start = idx_conn
         for ctr, coordinates_element in enumerate(coordinates_list):
+            if ctr > 0:
+                is_break[idx_conn] = True
+                idx_conn += 1
             shape_coordinates_row = coordinates_element.shape[0]
-            idx_stop = idx_start + shape_coordinates_row
-            new_face_nodes = np.arange(idx_start, idx_stop, dtype=dtype_int)
-            # log.debug(('new_face_nodes=', new_face_nodes.tolist()))
-            edge_nodes[idx_start - global_idx_start: idx_stop - global_idx_start, :] = get_edge_nodes(new_face_nodes)
-            if ctr == 0:
-                face_nodes_element = new_face_nodes
-            else:
-                face_nodes_element = np.hstack((face_nodes_element, polygon_break_value))
-                face_nodes_element = np.hstack((face_nodes_element, new_face_nodes))
-            coordinates[idx_start - global_idx_start:idx_stop - global_idx_start, :] = coordinates_element
-            idx_start += shape_coordinates_row
-        face_nodes[idx_face_nodes] = face_nodes_element.astype(dtype_int)
+            coordinates[idx_node:idx_node + shape_coordinates_row, :] = coordinates_element
+            part_start[idx_part] = idx_node
+            idx_node += shape_coordinates_row
+            part_stop[idx_part] = idx_node
+            idx_conn += shape_coordinates_row
+            idx_part += 1
+        num_element_conn[idx_face] = idx_conn - conn_start
+
+    nodes = np.arange(idx_start, idx_start + n_coords, dtype=dtype_int)
+    element_conn[is_break] = polygon_break_value
+    element_conn[np.invert(is_break)] = nodes
+
+    # Edges connect each node to the next node in its part. The last node in a part connects to the first.
+    edge_nodes = np.zeros((n_coords, 2), dtype=dtype_int)
+    edge_nodes[:, 0] = nodes
+    edge_nodes[:, 1] = nodes + 1
+    edge_nodes[part_stop - 1, 1] = nodes[part_start]
 
-    return face_nodes, coordinates, edge_nodes
+    return element_conn, num_element_conn, coordinates, edge_nodes
+
+
+def get_face_nodes_from_element_conn(element_conn, num_element_conn):
+    """
+    :param element_conn: Flat node indices for all elements. See :func:`~utools.io.helpers.get_coordinate_dict_variables`.
+    :type element_conn: :class:`numpy.ndarray`
+    :param num_element_conn: Number of node indices for each element.
+    :type num_element_conn: :class:`numpy.ndarray`
+    :returns: A numpy object array with slots containing views of ``element_conn`` for each element.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    ret = np.zeros(num_element_conn.shape[0], dtype=object)
+    for idx, fn in enumerate(np.split(element_conn, np.cumsum(num_element_conn)[0:-1])):
+        ret[idx] = fn
+    return ret
 
 
 def get_edge_nodes(face_nodes):
@@ -126,12 +171,18 @@ def get_edge_nodes(face_nodes):
     return edge_nodes
 
 
-def get_variables(gm, use_ragged_arrays=False, with_connectivity=True):
+def get_variables(gm, use_ragged_arrays=False, with_connectivity=True, connectivity_method='touches', pack=False,
+                  pack_decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS, esmf_layout=False, balance=False):
     """
     :param gm: The geometry manager containing geometries to convert to mesh variables.
     :type gm: :class:`pyugrid.flexible_mesh.helpers.GeometryManager`
-    :param pack: If ``True``, de-deduplicate shared coordinates.
+    :param pack: If ``True``, de-deduplicate shared coordinates. See :func:`~utools.io.helpers.get_packed_nodes`.
     :type pack: bool
+    :param int pack_decimals: Number of decimals used when rounding coordinates to find duplicates.
+    :param bool esmf_layout: If ``True``, only create the flat ESMF element connectivity. ``face_nodes`` and
+     ``face_edges`` are ``None``.
+    :param str connectivity_method: See :func:`~utools.io.helpers.get_face_variables`.
+    :param bool balance: See :func:`~utools.io.helpers.get_face_variables`.
     :returns: A tuple of arrays with index locations corresponding to:
 
     ===== ================ =============================
@@ -140,11 +191,14 @@ def get_variables(gm, use_ragged_arrays=False, with_connectivity=True):
     0     face_nodes       :class:`numpy.ma.MaskedArray`
     1     face_edges       :class:`numpy.ma.MaskedArray`
     2     edge_nodes       :class:`numpy.ndarray`
-    3     node_x           :class:`numpy.ndarray`
-    4     node_y           :class:`numpy.ndarray`
-    5     face_links       :class:`numpy.ndarray`
-    6     face_ids         :class:`numpy.ndarray`
-    7     face_coordinates :class:`numpy.ndarray`
+    3     coordinates      :class:`numpy.ndarray`
+    4     face_links       :class:`numpy.ndarray`
+    5     face_ids         :class:`numpy.ndarray`
+    6     face_coordinates :class:`numpy.ndarray`
+    7     face_areas       :class:`numpy.ndarray`
+    8     section          :class:`list`
+    9     element_conn     :class:`numpy.ndarray`
+    10    num_element_conn :class:`numpy.ndarray`
     ===== ================ =============================
 
     Information on individual variables may be found here: https://github.com/ugrid-conventions/ugrid-conventions/blob/9b6540405b940f0a9299af9dfb5e7c04b5074bf7/ugrid-conventions.md#2d-flexible-mesh-mixed-triangles-quadrilaterals-etc-topology
@@ -153,40 +207,137 @@ def get_variables(gm, use_ragged_arrays=False, with_connectivity=True):
     :raises: ValueError
     """
     # tdk: update doc
+    if gm.records is None:
+        from utools.io.geom_cabinet import get_layer_metadata
+
+        # Read the layer metadata once and share it with the other ranks.
+        get_layer_metadata(gm.path, driver_kwargs=gm.driver_kwargs, bcast=True)
     if len(gm) < MPI_SIZE:
         raise ValueError('The number of geometries must be greater than or equal to the number of processes.')
 
     pbv = UgridToolsConstants.POLYGON_BREAK_VALUE
 
-    result = get_face_variables(gm, with_connectivity=with_connectivity)
+    result = get_face_variables(gm, with_connectivity=with_connectivity, connectivity_method=connectivity_method,
+                                balance=balance)
     face_links, nmax_face_nodes, face_ids, face_coordinates, cdict, n_coords, face_areas, section = result
 
-    # Find the start index for each rank.
-    all_n_coords = MPI_COMM.gather(n_coords)
-    if MPI_RANK == 0:
-        all_idx_start = [0] * MPI_SIZE
-        for idx in range(len(all_n_coords)):
-            if idx == 0:
-                continue
-            else:
-                all_idx_start[idx] = all_n_coords[idx - 1] + all_idx_start[idx - 1]
+    if pack:
+        element_conn, num_element_conn, coordinates, edge_nodes = get_coordinate_dict_variables(
+            cdict, n_coords, polygon_break_value=pbv)
+        element_conn, coordinates, edge_nodes = get_packed_nodes(element_conn, coordinates, edge_nodes,
+                                                                 decimals=pack_decimals)
     else:
-        all_idx_start = None
-    idx_start = MPI_COMM.scatter(all_idx_start)
-    log.debug(('idx_start', idx_start))
+        element_conn, num_element_conn, coordinates, edge_nodes = get_unpacked_nodes(cdict, n_coords, pbv)
+    face_ids = np.array(cdict.keys(), dtype=get_uid_dtype(cdict.keys(), collective=True))
 
-    face_nodes, coordinates, edge_nodes = get_coordinate_dict_variables(cdict, n_coords, polygon_break_value=pbv,
-                                                                        idx_start=idx_start)
+    if esmf_layout:
+        face_nodes = None
+    else:
+        face_nodes = get_face_nodes_from_element_conn(element_conn, num_element_conn)
     face_edges = face_nodes
-    face_ids = np.array(cdict.keys(), dtype=np.int32)
 
     if not use_ragged_arrays:
         new_arrays = []
         for a in (face_links, face_nodes, face_edges):
-            new_arrays.append(get_rectangular_array_from_object_array(a, (a.shape[0], nmax_face_nodes)))
+            if a is not None:
+                a = get_rectangular_array_from_object_array(a, (a.shape[0], nmax_face_nodes))
+            new_arrays.append(a)
         face_links, face_nodes, face_edges = new_arrays
 
-    return face_nodes, face_edges, edge_nodes, coordinates, face_links, face_ids, face_coordinates, face_areas, section
+    return face_nodes, face_edges, edge_nodes, coordinates, face_links, face_ids, face_coordinates, face_areas, \
+           section, element_conn, num_element_conn
+
+
+def get_unpacked_nodes(cdict, n_coords, polygon_break_value):
+    """
+    Create mesh node variables with each face having its own nodes.
+
+    :returns: See :func:`~utools.io.helpers.get_coordinate_dict_variables`.
+    """
+
+    # Find the start index for each rank.
+    idx_start, _ = get_offsets(n_coords)
+    log.debug(('idx_start', idx_start))
+
+    return get_coordinate_dict_variables(cdict, n_coords, polygon_break_value=polygon_break_value,
+                                         idx_start=idx_start)
+
+
+def get_packed_nodes(element_conn, coordinates, edge_nodes, decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS):
+    """
+    De-duplicate nodes with coordinates that are equal after rounding. Duplicates are removed across all ranks. Each
+    unique node is owned by a single rank selected by hashing its rounded coordinates. The returned coordinates are
+    the nodes owned by the rank with global node indices increasing by rank.
+
+    :param element_conn: Flat rank-local node indices for all faces. Polygon break values are not remapped.
+    :type element_conn: :class:`numpy.ndarray`
+    :param coordinates: The rank's node coordinates with dimension ``(n, 2)``.
+    :type coordinates: :class:`numpy.ndarray`
+    :param edge_nodes: Rank-local node indices for each edge with dimension ``(m, 2)``.
+    :type edge_nodes: :class:`numpy.ndarray`
+    :param int decimals: Number of decimals used when rounding coordinates for comparison.
+    :returns: A tuple of packed ``(element_conn, coordinates, edge_nodes)`` with global node indices.
+    :rtype: tuple (array-like, array-like, array-like)
+    """
+
+    # De-duplicate locally first to reduce the number of nodes exchanged.
+    # Adding zero converts negative zeros so they hash the same as positive zeros.
+    keys = np.round(coordinates.astype(np.float64), decimals=decimals) + 0.
+    unique_keys, unique_index, local_map = get_unique_rows(keys)
+    unique_coordinates = coordinates[unique_index]
+
+    # Assign an owner rank to each unique node and send it the node's rounded and original coordinates.
+    hashed = unique_keys.view(np.uint64)
+    owner = ((hashed[:, 0] * np.uint64(1000003)) ^ hashed[:, 1]) % np.uint64(MPI_SIZE)
+    send_index = [np.where(owner == rank)[0] for rank in range(MPI_SIZE)]
+    received = MPI_COMM.alltoall([(unique_keys[ii], unique_coordinates[ii]) for ii in send_index])
+
+    # The owner de-duplicates its received nodes. Global indices start after the nodes owned by lower ranks.
+    received_counts = [r[0].shape[0] for r in received]
+    owned_keys, owned_index, owned_map = get_unique_rows(np.concatenate([r[0] for r in received]))
+    owned_coordinates = np.concatenate([r[1] for r in received])[owned_index]
+    node_start, _ = get_offsets(owned_keys.shape[0])
+    owned_map = owned_map.astype(np.int32) + node_start
+
+    # Return the global indices to the ranks that sent the nodes.
+    received_bounds = np.cumsum([0] + received_counts)
+    global_index = MPI_COMM.alltoall([owned_map[received_bounds[ii]:received_bounds[ii + 1]]
+                                      for ii in range(MPI_SIZE)])
+    unique_global_index = np.zeros(unique_keys.shape[0], dtype=np.int32)
+    for ii, gi in zip(send_index, global_index):
+        unique_global_index[ii] = gi
+    node_map = unique_global_index[local_map]
+
+    new_element_conn = element_conn.copy()
+    select = element_conn >= 0
+    new_element_conn[select] = node_map[element_conn[select]]
+    new_edge_nodes = node_map[edge_nodes]
+
+    log.debug(('packed node count', coordinates.shape[0], owned_coordinates.shape[0]))
+    return new_element_conn, owned_coordinates, new_edge_nodes
+
+
+def get_unique_rows(arr):
+    """
+    :param arr: Two-dimensional array.
+    :type arr: :class:`numpy.ndarray`
+    :returns: A tuple ``(unique, index, inverse)``. ``unique`` are the unique rows sorted lexicographically with the
+     first column as the primary key. ``index`` is the index of the first occurrence of each unique row in
+     ``arr``. ``inverse`` maps each row of ``arr`` to its row in ``unique``.
+    :rtype: tuple (:class:`numpy.ndarray`, :class:`numpy.ndarray`, :class:`numpy.ndarray`)
+    """
+
+    order = np.lexsort(arr.T[::-1])
+    sorted_arr = arr[order]
+    is_new = np.ones(arr.shape[0], dtype=bool)
+    is_new[1:] = np.any(sorted_arr[1:] != sorted_arr[:-1], axis=1)
+
+    sorted_inverse = np.cumsum(is_new) - 1
+    inverse = np.zeros(arr.shape[0], dtype=np.int64)
+    inverse[order] = sorted_inverse
+    # The lexsort is stable so the first element of each group is the first occurrence.
+    index = order[is_new]
+    return sorted_arr[is_new], index, inverse
 
 
 def get_rectangular_array_from_object_array(target, shape):
@@ -206,25 +357,50 @@ def iter_touching(si, gm, shapely_object):
             yield uid_target
 
 
-def get_face_variables(gm, with_connectivity=False):
-    if with_connectivity and MPI_SIZE > 1:
-        raise ValueError('Connectivity not enabled for parallel conversion.')
+def get_face_variables(gm, with_connectivity=False, connectivity_method='touches', balance=False):
+    """
+    :param gm: The geometry manager containing geometries to convert to mesh variables.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :param bool with_connectivity: If ``True``, compute face links (neighbors).
+    :param bool balance: If ``True``, balance the estimated conversion cost across ranks using per-face node counts.
+     See :func:`~utools.io.helpers.get_section_costs`. If ``False``, each rank converts the same number of faces.
+    :param str connectivity_method: The method used to find neighboring faces.
+
+    =========== ===================================================================================================
+    Method      Description
+    =========== ===================================================================================================
+    ``touches`` (default) Faces are neighbors if their geometries touch. Handles faces that do not share nodes
+                (T-junctions) but is slow and not enabled in parallel.
+    ``nodes``   Faces are neighbors if they share a node. Faces touching along an edge without sharing a node are
+                not neighbors. Enabled in parallel. See :func:`~utools.io.helpers.get_distributed_face_links`.
+    =========== ===================================================================================================
+
+    :raises: ValueError
+    """
+    if connectivity_method not in ('nodes', 'touches'):
+        raise ValueError('Connectivity method not recognized: {}'.format(connectivity_method))
+    if with_connectivity and connectivity_method == 'touches' and MPI_SIZE > 1:
+        raise ValueError('Connectivity using "touches" not enabled for parallel conversion.')
 
     n_face = len(gm)
 
+    if balance:
+        weights = get_section_costs(get_node_counts(gm))
+    else:
+        weights = None
+
     if MPI_RANK == 0:
-        sections = create_sections(n_face)
+        sections = create_sections(n_face, weights=weights)
     else:
         sections = None
 
     section = MPI_COMM.scatter(sections, root=0)
 
     # Create a spatial index to find touching faces.
-    if with_connectivity:
+    if with_connectivity and connectivity_method == 'touches':
         si = gm.get_spatial_index()
 
-    face_ids = np.zeros(section[1] - section[0], dtype=np.int32)
-    assert face_ids.shape[0] > 0
+    assert section[1] > section[0]
 
     face_links = {}
     max_face_nodes = 0
@@ -234,11 +410,10 @@ def get_face_variables(gm, with_connectivity=False):
     cdict = OrderedDict()
     n_coords = 0
 
-    for ctr, (uid_source, record_source) in enumerate(gm.iter_records(return_uid=True, slc=section)):
+    for uid_source, record_source in gm.iter_records(return_uid=True, slc=section):
         coordinates_list, n_coords = get_coordinates_list_and_update_n_coords(record_source, n_coords)
         cdict[uid_source] = coordinates_list
 
-        face_ids[ctr] = uid_source
         ref_object = record_source['geom']
 
         # Get representative points for each polygon.
@@ -257,7 +432,7 @@ def get_face_variables(gm, with_connectivity=False):
         if ncoords > max_face_nodes:
             max_face_nodes = ncoords
 
-        if with_connectivity:
+        if with_connectivity and connectivity_method == 'touches':
             touching = deque()
             for uid_target in iter_touching(si, gm, ref_object):
                 # If the objects only touch they are neighbors and may share nodes.
@@ -284,8 +459,14 @@ def get_face_variables(gm, with_connectivity=False):
     #
     #     max_face_nodes = max(max_face_nodes)
 
+    # Identifiers keep their source type so large integers are not truncated.
+    face_ids = np.array(cdict.keys())
+
     if with_connectivity:
-        face_links = get_mapped_face_links(face_ids, face_links)
+        if connectivity_method == 'nodes':
+            face_links = get_distributed_face_links(cdict.values(), section)
+        else:
+            face_links = get_mapped_face_links(face_ids, face_links)
     else:
         face_links = None
 
@@ -294,32 +475,301 @@ def get_face_variables(gm, with_connectivity=False):
     return face_links, max_face_nodes, face_ids, face_coordinates, cdict, n_coords, face_areas, section
 
 
+def get_node_counts(gm):
+    """
+    Collect the node count for each face in the geometry manager. Counts are read from the shapefile index if possible.
+    Otherwise, each rank counts the nodes for an equal share of the faces. This is a collective operation.
+
+    :param gm: The geometry manager.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :returns: Vector of node counts with shape ``(len(gm),)``.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    ret = None
+    if gm.records is None and gm.path is not None and os.path.splitext(gm.path)[1].lower() == '.shp':
+        if MPI_RANK == 0:
+            ret = get_shapefile_node_counts(gm.path)
+            if ret is not None and gm.slc is not None:
+                ret = ret[gm.slc[0]:gm.slc[1]]
+        ret = MPI_COMM.bcast(ret)
+
+    if ret is None:
+        section = create_sections(len(gm))[MPI_RANK]
+        ret = np.array([get_node_count(record['geom']) for record in gm.iter_records(slc=section)], dtype=np.int64)
+        ret = hgather(MPI_COMM.allgather(ret))
+
+    return ret
+
+
+def get_shapefile_node_counts(path):
+    """
+    Read the node count for each record in a polygon or polyline shapefile without decoding geometries. Record offsets
+    are read from the ``.shx`` index and only the point count of each record is read from the ``.shp`` file.
+
+    :param str path: Path to the ``.shp`` file.
+    :returns: Vector of node counts or ``None`` if the index is missing or the shapefile contains other shape types.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    path_shx = os.path.splitext(path)[0] + '.shx'
+    if not os.path.exists(path_shx):
+        return None
+
+    with open(path_shx, 'rb') as f:
+        # Skip the 100 byte header. Each index record contains the record offset and length in 16-bit words.
+        f.seek(100)
+        offsets = np.frombuffer(f.read(), dtype='>i4').reshape(-1, 2)[:, 0].astype(np.int64) * 2
+    if offsets.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Record contents start after the 8 byte record header. The point count follows the shape type, bounding box, and
+    # part count for polygon and polyline records.
+    shp = np.memmap(path, dtype=np.uint8, mode='r')
+    shape_types = shp[offsets[:, None] + 8 + np.arange(4)].copy().view('<i4').flatten()
+    null = shape_types == 0
+    if not np.all(null | np.in1d(shape_types, [3, 5, 13, 15, 23, 25])):
+        return None
+
+    ret = np.zeros(offsets.shape[0], dtype=np.int64)
+    select = offsets[~null]
+    ret[~null] = shp[select[:, None] + 48 + np.arange(4)].copy().view('<i4').flatten()
+    return ret
+
+
+def get_section_costs(node_counts):
+    """
+    Estimate the relative conversion cost of faces from their node counts. The cost grows linearly for small faces and
+    quadratically for faces much larger than :attr:`~utools.constants.UgridToolsConstants.SECTION_COST_NODE_SCALE`.
+
+    :param node_counts: Vector of face node counts.
+    :type node_counts: :class:`numpy.ndarray`
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    node_counts = np.asarray(node_counts, dtype=float)
+    return node_counts + node_counts ** 2 / UgridToolsConstants.SECTION_COST_NODE_SCALE
+
+
 def get_mapped_face_links(face_ids, face_links):
     """
     :param face_ids: Vector of unique, integer face identifiers.
     :type face_ids: :class:`numpy.ndarray`
-    :param face_links: List of dictionaries mapping face unique identifiers to neighbor face unique identifiers.
-    :type face_links: list
+    :param face_links: Dictionary or list of dictionaries mapping face unique identifiers to neighbor face unique
+     identifiers.
+    :type face_links: dict or list
     :returns: A numpy object array with slots containing numpy integer vectors with values equal to neighbor indices.
     :rtype: :class:`numpy.ndarray`
     """
 
-    face_links = dgather(face_links)
+    if not isinstance(face_links, dict):
+        face_links = dgather(face_links)
+
+    # Map face identifiers to their index locations using a single sort.
+    sorter = np.argsort(face_ids)
+    sorted_face_ids = face_ids[sorter]
+
     new_face_links = np.zeros(len(face_links), dtype=object)
     for idx, e in enumerate(face_ids.flat):
-        to_fill = np.zeros(len(face_links[e]), dtype=np.int32)
-        for idx_f, f in enumerate(face_links[e]):
-            # This flag indicates nothing touches the faces. Do not search for this value in the face identifiers.
-            if f == -1:
-                to_fill_value = f
-            # Search for the index location of the face identifier.
-            else:
-                to_fill_value = np.where(face_ids == f)[0][0]
-            to_fill[idx_f] = to_fill_value
-        new_face_links[idx] = to_fill
+        links = np.array(face_links[e], dtype=np.int32)
+        # This flag indicates nothing touches the faces. Do not search for this value in the face identifiers.
+        select = links != -1
+        links[select] = sorter[np.searchsorted(sorted_face_ids, links[select])]
+        new_face_links[idx] = links
     return new_face_links
 
 
+def get_distributed_face_links(coordinates, section, decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS):
+    """
+    Find neighboring faces across all ranks using :func:`~utools.io.helpers.get_face_links_from_nodes`. Each rank
+    sends the faces selected by :func:`~utools.io.helpers.get_halo_faces` to the other ranks. Neighbors are then found
+    using the rank's faces and the received halo faces.
+
+    :param coordinates: The rank's face coordinates. See :func:`~utools.io.helpers.get_face_links_from_nodes`.
+    :type coordinates: sequence
+    :param section: Two-element sequence ``[start, stop]`` of the rank's global face indices.
+    :type section: sequence
+    :param int decimals: Number of decimals used when rounding coordinates for comparison.
+    :returns: A numpy object array with slots containing numpy integer vectors with values equal to global neighbor
+     indices sorted in ascending order. Faces without neighbors have a single ``-1`` value.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    n_faces = len(coordinates)
+    face_indices = np.arange(section[0], section[0] + n_faces, dtype=np.int32)
+
+    # Bounding boxes are expanded so coordinates equal after rounding are not excluded from the halo.
+    tolerance = 10. ** -decimals
+    face_bounds = np.zeros((n_faces, 4))
+    for idx, face in enumerate(coordinates):
+        stacked = np.concatenate(face)
+        face_bounds[idx, 0:2] = stacked.min(axis=0) - tolerance
+        face_bounds[idx, 2:4] = stacked.max(axis=0) + tolerance
+
+    # Collect the halo faces to send to each rank.
+    to_send = [(face_indices[select], [coordinates[ii] for ii in select]) for select in get_halo_faces(face_bounds)]
+    received = MPI_COMM.alltoall(to_send)
+
+    all_face_indices = [face_indices]
+    all_coordinates = list(coordinates)
+    for rank, (halo_indices, halo_coordinates) in enumerate(received):
+        if rank == MPI_RANK:
+            continue
+        all_face_indices.append(halo_indices)
+        all_coordinates += halo_coordinates
+    all_face_indices = np.concatenate(all_face_indices)
+    log.debug(('halo face count', all_face_indices.shape[0] - n_faces))
+
+    links = get_face_links_from_nodes(all_coordinates, decimals=decimals)
+
+    # Only keep links for the rank's faces and convert to global indices.
+    ret = np.zeros(n_faces, dtype=object)
+    for idx in range(n_faces):
+        current = links[idx]
+        if current[0] != -1:
+            current = np.sort(all_face_indices[current])
+        ret[idx] = current
+    return ret
+
+
+def get_halo_faces(face_bounds, grid_size=None):
+    """
+    Select the rank's faces with bounding boxes intersecting the bounding box of a face on another rank. Sections are
+    not spatially compact so rank extents overlap heavily. Instead, each rank marks the cells of a coarse grid over the
+    global extent covered by its faces. Only the bounds of faces covering a cell occupied by another rank are sent to
+    that rank which returns the faces intersecting its own face bounds. This is a collective operation.
+
+    :param face_bounds: The rank's face bounding boxes as rows of ``(min x, min y, max x, max y)`` with shape
+     ``(n, 4)``.
+    :type face_bounds: :class:`numpy.ndarray`
+    :param int grid_size: Number of cells along each axis of the occupancy grid. If ``None``, use
+     :attr:`utools.constants.UgridToolsConstants.HALO_GRID_SIZE`.
+    :returns: A list with one element per rank containing the sorted indices of the rank's faces to send to that rank.
+     The element for the current rank is empty.
+    :rtype: list of :class:`numpy.ndarray`
+    """
+    from utools.io.spatial_index import SpatialIndex
+
+    grid_size = grid_size or UgridToolsConstants.HALO_GRID_SIZE
+    face_bounds = np.asarray(face_bounds, dtype=np.float64).reshape(-1, 4)
+    n_faces = face_bounds.shape[0]
+    empty = np.zeros(0, dtype=np.int64)
+
+    if n_faces == 0:
+        rank_bounds = None
+    else:
+        rank_bounds = np.hstack((face_bounds[:, 0:2].min(axis=0), face_bounds[:, 2:4].max(axis=0)))
+    all_rank_bounds = np.array([b for b in MPI_COMM.allgather(rank_bounds) if b is not None]).reshape(-1, 4)
+    if all_rank_bounds.shape[0] == 0:
+        return [empty] * MPI_SIZE
+
+    # Map the face bounds to inclusive ranges of cell indices on the grid covering the global extent.
+    origin = all_rank_bounds[:, 0:2].min(axis=0)
+    span = all_rank_bounds[:, 2:4].max(axis=0) - origin
+    cell_size = np.where(span > 0, span / grid_size, 1.)
+    cells = np.floor((face_bounds - np.tile(origin, 2)) / np.tile(cell_size, 2)).astype(np.int64)
+    cells = np.clip(cells, 0, grid_size - 1)
+
+    occupied = np.zeros((grid_size, grid_size), dtype=bool)
+    for x0, y0, x1, y1 in cells.tolist():
+        occupied[y0:y1 + 1, x0:x1 + 1] = True
+    all_occupied = MPI_COMM.allgather(occupied)
+
+    # Count the occupied cells in each face's cell range using a summed-area table.
+    candidates = [None] * MPI_SIZE
+    for rank, other in enumerate(all_occupied):
+        if rank == MPI_RANK:
+            candidates[rank] = empty
+            continue
+        summed = np.zeros((grid_size + 1, grid_size + 1), dtype=np.int64)
+        summed[1:, 1:] = other.cumsum(axis=0).cumsum(axis=1)
+        x0, y0, x1, y1 = cells[:, 0], cells[:, 1], cells[:, 2] + 1, cells[:, 3] + 1
+        counts = summed[y1, x1] - summed[y0, x1] - summed[y1, x0] + summed[y0, x0]
+        candidates[rank] = np.flatnonzero(counts > 0)
+    received = MPI_COMM.alltoall([face_bounds[c] for c in candidates])
+
+    # Keep the received candidates intersecting the bounds of the rank's faces.
+    if n_faces > 0:
+        si = SpatialIndex(stream=((ii, tuple(b), None) for ii, b in enumerate(face_bounds.tolist())))
+    selected = [None] * MPI_SIZE
+    for rank, bounds in enumerate(received):
+        if n_faces == 0 or bounds.shape[0] == 0:
+            selected[rank] = empty
+        else:
+            selected[rank] = np.unique(si.query_bounds(bounds)[0])
+    selected = MPI_COMM.alltoall(selected)
+
+    return [c[s] for c, s in zip(candidates, selected)]
+
+
+def get_face_links_from_nodes(coordinates, decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS):
+    """
+    Find neighboring faces by matching node coordinates. Faces are neighbors if they share at least one node after
+    coordinates are rounded. Faces touching along an edge without sharing a node are not neighbors.
+
+    >>> coordinates = [[np.array([[0., 0.], [1., 0.], [1., 1.]])], [np.array([[1., 0.], [2., 0.], [1., 1.]])]]
+    >>> get_face_links_from_nodes(coordinates)
+    array([array([1], dtype=int32), array([0], dtype=int32)], dtype=object)
+
+    :param coordinates: Sequence with each element a list of coordinate arrays (one for each face part) with
+     dimension ``(n, 2)``. The face index is the sequence index.
+    :type coordinates: sequence
+    :param int decimals: Number of decimals used when rounding coordinates for comparison.
+    :returns: A numpy object array with slots containing numpy integer vectors with values equal to neighbor indices
+     sorted in ascending order. Faces without neighbors have a single ``-1`` value.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    n_faces = len(coordinates)
+    parts = [part for face in coordinates for part in face]
+    counts = [sum([part.shape[0] for part in face]) for face in coordinates]
+    face_index = np.repeat(np.arange(n_faces, dtype=np.int64), counts)
+
+    if len(parts) > 0:
+        nodes = np.round(np.concatenate(parts), decimals=decimals)
+    else:
+        nodes = np.zeros((0, 2))
+    # Sort the nodes so identical coordinates are adjacent.
+    order = np.lexsort((nodes[:, 1], nodes[:, 0]))
+    nodes = nodes[order]
+    face_index = face_index[order]
+    node_key = np.zeros(nodes.shape[0], dtype=np.int64)
+    if nodes.shape[0] > 0:
+        node_key[1:] = np.cumsum(np.any(nodes[1:] != nodes[:-1], axis=1))
+
+    # Pair faces sharing a node key. Offset d pairs each node with the node d positions later in the sorted order.
+    # Offsets stop when no node key is repeated that many times.
+    first = deque()
+    second = deque()
+    for d in range(1, nodes.shape[0]):
+        select = node_key[d:] == node_key[:-d]
+        if not select.any():
+            break
+        first.append(face_index[:-d][select])
+        second.append(face_index[d:][select])
+    if len(first) > 0:
+        first = np.concatenate(first)
+        second = np.concatenate(second)
+    else:
+        first = second = np.zeros(0, dtype=np.int64)
+
+    # Remove self-pairs from parts of the same face, add reverse pairs, and remove duplicate pairs.
+    select = first != second
+    first, second = first[select], second[select]
+    pairs = np.unique(np.concatenate((first * n_faces + second, second * n_faces + first)))
+    first = pairs // n_faces
+    second = (pairs % n_faces).astype(np.int32)
+
+    ret = np.zeros(n_faces, dtype=object)
+    bounds = np.searchsorted(first, np.arange(n_faces + 1))
+    for idx in range(n_faces):
+        links = second[bounds[idx]:bounds[idx + 1]]
+        if links.shape[0] == 0:
+            links = np.array([-1], dtype=np.int32)
+        ret[idx] = links
+    return ret
+
+
 def flexible_mesh_to_fiona(out_path, face_nodes, node_x, node_y, crs=None, driver='ESRI Shapefile',
                            indices_to_load=None, face_uid=None):
     if face_uid is None:
@@ -391,15 +841,229 @@ def iter_records(face_nodes, node_x, node_y, indices_to_load=None, datasets=None
 
 def create_rtree_file(gm, path):
     """
+    Bulk load a serialized spatial index from geometry bounds computed in parallel. The index is written by the root
+    rank to a temporary location and moved into place. A ``<path>.json`` file records the source state used by
+    :func:`~utools.io.helpers.get_rtree_is_current`. If the index cannot be written or is not visible on a rank, the
+    rank builds an in-memory index from the same bounds. This is a collective operation.
+
     :param gm: Target geometries to index.
     :type gm: :class:`pyugrid.flexible_mesh.helpers.GeometryManager`
     :param path: Output path for the serialized spatial index. See http://toblerity.org/rtree/tutorial.html#serializing-your-index-to-a-file.
+    :returns: The spatial index.
+    :rtype: :class:`utools.io.spatial_index.SpatialIndex`
     """
+    from rtree.core import RTreeError
     from spatial_index import SpatialIndex
 
-    si = SpatialIndex(path=path)
-    for uid, record in gm.iter_records(return_uid=True):
-        si.add(uid, record['geom'])
+    uids, bounds = get_geometry_bounds(gm)
+
+    error = None
+    if MPI_RANK == 0:
+        # Empty geometries have no bounds to index.
+        select = np.logical_not(np.isnan(bounds[:, 0]))
+        uids, bounds = uids[select], bounds[select]
+        stream = ((uid, tuple(b), None) for uid, b in itertools.izip(uids.tolist(), bounds.tolist()))
+        path_tmp = '{}.tmp-{}'.format(path, os.getpid())
+        try:
+            directory = os.path.dirname(path)
+            if directory != '' and not os.path.isdir(directory):
+                os.makedirs(directory)
+            si = SpatialIndex(path=path_tmp, stream=stream if uids.shape[0] > 0 else None)
+            si.close()
+            for ext in ('.idx', '.dat'):
+                os.rename(path_tmp + ext, path + ext)
+            with open(path + '.json', 'w') as f:
+                json.dump(get_rtree_source_state(gm), f)
+        except (IOError, OSError, RTreeError) as e:
+            error = '{}: {}'.format(e.__class__.__name__, e)
+            for ext in ('.idx', '.dat'):
+                if os.path.exists(path_tmp + ext):
+                    os.remove(path_tmp + ext)
+    error = MPI_COMM.bcast(error)
+
+    visible = error is None and os.path.exists(path + '.idx')
+    if not all(MPI_COMM.allgather(visible)):
+        # Only send the bounds if a rank needs to build an in-memory index.
+        uids, bounds = MPI_COMM.bcast((uids, bounds))
+    if visible:
+        ret = SpatialIndex(path=path)
+    else:
+        if MPI_RANK == 0:
+            log.warn('Spatial index not written to {} ({}). Using an in-memory index.'.format(path, error))
+        stream = ((uid, tuple(b), None) for uid, b in itertools.izip(uids.tolist(), bounds.tolist()))
+        ret = SpatialIndex(stream=stream if uids.shape[0] > 0 else None)
+    return ret
+
+
+def get_geometry_bounds(gm):
+    """
+    Compute the bounds of all geometries in parallel. Each rank computes bounds for a section of the geometries. File
+    geometries are read as columnar blocks without creating geometry objects. This is a collective operation.
+
+    :param gm: The geometry manager.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :returns: On the root rank, a tuple ``(uids, bounds)`` with bounds shape ``(n, 4)``. ``(None, None)`` on other
+     ranks.
+    :rtype: tuple
+    """
+    from utools.io.geom_cabinet import GeomCabinet, get_columnar_bounds
+
+    section = create_sections(len(gm))[MPI_RANK]
+    if gm.records is None:
+        offset = 0 if gm.slc is None else gm.slc[0]
+        uids = []
+        bounds = []
+        if section[1] > section[0]:
+            slc = [section[0] + offset, section[1] + offset]
+            for block in GeomCabinet().iter_blocks(gm.name_uid, path=gm.path, slc=slc, dest_crs=gm.dest_crs,
+                                                   driver_kwargs=gm.driver_kwargs):
+                uids.append(block['uid'])
+                bounds.append(get_columnar_bounds(block))
+        uids = np.hstack(uids + [np.zeros(0, dtype=np.int64)])
+        bounds = np.vstack(bounds + [np.zeros((0, 4))])
+    else:
+        records = list(gm.iter_records(return_uid=True, slc=section))
+        uids = np.array([r[0] for r in records], dtype=np.int64)
+        bounds = np.array([r[1]['geom'].bounds for r in records], dtype=np.float64).reshape(-1, 4)
+
+    uids = MPI_COMM.gather(uids)
+    bounds = MPI_COMM.gather(bounds)
+    if MPI_RANK == 0:
+        return hgather(uids), vgather(bounds)
+    else:
+        return None, None
+
+
+def get_esmf_format_sizes(gm, block_size=None):
+    """
+    Compute the ESMF format dimension sizes of the converted geometries before converting them. File geometries are
+    read as columnar blocks without creating geometry objects. Only geometries exceeding the node threshold are
+    decoded and split to count their pieces exactly. These geometries are split again when converted, so the scan
+    doubles the splitting cost. Nodes are counted as if they are not de-duplicated. This is a collective operation.
+
+    :param gm: The geometry manager.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :param int block_size: Number of features in a columnar block. If ``None``, use
+     :attr:`utools.constants.UgridToolsConstants.FEATURE_BLOCK_SIZE`.
+    :returns: The node, element, and connection counts (``nodeCount``, ``elementCount``, ``connectionCount``).
+    :rtype: list of int
+    """
+    from utools.io.geom_cabinet import GeomCabinet, get_columnar_sizes
+
+    block_size = block_size or UgridToolsConstants.FEATURE_BLOCK_SIZE
+    section = create_sections(len(gm))[MPI_RANK]
+    sizes = np.zeros(3, dtype=np.int64)
+
+    if gm.records is None:
+        offset = 0 if gm.slc is None else gm.slc[0]
+        to_split = []
+        if section[1] > section[0]:
+            slc = [section[0] + offset, section[1] + offset]
+            for block in GeomCabinet().iter_blocks(gm.name_uid, path=gm.path, slc=slc, dest_crs=gm.dest_crs,
+                                                   driver_kwargs=gm.driver_kwargs, block_size=block_size):
+                node_counts, part_counts = get_columnar_sizes(block)
+                if gm.node_threshold is not None:
+                    # Node counts for the threshold include the repeated closing coordinate of each part.
+                    select = node_counts + part_counts > gm.node_threshold
+                    to_split += block['uid'][select].tolist()
+                    node_counts, part_counts = node_counts[~select], part_counts[~select]
+                connection_counts = get_connection_counts(node_counts, part_counts)
+                sizes += [node_counts.sum(), node_counts.shape[0], connection_counts.sum()]
+        # Split geometries are counted from the split geometry objects.
+        if len(to_split) > 0:
+            records = gm.iter_records(select_uid=to_split, slc=[0, len(to_split)])
+        else:
+            records = []
+    else:
+        records = gm.iter_records(slc=section)
+
+    for record in records:
+        coordinates_list, n_coords = get_coordinates_list_and_update_n_coords(record, 0)
+        sizes += [n_coords, 1, get_connection_counts(n_coords, len(coordinates_list))]
+
+    return MPI_COMM.allreduce(sizes).tolist()
+
+
+def get_connection_counts(node_counts, part_counts):
+    """
+    :param node_counts: Element node counts without repeated closing coordinates.
+    :type node_counts: int or :class:`numpy.ndarray`
+    :param part_counts: Element part counts.
+    :type part_counts: int or :class:`numpy.ndarray`
+    :returns: The ESMF format connection counts. Each part after the first is preceded by a polygon break value.
+     Elements without parts (empty geometries) have no connections.
+    :rtype: int or :class:`numpy.ndarray`
+    """
+
+    return np.maximum(np.asarray(node_counts) + part_counts - 1, 0)
+
+
+def get_esmf_format_nbytes(sizes, face_uid=True):
+    """
+    :param sequence sizes: The node, element, and connection counts. See
+     :func:`~utools.io.helpers.get_esmf_format_sizes`.
+    :param bool face_uid: If ``True``, include the element unique identifier variable.
+    :returns: The size in bytes of the ESMF format variable values.
+    :rtype: int
+    """
+
+    n_nodes, n_elements, n_connections = sizes
+    # Element values are the connection count, center coordinates, area, and optional unique identifier.
+    element_nbytes = 4 + 16 + 8 + (4 if face_uid else 0)
+    return n_nodes * 16 + n_elements * element_nbytes + n_connections * 4
+
+
+def get_rtree_path(gm):
+    """
+    :param gm: The geometry manager.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :returns: The default path for the geometry manager's serialized spatial index. The index is stored next to the
+     source geometry container if its directory is writable. Otherwise, it is stored in
+     :attr:`utools.constants.UgridToolsConstants.RTREE_DIRECTORY` with a name unique to the source path.
+    :rtype: str
+    """
+
+    source = os.path.abspath(os.path.normpath(gm.path))
+    stem = os.path.splitext(source)[0]
+    if os.access(os.path.dirname(source), os.W_OK):
+        ret = [stem]
+    else:
+        directory = UgridToolsConstants.RTREE_DIRECTORY or os.path.join(tempfile.gettempdir(), 'utools_rtree')
+        ret = [os.path.join(directory, os.path.basename(stem)), hashlib.sha1(source).hexdigest()[0:12]]
+    feature_class = (gm.driver_kwargs or {}).get('feature_class')
+    if feature_class is not None:
+        ret.append(feature_class)
+    ret += [gm.name_uid, 'rtree']
+    return '.'.join(ret)
+
+
+def get_rtree_is_current(gm, path):
+    """
+    :param gm: The geometry manager.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :param str path: Path to the serialized spatial index.
+    :returns: ``True`` if the spatial index exists and was created from the current state of the geometry manager's
+     source.
+    :rtype: bool
+    """
+
+    if not all([os.path.exists(path + ext) for ext in ('.idx', '.dat', '.json')]):
+        return False
+    with open(path + '.json') as f:
+        return json.load(f) == get_rtree_source_state(gm)
+
+
+def get_rtree_source_state(gm):
+    from utools.io.geom_cabinet import get_path_stamp
+
+    if gm.dest_crs is None:
+        dest_crs = None
+    else:
+        dest_crs = gm.dest_crs.ExportToWkt()
+    # Round-trip through JSON so the state compares equal to a loaded state.
+    ret = {'stamp': get_path_stamp(gm.path), 'name_uid': gm.name_uid, 'driver_kwargs': gm.driver_kwargs,
+           'slc': gm.slc, 'dest_crs': dest_crs}
+    return json.loads(json.dumps(ret))
 
 
 def get_split_array(arr, break_value):
@@ -433,7 +1097,7 @@ def get_oriented_and_valid_geometry(geom):
 
 
 def convert_collection_to_esmf_format(fmobj, filename, polygon_break_value=None, start_index=0, face_uid_name=None,
-                                      dataset_kwargs=None):
+                                      dataset_kwargs=None, parallel=False, profile=None, float32_tolerance=None):
     """
     Convert to an ESMF format NetCDF files. Only supports ragged arrays.
 
@@ -441,9 +1105,23 @@ def convert_collection_to_esmf_format(fmobj, filename, polygon_break_value=None,
     :type fm: :class:`pyugrid.flexible_mesh.core.FlexibleMesh`
     :param ds: An open netCDF4 dataset object.
     :type ds: :class:`netCDF4.Dataset`
+    :param bool parallel: If ``True``, all ranks open the file with parallel I/O (MPI-IO) and write their values
+     concurrently. Requires ``netCDF4`` built with parallel support. If ``False``, ranks write one at a time.
+    :param str profile: Name of the output profile setting the file format, compression, and chunking. See
+     :func:`get_esmf_format_profile`. Compressed profiles do not support parallel writes.
+    :param float float32_tolerance: If not ``None``, write node and center coordinates and element areas as
+     ``float32``. The maximum coordinate error from the reduced precision must be less than or equal to this tolerance
+     in coordinate units. See :func:`get_float32_errors`.
+    :raises: ValueError
     """
 
-    dataset_kwargs = dataset_kwargs or {}
+    dataset_kwargs = dict(dataset_kwargs or {})
+    if parallel and MPI_ENABLED:
+        if not (nc.__has_parallel4_support__ or nc.__has_pnetcdf_support__):
+            raise ValueError('Parallel writes require "netCDF4" built with parallel I/O support.')
+    else:
+        # Without MPI, there is nothing to write concurrently.
+        parallel = False
 
     # tdk: doc
     # face_areas = fmobj.face_areas
@@ -461,20 +1139,32 @@ def convert_collection_to_esmf_format(fmobj, filename, polygon_break_value=None,
         face_uid_value = fmobj[face_uid_name]
     else:
         face_uid_value = None
-    faces = fmobj['face']
     nodes = fmobj['nodes']
 
     # float_dtype = np.float32
     # int_dtype = np.int32
 
-    # Transform ragged array to one-dimensional array.
-    num_element_conn_data = [e.shape[0] for e in faces.flat]
-    length_connection_count = sum(num_element_conn_data)
-    element_conn_data = np.zeros(length_connection_count, dtype=faces[0].dtype)
-    start = 0
-    for ii in faces.flat:
-        element_conn_data[start: start + ii.shape[0]] = ii
-        start += ii.shape[0]
+    if fmobj.get('element_conn') is not None:
+        # The connectivity is already in the flat ESMF layout.
+        element_conn_data = fmobj['element_conn']
+        num_element_conn_data = fmobj['num_element_conn']
+    else:
+        # Transform ragged array to one-dimensional array.
+        faces = fmobj['face']
+        num_element_conn_data = np.array([e.shape[0] for e in faces.flat], dtype=np.int32)
+        element_conn_data = np.zeros(num_element_conn_data.sum(), dtype=faces[0].dtype)
+        start = 0
+        for ii in faces.flat:
+            element_conn_data[start: start + ii.shape[0]] = ii
+            start += ii.shape[0]
+    length_connection_count = element_conn_data.shape[0]
+
+    if float32_tolerance is not None:
+        errors = check_float32_errors(get_float32_errors(nodes, face_coordinates, face_areas), float32_tolerance)
+        if MPI_RANK == 0:
+            log.info(get_float32_error_report(errors))
+        nodes, face_coordinates, face_areas = [np.asarray(a, dtype=np.float32)
+                                               for a in (nodes, face_coordinates, face_areas)]
 
     ####################################################################################################################
 
@@ -511,147 +1201,581 @@ def convert_collection_to_esmf_format(fmobj, filename, polygon_break_value=None,
     #
     # coll.write(ds)
 
-    node_counts = MPI_COMM.gather(nodes.shape[0])
-    element_counts = MPI_COMM.gather(faces.shape[0])
-    length_connection_counts = MPI_COMM.gather(length_connection_count)
+    starts, totals = get_offsets([nodes.shape[0], num_element_conn_data.shape[0], length_connection_count])
 
-    if MPI_RANK == 0:
+    output_profile = get_esmf_format_profile(profile, totals.tolist(), face_uid_name=face_uid_name)
+    if output_profile.format is not None:
+        dataset_kwargs.setdefault('format', output_profile.format)
+    if parallel and any([v.get('zlib', False) for v in output_profile.variables.values()]):
+        raise ValueError('Compressed output profiles do not support parallel writes.')
+
+    if parallel:
+        from mpi4py import MPI
+        ds = nc.Dataset(filename, 'w', parallel=True, comm=MPI_COMM, info=MPI.Info(), **dataset_kwargs)
+    elif MPI_RANK == 0:
         ds = nc.Dataset(filename, 'w', **dataset_kwargs)
+    else:
+        ds = None
+
+    if ds is not None:
         try:
-            # Dimensions -----------------------------------------------------------------------------------------------
+            if not output_profile.fill:
+                ds.set_fill_off()
+            if face_uid_value is None:
+                face_uid_dtype = None
+            elif face_uid_value.dtype.kind in 'SU':
+                face_uid_dtype = str
+            else:
+                face_uid_dtype = face_uid_value.dtype
+            create_esmf_format_variables(ds, totals.tolist(), nodes.dtype, element_conn_data.dtype,
+                                         face_coordinates.dtype, polygon_break_value=polygon_break_value,
+                                         start_index=start_index, face_uid_name=face_uid_name,
+                                         face_uid_dtype=face_uid_dtype, variable_kwargs=output_profile.variables)
+
+            if parallel:
+                fill_esmf_format_variables(ds, starts, nodes, element_conn_data, num_element_conn_data,
+                                           face_coordinates, face_areas, face_uid_name, face_uid_value)
+        finally:
+            ds.close()
 
-            node_count_size = sum(node_counts)
-            element_count_size = sum(element_counts)
-            connection_count_size = sum(length_connection_counts)
+    # Fill variable values -----------------------------------------------------------------------------------------
 
-            node_count = ds.createDimension('nodeCount', node_count_size)
-            element_count = ds.createDimension('elementCount', element_count_size)
-            coord_dim = ds.createDimension('coordDim', 2)
-            # element_conn_vltype = ds.createVLType(fm.faces[0].dtype, 'elementConnVLType')
-            connection_count = ds.createDimension('connectionCount', connection_count_size)
+    if not parallel:
+        for rank_to_write in range(MPI_SIZE):
+            if MPI_RANK == rank_to_write:
+                ds = nc.Dataset(filename, mode='a')
+                try:
+                    if not output_profile.fill:
+                        ds.set_fill_off()
+                    fill_esmf_format_variables(ds, starts, nodes, element_conn_data, num_element_conn_data,
+                                               face_coordinates, face_areas, face_uid_name, face_uid_value)
+                finally:
+                    ds.close()
+            MPI_COMM.Barrier()
+
+
+def convert_to_esmf_format_stream(gm, filename, polygon_break_value=None, start_index=0, face_uid_name=None,
+                                  dataset_kwargs=None, block_size=None, sizes=None, profile=None,
+                                  float32_tolerance=None):
+    """
+    Convert geometries to an ESMF format NetCDF file one block of records at a time. Only a block of records and its
+    mesh variables are held in memory. Nodes are not de-duplicated and connectivity is not computed. The values are
+    identical to converting the geometries with :func:`convert_collection_to_esmf_format`.
+
+    :param gm: The geometry manager containing geometries to convert.
+    :type gm: :class:`utools.io.geom_manager.GeometryManager`
+    :param str filename: Path to the output NetCDF file.
+    :param int block_size: Number of records converted and written at a time. If ``None``, use
+     :attr:`utools.constants.UgridToolsConstants.FEATURE_BLOCK_SIZE`.
+    :param sequence sizes: The node, element, and connection counts of the converted geometries used to size the
+     output dimensions. If ``None``, the dimensions are unlimited which requires the ``NETCDF4`` file format.
+    :param str profile: Name of the output profile setting the file format, compression, and chunking. See
+     :func:`get_esmf_format_profile`.
+    :param float float32_tolerance: If not ``None``, write node and center coordinates and element areas as
+     ``float32``. Each block is checked before it is written and the conversion stops if the maximum coordinate error
+     exceeds this tolerance. See :func:`convert_collection_to_esmf_format`.
+    :raises: ValueError
+    """
 
-            # Variables ------------------------------------------------------------------------------------------------
+    if MPI_SIZE > 1:
+        raise ValueError('Streaming conversion runs on a single process.')
 
-            node_coords = ds.createVariable('nodeCoords', nodes.dtype, (node_count.name, coord_dim.name))
-            node_coords.units = 'degrees'
+    polygon_break_value = polygon_break_value or UgridToolsConstants.POLYGON_BREAK_VALUE
+    dataset_kwargs = dict(dataset_kwargs or {})
+    block_size = block_size or UgridToolsConstants.FEATURE_BLOCK_SIZE
+    if sizes is None:
+        sizes = [None] * 3
+    # Appending to unlimited dimensions with the library's small default chunks is slow. The profile chunks them.
+    output_profile = get_esmf_format_profile(profile, sizes, face_uid_name=face_uid_name)
+    if output_profile.format is not None:
+        dataset_kwargs.setdefault('format', output_profile.format)
+    if sizes[0] is None and dataset_kwargs.get('format', 'NETCDF4') != 'NETCDF4':
+        raise ValueError('Unlimited dimensions require the "NETCDF4" file format.')
+
+    if float32_tolerance is None:
+        float_dtype = np.float64
+        errors = None
+    else:
+        float_dtype = np.float32
+        errors = get_float32_errors(*[np.zeros(0)] * 3)
 
-            element_conn = ds.createVariable('elementConn', element_conn_data.dtype, (connection_count.name,))
-            element_conn.long_name = 'Node indices that define the element connectivity.'
-            if polygon_break_value is not None:
-                element_conn.polygon_break_value = polygon_break_value
-            element_conn.start_index = start_index
+    records = gm.iter_records(return_uid=True)
+    block = list(itertools.islice(records, block_size))
+    if face_uid_name is None:
+        face_uid_dtype = None
+    else:
+        # The variable is created before later blocks are read so the first block sets the identifier type.
+        face_uid_dtype = get_uid_dtype([uid for uid, _ in block])
 
-            num_element_conn = ds.createVariable('numElementConn', np.int32, (element_count.name,))
-            num_element_conn.long_name = 'Number of nodes per element.'
+    ds = nc.Dataset(filename, 'w', **dataset_kwargs)
+    try:
+        if not output_profile.fill:
+            ds.set_fill_off()
+        create_esmf_format_variables(ds, sizes, float_dtype, np.int32, float_dtype,
+                                     polygon_break_value=polygon_break_value, start_index=start_index,
+                                     face_uid_name=face_uid_name, face_uid_dtype=face_uid_dtype,
+                                     variable_kwargs=output_profile.variables)
+
+        starts = np.zeros(3, dtype=np.int64)
+        while len(block) > 0:
+            face_ids, face_coordinates, face_areas, element_conn, num_element_conn, nodes = \
+                get_esmf_format_block(block, polygon_break_value, idx_start=starts[0])
+            if face_uid_name is None:
+                face_ids = None
+            elif face_uid_dtype not in (str, get_uid_dtype(face_ids, dtype=face_uid_dtype)):
+                msg = 'Element identifiers starting at element {} do not fit the {} identifier variable.'
+                raise ValueError(msg.format(starts[1], np.dtype(face_uid_dtype).name))
+            if errors is not None:
+                errors = check_float32_errors(get_float32_errors(nodes, face_coordinates, face_areas, errors=errors),
+                                              float32_tolerance)
+            fill_esmf_format_variables(ds, starts.tolist(), nodes, element_conn, num_element_conn, face_coordinates,
+                                       face_areas, face_uid_name, face_ids)
+            starts += [nodes.shape[0], num_element_conn.shape[0], element_conn.shape[0]]
+            log.debug(('streamed element count', starts[1]))
+            block = list(itertools.islice(records, block_size))
+    finally:
+        ds.close()
+
+    if errors is not None:
+        log.info(get_float32_error_report(errors))
+    if sizes[0] is not None and starts.tolist() != list(sizes):
+        raise ValueError('Written counts {} do not match the dimension sizes {}.'.format(starts.tolist(), list(sizes)))
+
+
+def get_esmf_format_profile(profile, sizes, face_uid_name=None):
+    """
+    Get the dataset and variable creation arguments for a named ESMF format output profile.
+
+    :param str profile: Name of the profile in :attr:`utools.constants.UgridToolsConstants.ESMF_FORMAT_PROFILES`. If
+     ``None``, variables are created with the library defaults.
+    :param sequence sizes: The node, element, and connection counts. A ``None`` count is an unlimited dimension. Its
+     variables are always chunked and use :attr:`utools.constants.UgridToolsConstants.STREAM_CHUNK_SIZE` if the
+     profile has no chunk length for the dimension.
+    :param str face_uid_name: Name of the element unique identifier variable, if any.
+    :returns: A dictionary with the file ``format`` (``None`` for the library default), whether to ``fill`` variables,
+     and the ``createVariable`` keyword arguments keyed by variable name in ``variables``.
+    :rtype: :class:`utools.addict.Dict`
+    :raises: ValueError
+    """
 
-            center_coords = ds.createVariable('centerCoords', face_coordinates.dtype, (element_count.name,
-                                                                                       coord_dim.name))
-            center_coords.units = 'degrees'
+    if profile is None:
+        settings = {}
+    else:
+        try:
+            settings = UgridToolsConstants.ESMF_FORMAT_PROFILES[profile]
+        except KeyError:
+            raise ValueError('Output profile "{}" not found. Choose from: {}'.format(
+                profile, sorted(UgridToolsConstants.ESMF_FORMAT_PROFILES.keys())))
+
+    dimension_sizes = dict(zip(['nodeCount', 'elementCount', 'connectionCount'], sizes))
+    variable_dimensions = OrderedDict([('nodeCoords', ('nodeCount', 'coordDim')),
+                                       ('elementConn', ('connectionCount',)),
+                                       ('numElementConn', ('elementCount',)),
+                                       ('centerCoords', ('elementCount', 'coordDim')),
+                                       ('elementArea', ('elementCount',))])
+    if face_uid_name is not None:
+        variable_dimensions[face_uid_name] = ('elementCount',)
+
+    chunk_lengths = settings.get('chunk_lengths', {})
+    variables = {}
+    for name, dimensions in variable_dimensions.iteritems():
+        size = dimension_sizes[dimensions[0]]
+        kwargs = {}
+        if settings.get('zlib', False):
+            kwargs.update(zlib=True, shuffle=settings.get('shuffle', True), complevel=settings.get('complevel', 4))
+        chunk_length = chunk_lengths.get(dimensions[0])
+        if size is None:
+            # Unlimited dimensions cannot be stored contiguously.
+            chunk_length = chunk_length or UgridToolsConstants.STREAM_CHUNK_SIZE
+        elif chunk_length is not None:
+            # Chunks may not be longer than a fixed dimension.
+            chunk_length = max(min(chunk_length, size), 1)
+        elif settings.get('contiguous', False):
+            kwargs['contiguous'] = True
+        if chunk_length is not None:
+            kwargs['chunksizes'] = (chunk_length,) + (2,) * (len(dimensions) - 1)
+        variables[name] = kwargs
 
-            if face_uid_value is not None:
-                uid = ds.createVariable(face_uid_name, face_uid_value.dtype, dimensions=(element_count.name,))
-                uid.long_name = 'Element unique identifier.'
+    ret = Dict()
+    ret.format = settings.get('format')
+    ret.fill = settings.get('fill', True)
+    ret.variables = variables
+    return ret
 
-            element_area = ds.createVariable('elementArea', nodes.dtype, (element_count.name,))
-            element_area.units = 'degrees'
-            element_area.long_name = 'Element area in native units.'
 
-            # Global Attributes ----------------------------------------------------------------------------------------
+def get_float32_errors(nodes, face_coordinates, face_areas, errors=None):
+    """
+    Get the largest errors from storing the current rank's mesh values as ``float32``.
+
+    :param nodes: Node coordinates with shape ``(n, 2)``.
+    :type nodes: :class:`numpy.ndarray`
+    :param face_coordinates: Element center coordinates with shape ``(m, 2)``.
+    :type face_coordinates: :class:`numpy.ndarray`
+    :param face_areas: Element areas with shape ``(m,)``.
+    :type face_areas: :class:`numpy.ndarray`
+    :param dict errors: Errors from a previous call to update with the maximum errors.
+    :returns: The maximum absolute node and center coordinate errors and the maximum relative element area error keyed
+     by ESMF format variable name.
+    :rtype: :class:`collections.OrderedDict`
+    """
 
-            ds.gridType = 'unstructured'
-            ds.version = '0.9'
-            setattr(ds, coord_dim.name, "longitude latitude")
+    def get_max_error(arr, relative=False):
+        arr = np.asarray(arr, dtype=np.float64)
+        diff = np.abs(arr.astype(np.float32).astype(np.float64) - arr)
+        if relative:
+            select = arr != 0
+            diff = diff[select] / np.abs(arr[select])
+        if diff.size == 0:
+            return 0.
+        return float(diff.max())
+
+    ret = OrderedDict([('nodeCoords', get_max_error(nodes)),
+                       ('centerCoords', get_max_error(face_coordinates)),
+                       ('elementArea', get_max_error(face_areas, relative=True))])
+    if errors is not None:
+        for key, value in errors.items():
+            ret[key] = max(ret[key], value)
+    return ret
 
-            # element_mask = ds.createVariable('elementMask', np.int32, (element_count.name,))
 
-        finally:
-            ds.close()
+def check_float32_errors(errors, tolerance):
+    """
+    Check the ``float32`` coordinate errors of all ranks against a tolerance. This is a collective operation.
 
-    # Fill variable values -----------------------------------------------------------------------------------------
+    :param dict errors: The current rank's errors from :func:`get_float32_errors`.
+    :param float tolerance: The maximum allowed absolute coordinate error in coordinate units. Element area errors are
+     reported but not checked.
+    :returns: The maximum errors across all ranks.
+    :rtype: :class:`collections.OrderedDict`
+    :raises: ValueError
+    """
 
-    node_coords_start = 0
-    node_coords_stop = None
-    element_conn_start = 0
-    element_conn_stop = None
-
-    for rank_to_write in range(MPI_SIZE):
-        log.debug(('node_coords_start', node_coords_start))
-        if MPI_RANK == rank_to_write:
-            ds = nc.Dataset(filename, mode='a')
-            try:
-                node_coords = ds.variables['nodeCoords']
-                element_conn = ds.variables['elementConn']
-                num_element_conn = ds.variables['numElementConn']
-                center_coords = ds.variables['centerCoords']
-                element_area = ds.variables['elementArea']
-                if face_uid_value is not None:
-                    uid = ds.variables[face_uid_name]
-
-                node_coords_stop = node_coords_start + nodes.shape[0]
-                element_conn_stop = element_conn_start + element_conn_data.shape[0]
-                node_coords[node_coords_start:node_coords_stop] = nodes
-                log.debug(('element_conn indices', element_conn_start, element_conn_stop))
-                element_conn[element_conn_start:element_conn_stop] = element_conn_data
-
-                start, stop = fmobj['section']
-                num_element_conn[start:stop] = num_element_conn_data
-                center_coords[start:stop] = face_coordinates
-                element_area[start:stop] = face_areas
-                if face_uid_value is not None:
-                    uid[start:stop] = face_uid_value
-            finally:
-                ds.close()
-        node_coords_start = MPI_COMM.bcast(node_coords_stop, root=rank_to_write)
-        element_conn_start = MPI_COMM.bcast(element_conn_stop, root=rank_to_write)
-        MPI_COMM.Barrier()
-
-
-def get_split_polygon_by_node_threshold(geom, node_threshold):
-    # tdk: doc
-    node_schema = get_node_schema(geom)
-
-    # Collect geometries with node counts higher than the threshold.
-    to_split = []
-    for k, v in node_schema.items():
-        if v['node_count'] > node_threshold:
-            to_split.append(k)
-
-    # Identify split parameters for an element exceeding the node threshold.
-    for ii in to_split:
-        n = node_schema[ii]
-        # Approximate number of splits need for each split element to be less than the node threshold.
-        n.n_splits = int(np.ceil(n['node_count'] / node_threshold))
-        # This is the shape of the polygon grid to use for splitting the target element.
-        n.split_shape = np.sqrt(n.n_splits)
-        # There should be at least two splits.
-        if n.split_shape == 1:
-            n.split_shape += 1
-        n.split_shape = tuple([int(np.ceil(ns)) for ns in [n.split_shape] * 2])
-
-        # Get polygons to use for splitting.
-        n.splitters = get_split_polygons(n['geom'], n.split_shape)
-
-        # Create the individual splits:
-        n.splits = []
-        for s in n.splitters:
-            if n.geom.intersects(s):
-                the_intersection = n.geom.intersection(s)
-                for ti in get_iter(the_intersection, dtype=Polygon):
-                    n.splits.append(ti)
-
-                    # write_fiona(n.splits, '01-splits')
-
-    # Collect the polygons to return as a multipolygon.
-    the_multi = []
-    for v in node_schema.values():
-        if 'splits' in v:
-            the_multi += v.splits
+    gathered = MPI_COMM.allgather(errors)
+    ret = OrderedDict([(key, max([g[key] for g in gathered])) for key in errors])
+    exceeded = [key for key in ('nodeCoords', 'centerCoords') if not ret[key] <= tolerance]
+    if len(exceeded) > 0:
+        msg = 'The float32 coordinate errors exceed the tolerance {}. {}'
+        raise ValueError(msg.format(tolerance, get_float32_error_report(ret)))
+    return ret
+
+
+def get_float32_error_report(errors):
+    """
+    :param dict errors: Errors from :func:`get_float32_errors`.
+    :returns: A one-line report of the maximum ``float32`` errors.
+    :rtype: str
+    """
+
+    return 'Maximum float32 errors: nodeCoords={:g}, centerCoords={:g}, elementArea (relative)={:g}'.format(
+        errors['nodeCoords'], errors['centerCoords'], errors['elementArea'])
+
+
+def get_uid_dtype(uids, dtype=None, collective=False):
+    """
+    Get the output data type for element unique identifiers. Integers are stored as ``int32`` if all values fit and as
+    ``int64`` otherwise. Strings are stored as variable-length strings.
+
+    :param sequence uids: The unique identifiers.
+    :param dtype: A data type to promote with the identifiers' data type.
+    :param bool collective: If ``True``, get a data type fitting the identifiers of all ranks. This is a collective
+     operation.
+    :returns: A :class:`numpy.dtype` or ``str`` for string identifiers.
+    """
+
+    uids = np.asarray(uids)
+    if uids.dtype.kind in 'SUO':
+        ret = str
+    elif uids.size == 0:
+        ret = None
+    elif uids.dtype.kind in 'iu':
+        info = np.iinfo(np.int32)
+        if uids.min() < info.min or uids.max() > info.max:
+            ret = np.dtype(np.int64)
         else:
-            the_multi.append(v.geom)
+            ret = np.dtype(np.int32)
+    else:
+        ret = uids.dtype
+
+    dtypes = [ret, dtype]
+    if collective:
+        dtypes = MPI_COMM.allgather(ret) + [dtype]
+    dtypes = [d for d in dtypes if d is not None]
+    if str in dtypes:
+        ret = str
+    elif len(dtypes) == 0:
+        ret = np.dtype(np.int32)
+    else:
+        ret = np.result_type(*dtypes)
+    return ret
+
+
+def get_esmf_format_block(records, polygon_break_value, idx_start=0):
+    """
+    :param sequence records: Sequence of ``(uid, record)`` tuples.
+    :param int polygon_break_value: Negative integer value to use for breaks between multi-geometries.
+    :param int idx_start: Index of the first node of the block.
+    :returns: A tuple of element identifiers, element center coordinates, element areas, and the
+     ``(element_conn, num_element_conn, coordinates)`` from :func:`~utools.io.helpers.get_coordinate_dict_variables`.
+    :rtype: tuple
+    """
+
+    face_ids = np.array([uid for uid, _ in records])
+    face_coordinates = np.zeros((len(records), 2))
+    face_areas = np.zeros(len(records))
+    cdict = OrderedDict()
+    n_coords = 0
+    for ctr, (uid, record) in enumerate(records):
+        coordinates_list, n_coords = get_coordinates_list_and_update_n_coords(record, n_coords)
+        cdict[uid] = coordinates_list
+        face_coordinates[ctr] = record['geom'].representative_point().coords[0]
+        face_areas[ctr] = record['geom'].area
+
+    element_conn, num_element_conn, coordinates, _ = get_coordinate_dict_variables(
+        cdict, n_coords, polygon_break_value=polygon_break_value, idx_start=idx_start)
+    return face_ids, face_coordinates, face_areas, element_conn, num_element_conn, coordinates
+
+
+def create_esmf_format_variables(ds, sizes, node_dtype, element_conn_dtype, center_dtype, polygon_break_value=None,
+                                 start_index=0, face_uid_name=None, face_uid_dtype=None, variable_kwargs=None):
+    """
+    Create the dimensions, variables, and global attributes of an ESMF unstructured format file.
+
+    :param ds: The open dataset.
+    :type ds: :class:`netCDF4.Dataset`
+    :param sequence sizes: The node, element, and connection counts. A ``None`` count creates an unlimited dimension.
+    :param dict variable_kwargs: Optional ``createVariable`` keyword arguments keyed by variable name. See
+     :func:`get_esmf_format_profile`.
+    """
+
+    variable_kwargs = variable_kwargs or {}
 
+    # Dimensions -------------------------------------------------------------------------------------------------------
+
+    node_count_size, element_count_size, connection_count_size = sizes
+
+    node_count = ds.createDimension('nodeCount', node_count_size)
+    element_count = ds.createDimension('elementCount', element_count_size)
+    coord_dim = ds.createDimension('coordDim', 2)
+    # element_conn_vltype = ds.createVLType(fm.faces[0].dtype, 'elementConnVLType')
+    connection_count = ds.createDimension('connectionCount', connection_count_size)
+
+    # Variables --------------------------------------------------------------------------------------------------------
+
+    def create_variable(name, dtype, dimensions):
+        return ds.createVariable(name, dtype, dimensions, **variable_kwargs.get(name, {}))
+
+    node_coords = create_variable('nodeCoords', node_dtype, (node_count.name, coord_dim.name))
+    node_coords.units = 'degrees'
+
+    element_conn = create_variable('elementConn', element_conn_dtype, (connection_count.name,))
+    element_conn.long_name = 'Node indices that define the element connectivity.'
+    if polygon_break_value is not None:
+        element_conn.polygon_break_value = polygon_break_value
+    element_conn.start_index = start_index
+
+    num_element_conn = create_variable('numElementConn', np.int32, (element_count.name,))
+    num_element_conn.long_name = 'Number of nodes per element.'
+
+    center_coords = create_variable('centerCoords', center_dtype, (element_count.name, coord_dim.name))
+    center_coords.units = 'degrees'
+
+    if face_uid_dtype is not None:
+        uid = create_variable(face_uid_name, face_uid_dtype, (element_count.name,))
+        uid.long_name = 'Element unique identifier.'
+
+    element_area = create_variable('elementArea', node_dtype, (element_count.name,))
+    element_area.units = 'degrees'
+    element_area.long_name = 'Element area in native units.'
+
+    # Global Attributes ------------------------------------------------------------------------------------------------
+
+    ds.gridType = 'unstructured'
+    ds.version = '0.9'
+    setattr(ds, coord_dim.name, "longitude latitude")
+
+    # element_mask = ds.createVariable('elementMask', np.int32, (element_count.name,))
+
+
+def fill_esmf_format_variables(ds, starts, nodes, element_conn_data, num_element_conn_data, face_coordinates,
+                               face_areas, face_uid_name, face_uid_value):
+    """
+    Write the current rank's values to the variables created by :func:`convert_collection_to_esmf_format`.
+
+    :param ds: The open dataset.
+    :type ds: :class:`netCDF4.Dataset`
+    :param sequence starts: The rank's node, element, and connection start offsets. See
+     :func:`utools.io.mpi.get_offsets`.
+    """
+
+    node_coords_start, start, element_conn_start = starts
+    node_coords_stop = node_coords_start + nodes.shape[0]
+    element_conn_stop = element_conn_start + element_conn_data.shape[0]
+    stop = start + num_element_conn_data.shape[0]
+    log.debug(('node_coords_start', node_coords_start))
+
+    if node_coords_stop > node_coords_start:
+        ds.variables['nodeCoords'][node_coords_start:node_coords_stop] = nodes
+    log.debug(('element_conn indices', element_conn_start, element_conn_stop))
+    if element_conn_stop > element_conn_start:
+        ds.variables['elementConn'][element_conn_start:element_conn_stop] = element_conn_data
+
+    if stop > start:
+        ds.variables['numElementConn'][start:stop] = num_element_conn_data
+        ds.variables['centerCoords'][start:stop] = face_coordinates
+        ds.variables['elementArea'][start:stop] = face_areas
+        if face_uid_value is not None:
+            ds.variables[face_uid_name][start:stop] = face_uid_value
+
+
+def get_split_polygon_by_node_threshold(geom, node_threshold, max_depth=None, split_method=None):
+    """
+    Split polygons with more nodes than the threshold into pieces. Pieces still exceeding the threshold are split again.
+
+    :param geom: The geometry to split.
+    :type geom: :class:`shapely.geometry.Polygon` | :class:`shapely.geometry.MultiPolygon`
+    :param int node_threshold: The target maximum number of nodes for each piece.
+    :param int max_depth: Maximum number of recursive splits. If ``None``, use
+     :attr:`utools.constants.UgridToolsConstants.SPLIT_MAX_DEPTH` for the ``'grid'`` method and
+     :attr:`utools.constants.UgridToolsConstants.QUADTREE_MAX_DEPTH` for the ``'quadtree'`` method.
+    :param str split_method: If ``'grid'``, split using a rectangular grid sized by the node count. If ``'quadtree'``,
+     split into quadrants at the median node coordinates so pieces have similar node counts. If ``None``, use
+     :attr:`utools.constants.UgridToolsConstants.SPLIT_METHOD`.
+    :rtype: :class:`shapely.geometry.MultiPolygon`
+    :raises: ValueError
+    """
+
+    if split_method is None:
+        split_method = UgridToolsConstants.SPLIT_METHOD
+    if split_method == 'grid':
+        get_pieces = get_split_polygon_pieces
+        default_max_depth = UgridToolsConstants.SPLIT_MAX_DEPTH
+    elif split_method == 'quadtree':
+        get_pieces = get_quadtree_polygon_pieces
+        default_max_depth = UgridToolsConstants.QUADTREE_MAX_DEPTH
+    else:
+        raise ValueError('Split method not recognized: {}'.format(split_method))
+    if max_depth is None:
+        max_depth = default_max_depth
+
+    the_multi = []
+    for polygon in get_iter(geom, dtype=Polygon):
+        the_multi += get_pieces(polygon, node_threshold, max_depth)
     return MultiPolygon(the_multi)
 
 
+def get_split_polygon_pieces(polygon, node_threshold, max_depth, depth=0):
+    """
+    :param polygon: The polygon to split.
+    :type polygon: :class:`shapely.geometry.Polygon`
+    :param int node_threshold: The target maximum number of nodes for each piece.
+    :param int max_depth: Maximum number of recursive splits.
+    :param int depth: The current recursion depth.
+    :returns: Polygon pieces covering ``polygon``.
+    :rtype: list
+    """
+
+    node_count = get_node_count(polygon)
+    if node_count <= node_threshold:
+        return [polygon]
+
+    # Approximate number of splits needed for each piece to be less than the node threshold. There should be at least
+    # two splits in each direction.
+    n_splits = int(np.ceil(node_count / float(node_threshold)))
+    split_shape = [max(int(np.ceil(np.sqrt(n_splits))), 2)] * 2
+
+    splitters = get_split_polygons(polygon, split_shape)
+    n_cols = split_shape[1]
+
+    ret = []
+    prepared = prep(polygon)
+    # Clip the polygon to each grid row first so cell intersections only operate on the row's coordinates.
+    for row, band in enumerate(get_split_polygons(polygon, (split_shape[0], 1))):
+        row_splitters = splitters[row * n_cols:(row + 1) * n_cols]
+        # Cells covered by the polygon need no intersection and cells not touching it contribute nothing.
+        if prepared.contains(band):
+            ret += row_splitters
+            continue
+        if not prepared.intersects(band):
+            continue
+        strip = polygon.intersection(band)
+        prepared_strip = prep(strip)
+        for splitter in row_splitters:
+            if prepared_strip.contains(splitter):
+                ret.append(splitter)
+                continue
+            if not prepared_strip.intersects(splitter):
+                continue
+            for piece in get_iter(strip.intersection(splitter), dtype=Polygon):
+                if not isinstance(piece, Polygon) or piece.is_empty:
+                    continue
+                piece_node_count = get_node_count(piece)
+                # Only split again if the previous split reduced the node count.
+                if node_threshold < piece_node_count < node_count and depth < max_depth:
+                    ret += get_split_polygon_pieces(piece, node_threshold, max_depth, depth=depth + 1)
+                else:
+                    ret.append(piece)
+    return ret
+
+
+def get_quadtree_polygon_pieces(polygon, node_threshold, max_depth, depth=0):
+    """
+    :param polygon: The polygon to split.
+    :type polygon: :class:`shapely.geometry.Polygon`
+    :param int node_threshold: The target maximum number of nodes for each piece.
+    :param int max_depth: Maximum number of recursive splits.
+    :param int depth: The current recursion depth.
+    :returns: Polygon pieces covering ``polygon``.
+    :rtype: list
+    """
+
+    node_count = get_node_count(polygon)
+    if node_count <= node_threshold:
+        return [polygon]
+
+    # Split at the median node coordinates so the quadrants have similar node counts. Use the center of the bounds if
+    # the median is on the boundary.
+    minx, miny, maxx, maxy = polygon.bounds
+    coords = np.vstack([np.array(ring.coords)[:, 0:2] for ring in [polygon.exterior] + list(polygon.interiors)])
+    x, y = np.median(coords, axis=0).tolist()
+    if not minx < x < maxx:
+        x = (minx + maxx) / 2.
+    if not miny < y < maxy:
+        y = (miny + maxy) / 2.
+
+    ret = []
+    for lower, upper in ((miny, y), (y, maxy)):
+        strip = polygon.intersection(box(minx, lower, maxx, upper))
+        for left, right in ((minx, x), (x, maxx)):
+            for piece in get_iter(strip.intersection(box(left, lower, right, upper)), dtype=Polygon):
+                if not isinstance(piece, Polygon) or piece.is_empty:
+                    continue
+                piece_node_count = get_node_count(piece)
+                # Only split again if the previous split reduced the node count.
+                if node_threshold < piece_node_count < node_count and depth < max_depth:
+                    ret += get_quadtree_polygon_pieces(piece, node_threshold, max_depth, depth=depth + 1)
+                else:
+                    ret.append(piece)
+    return ret
+
+
+def get_node_count_report(node_counts, bins=10):
+    """
+    :param sequence node_counts: Element node counts.
+    :param int bins: Number of histogram bins.
+    :returns: A text histogram of the node counts with one line per bin.
+    :rtype: str
+    """
+
+    node_counts = np.asarray(node_counts)
+    if node_counts.shape[0] == 0:
+        return 'Node count histogram: no elements'
+    counts, edges = np.histogram(node_counts, bins=bins)
+    lines = ['Node count histogram ({} elements, max={}):'.format(node_counts.shape[0], node_counts.max())]
+    for count, lower, upper in itertools.izip(counts.tolist(), edges[:-1].tolist(), edges[1:].tolist()):
+        lines.append('  [{:.0f}, {:.0f}]: {}'.format(lower, upper, count))
+    return '\n'.join(lines)
+
+
 def get_node_schema(geom):
     # tdk: doc
     ret = Dict()
@@ -662,6 +1786,20 @@ def get_node_schema(geom):
     return ret
 
 
+def get_geometry_nbytes(geom):
+    """
+    :param geom: A polygon or multipolygon.
+    :type geom: :class:`shapely.geometry.base.BaseGeometry`
+    :returns: The approximate memory size of the geometry's coordinates in bytes.
+    :rtype: int
+    """
+
+    ret = 0
+    for ii in get_iter(geom, dtype=Polygon):
+        ret += len(ii.exterior.coords) + sum([len(interior.coords) for interior in ii.interiors])
+    return ret * 16
+
+
 def get_node_count(geom):
     node_count = 0
     for ii in get_iter(geom, dtype=Polygon):
@@ -686,46 +1824,31 @@ def get_bounds_from_1d(centroids):
 
     mids = get_bounds_vector_from_centroids(centroids)
 
-    # loop to fill the bounds array
     bounds = np.zeros((centroids.shape[0], 2), dtype=centroids.dtype)
-    for ii in range(mids.shape[0]):
-        try:
-            bounds[ii, 0] = mids[ii]
-            bounds[ii, 1] = mids[ii + 1]
-        except IndexError:
-            break
+    bounds[:, 0] = mids[:-1]
+    bounds[:, 1] = mids[1:]
 
     return bounds
 
 
 def get_split_polygons(geom, split_shape):
-    minx, miny, maxx, maxy = geom.bounds
-    rows = np.linspace(miny, maxy, split_shape[0])
-    cols = np.linspace(minx, maxx, split_shape[1])
-
-    cols, rows = np.meshgrid(cols, rows)
-
-    cols_corners = get_extrapolated_corners_esmf(cols)
-    cols_corners = get_ocgis_corners_from_esmf_corners(cols_corners)
-
-    rows_corners = get_extrapolated_corners_esmf(rows)
-    rows_corners = get_ocgis_corners_from_esmf_corners(rows_corners)
-
-    corners = np.vstack((rows_corners, cols_corners))
-    corners = corners.reshape([2] + list(cols_corners.shape))
-    range_row = range(rows.shape[0])
-    range_col = range(cols.shape[1])
+    """
+    :param geom: The geometry to split.
+    :type geom: :class:`shapely.geometry.base.BaseGeometry`
+    :param sequence split_shape: Number of rows and columns in the split grid.
+    :returns: Rectangles covering the bounds of ``geom`` ordered by row.
+    :rtype: list
+    """
 
-    fill = np.zeros(cols.shape, dtype=object)
+    minx, miny, maxx, maxy = geom.bounds
+    rows = np.linspace(miny, maxy, split_shape[0] + 1)
+    cols = np.linspace(minx, maxx, split_shape[1] + 1)
 
-    for row, col in itertools.product(range_row, range_col):
-        current_corner = corners[:, row, col]
-        coords = np.hstack((current_corner[1, :].reshape(-1, 1),
-                            current_corner[0, :].reshape(-1, 1)))
-        polygon = Polygon(coords)
-        fill[row, col] = polygon
+    # Lower left and upper right corners of each grid cell.
+    lower, left = [arr.flatten() for arr in np.meshgrid(rows[:-1], cols[:-1], indexing='ij')]
+    upper, right = [arr.flatten() for arr in np.meshgrid(rows[1:], cols[1:], indexing='ij')]
 
-    return fill.flatten().tolist()
+    return [box(*bounds) for bounds in itertools.izip(left.tolist(), lower.tolist(), right.tolist(), upper.tolist())]
 
 
 def get_ocgis_corners_from_esmf_corners(ecorners):
@@ -742,13 +1865,10 @@ def get_ocgis_corners_from_esmf_corners(ecorners):
     base_shape = [xx - 1 for xx in ecorners.shape]
     grid_corners = np.zeros(base_shape + [4], dtype=ecorners.dtype)
     # Uppler left, upper right, lower right, lower left
-    slices = [(0, 0), (0, 1), (1, 1), (1, 0)]
-    for ii, jj in itertools.product(range(base_shape[0]), range(base_shape[1])):
-        row_slice = slice(ii, ii + 2)
-        col_slice = slice(jj, jj + 2)
-        corners = ecorners[row_slice, col_slice]
-        for kk, slc in enumerate(slices):
-            grid_corners[ii, jj, kk] = corners[slc]
+    grid_corners[:, :, 0] = ecorners[:-1, :-1]
+    grid_corners[:, :, 1] = ecorners[:-1, 1:]
+    grid_corners[:, :, 2] = ecorners[1:, 1:]
+    grid_corners[:, :, 3] = ecorners[1:, :-1]
     grid_corners = np.ma.array(grid_corners, mask=False)
     return grid_corners
 
@@ -778,11 +1898,8 @@ def get_extrapolated_corners_esmf(arr):
     # the corners array has one additional row and column
     corners = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=arr.dtype)
 
-    # fill the interior of the array first with a 2x2 moving window. then do edges.
-    for ii in range(arr.shape[0] - 1):
-        for jj in range(arr.shape[1] - 1):
-            window_values = arr[ii:ii + 2, jj:jj + 2]
-            corners[ii + 1, jj + 1] = np.mean(window_values)
+    # fill the interior of the array first with the mean of a 2x2 moving window. then do edges.
+    corners[1:-1, 1:-1] = (arr[:-1, :-1] + arr[:-1, 1:] + arr[1:, :-1] + arr[1:, 1:]) / 4.
 
     # flag to determine if rows are increasing in value
     row_increasing = get_is_increasing(arr[:, 0])
@@ -793,32 +1910,22 @@ def get_extrapolated_corners_esmf(arr):
     row_diff = np.mean(np.abs(np.diff(arr[:, 0])))
     col_diff = np.mean(np.abs(np.diff(arr[0, :])))
 
+    if not col_increasing:
+        col_diff = -col_diff
+    if not row_increasing:
+        row_diff = -row_diff
+
     # fill the rows accounting for increasing flag
-    for ii in range(1, corners.shape[0] - 1):
-        if col_increasing:
-            corners[ii, 0] = corners[ii, 1] - col_diff
-            corners[ii, -1] = corners[ii, -2] + col_diff
-        else:
-            corners[ii, 0] = corners[ii, 1] + col_diff
-            corners[ii, -1] = corners[ii, -2] - col_diff
+    corners[1:-1, 0] = corners[1:-1, 1] - col_diff
+    corners[1:-1, -1] = corners[1:-1, -2] + col_diff
 
     # fill the columns accounting for increasing flag
-    for jj in range(1, corners.shape[1] - 1):
-        if row_increasing:
-            corners[0, jj] = corners[1, jj] - row_diff
-            corners[-1, jj] = corners[-2, jj] + row_diff
-        else:
-            corners[0, jj] = corners[1, jj] + row_diff
-            corners[-1, jj] = corners[-2, jj] - row_diff
+    corners[0, 1:-1] = corners[1, 1:-1] - row_diff
+    corners[-1, 1:-1] = corners[-2, 1:-1] + row_diff
 
     # fill the extreme corners accounting for increasing flag
-    for row_idx in [0, -1]:
-        if col_increasing:
-            corners[row_idx, 0] = corners[row_idx, 1] - col_diff
-            corners[row_idx, -1] = corners[row_idx, -2] + col_diff
-        else:
-            corners[row_idx, 0] = corners[row_idx, 1] + col_diff
-            corners[row_idx, -1] = corners[row_idx, -2] - col_diff
+    corners[[0, -1], 0] = corners[[0, -1], 1] - col_diff
+    corners[[0, -1], -1] = corners[[0, -1], -2] + col_diff
 
     return corners
 
@@ -857,8 +1964,7 @@ def get_bounds_vector_from_centroids(centroids):
     # will hold the mean midpoints between coordinate elements
     mids = np.zeros(centroids.shape[0] - 1, dtype=centroids.dtype)
     # this is essentially a two-element span moving average kernel
-    for ii in range(mids.shape[0]):
-        mids[ii] = np.mean(centroids[ii:ii + 2])
+    mids[:] = (centroids[:-1] + centroids[1:]) / 2.
     # account for edge effects by averaging the difference of the midpoints. if there is only a single value, use the
     # different of the original values instead.
     if len(mids) == 1:
@@ -12,9 +12,21 @@ class DummyMPIComm(object):
     def Barrier(self):
         pass
 
+    def allgather(self, *args, **kwargs):
+        return [args[0]]
+
+    def allreduce(self, *args, **kwargs):
+        return args[0]
+
+    def alltoall(self, *args, **kwargs):
+        return args[0]
+
     def bcast(self, *args, **kwargs):
         return args[0]
 
+    def exscan(self, *args, **kwargs):
+        return None
+
     def gather(self, *args, **kwargs):
         return [args[0]]
 
@@ -36,7 +48,23 @@ MPI_SIZE = MPI_COMM.Get_size()
 MPI_RANK = MPI_COMM.Get_rank()
 
 
-def create_sections(length, size=MPI_SIZE):
+def create_sections(length, size=MPI_SIZE, weights=None):
+    """
+    Split a range of element indices into contiguous sections.
+
+    :param int length: The number of elements to split.
+    :param int size: The number of sections to create.
+    :param weights: Vector of non-negative element costs with shape ``(length,)``. If provided, sections are chosen so
+     each has approximately the same total cost. Each section contains at least one element if ``length >= size``. If
+     ``None``, sections contain approximately the same number of elements.
+    :type weights: :class:`numpy.ndarray`
+    :returns: A sequence of ``[start, stop]`` sections with one section per rank.
+    :rtype: list
+    """
+
+    if weights is not None and length >= size:
+        return create_weighted_sections(weights, size)
+
     step = int(np.ceil(float(length) / size))
     indexes = [None] * size
     start = 0
@@ -50,6 +78,56 @@ def create_sections(length, size=MPI_SIZE):
     return indexes
 
 
+def create_weighted_sections(weights, size):
+    weights = np.asarray(weights, dtype=float)
+    length = weights.shape[0]
+    assert length >= size
+
+    # An element is placed in the first section whose cumulative cost target lies beyond the element's center.
+    cumulative = np.cumsum(weights)
+    centers = cumulative - 0.5 * weights
+    targets = cumulative[-1] * np.arange(1, size, dtype=float) / size
+    stops = np.searchsorted(centers, targets)
+
+    # Ensure each section has at least one element. Stops are offset by their section index so the adjusted stops
+    # remain strictly increasing.
+    offsets = np.arange(1, size)
+    stops = np.clip(stops - offsets, 0, length - size)
+    stops = np.maximum.accumulate(stops) + offsets
+
+    bounds = [0] + stops.tolist() + [length]
+    return [[int(bounds[ii]), int(bounds[ii + 1])] for ii in range(size)]
+
+
+def get_offsets(counts, comm=None):
+    """
+    Compute the global start offsets and totals for rank-local counts using collective prefix sums. Ranks are ordered
+    by rank number.
+
+    >>> (node_start, element_start), (node_total, element_total) = get_offsets([n_nodes, n_elements])
+
+    :param counts: A rank-local count or a sequence of rank-local counts.
+    :type counts: int or sequence
+    :param comm: The communicator. If ``None``, use :attr:`utools.io.mpi.MPI_COMM`.
+    :returns: A tuple ``(starts, totals)``. Each is an integer if ``counts`` is an integer and a vector otherwise.
+    :rtype: tuple
+    """
+
+    comm = comm or MPI_COMM
+    is_scalar = np.isscalar(counts)
+    counts = np.atleast_1d(np.array(counts, dtype=np.int64))
+
+    starts = comm.exscan(counts)
+    # The exclusive scan is undefined on the first rank.
+    if starts is None:
+        starts = np.zeros_like(counts)
+    totals = comm.allreduce(counts)
+
+    if is_scalar:
+        starts, totals = int(starts[0]), int(totals[0])
+    return starts, totals
+
+
 def dgather(elements):
     grow = elements[0]
     for idx in range(1, len(elements)):
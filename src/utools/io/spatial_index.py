@@ -1,5 +1,6 @@
 from itertools import izip
 
+import numpy as np
 from rtree import index
 from shapely.prepared import prep
 
@@ -7,13 +8,25 @@ from shapely.prepared import prep
 class SpatialIndex(object):
     """
     Create and access spatial indexes using the :mod:`rtree` module.
+
+    :param str path: Path to a serialized spatial index without the ``.idx`` or ``.dat`` extension. If ``None``, create
+     an in-memory index.
+    :param stream: An iterable of ``(id, (min x, min y, max x, max y), None)`` tuples. If provided, the index is bulk
+     loaded from the stream which is much faster than inserting items one at a time. ``path`` must not exist.
     """
 
-    def __init__(self, path=None):
-        if path is None:
-            self._index = index.Index()
-        else:
-            self._index = index.Rtree(path)
+    def __init__(self, path=None, stream=None):
+        args = []
+        if path is not None:
+            args.append(path)
+        if stream is not None:
+            args.append(stream)
+        self._index = index.Index(*args)
+
+    def close(self):
+        """Flush and close the underlying index. Required before a new disk index is read by other processes."""
+
+        self._index.close()
 
     def add(self, id_geom, shapely_geom):
         """
@@ -31,6 +44,58 @@ class SpatialIndex(object):
             for ig, sg in izip(id_geom, shapely_geom):
                 _insert(ig, sg.bounds)
 
+    def query(self, query_geoms, geom_mapping, predicate='intersects'):
+        """
+        Find the geometries satisfying a spatial predicate for each query geometry. Candidates are found with a batch
+        bounding box query. Each query geometry is prepared once to test its candidates.
+
+        :param sequence query_geoms: Sequence of :class:`shapely.geometry.base.BaseGeometry` query geometries.
+        :param dict geom_mapping: The collection of geometries to do the full predicate test on. The keys of the
+         dictionary correspond to the integer unique identifiers. The values are Shapely geometries.
+        :param str predicate: Name of the prepared geometry predicate called as ``predicate(query_geom, geom)``
+         (e.g. ``'intersects'``, ``'contains'``, ``'touches'``). If ``None``, return the bounding box candidates.
+        :returns: See :meth:`~utools.io.spatial_index.SpatialIndex.query_bounds`.
+        :rtype: tuple
+        """
+
+        bounds = np.array([g.bounds for g in query_geoms], dtype=np.float64).reshape(-1, 4)
+        query_index, uids = self.query_bounds(bounds)
+        if predicate is None or query_index.shape[0] == 0:
+            return query_index, uids
+
+        keep = np.zeros(query_index.shape[0], dtype=bool)
+        # Candidates are grouped by query index.
+        boundaries = np.flatnonzero(np.diff(query_index)) + 1
+        starts = np.hstack(([0], boundaries))
+        stops = np.hstack((boundaries, [query_index.shape[0]]))
+        for start, stop in izip(starts, stops):
+            test = getattr(prep(query_geoms[query_index[start]]), predicate)
+            keep[start:stop] = [test(geom_mapping[uid]) for uid in uids[start:stop].tolist()]
+        return query_index[keep], uids[keep]
+
+    def query_bounds(self, bounds):
+        """
+        Find the identifiers of indexed geometries with bounding boxes intersecting each query bounding box.
+
+        :param bounds: Query bounds as rows of ``(min x, min y, max x, max y)`` with shape ``(n, 4)``.
+        :type bounds: :class:`numpy.ndarray`
+        :returns: A tuple of integer vectors ``(query_index, uid)`` of candidate pairs sorted by query index.
+        :rtype: tuple
+        """
+
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        if hasattr(self._index, 'intersection_v'):
+            # Available with newer "rtree" versions. The query runs in a single call.
+            uids, counts = self._index.intersection_v(bounds[:, 0:2], bounds[:, 2:4])
+            uids = uids.astype(np.int64)
+        else:
+            _intersection = self._index.intersection
+            found = [np.fromiter(_intersection(tuple(b)), dtype=np.int64) for b in bounds.tolist()]
+            counts = np.array([f.shape[0] for f in found], dtype=np.int64)
+            uids = np.hstack(found + [np.zeros(0, dtype=np.int64)])
+        query_index = np.repeat(np.arange(bounds.shape[0], dtype=np.int64), counts)
+        return query_index, uids
+
     def iter_intersects(self, shapely_geom, geom_mapping, keep_touches=True):
         """
         Return an interator for the unique identifiers of the geometries intersecting the target geometry.
@@ -7,7 +7,9 @@ from logbook import DEBUG
 from utools.constants import UgridToolsConstants
 from utools.io.core import from_shapefile
 from utools.io.geom_manager import GeometryManager
-from utools.io.helpers import convert_multipart_to_singlepart, convert_collection_to_esmf_format
+from utools.io.helpers import convert_multipart_to_singlepart, convert_collection_to_esmf_format, \
+    convert_to_esmf_format_stream, get_esmf_format_sizes, get_esmf_format_nbytes
+from utools.io.mpi import MPI_SIZE
 from utools.logging import log_entry_exit, log
 
 
@@ -21,16 +23,49 @@ def convert_to_singlepart():
 
 @log_entry_exit
 def convert_to_esmf_format(path_out_nc, path_in_shp, name_uid, node_threshold=None, debug=False, driver_kwargs=None,
-                           dest_crs=None, with_connectivity=False, dataset_kwargs=None):
+                           dest_crs=None, with_connectivity=False, dataset_kwargs=None, pack=False, balance=False,
+                           parallel_write=False, split_method=None, split_processes=None, stream=False,
+                           profile=None, float32_tolerance=None, geometry_cache_nbytes=None,
+                           pack_decimals=UgridToolsConstants.CONNECTIVITY_DECIMALS, scan_sizes=True):
     polygon_break_value = UgridToolsConstants.POLYGON_BREAK_VALUE
 
+    if stream:
+        # Convert and write blocks of records without loading the whole mesh.
+        if pack or with_connectivity:
+            raise ValueError('Streaming conversion does not support packing nodes or computing connectivity.')
+        if balance or parallel_write:
+            raise ValueError('Streaming conversion runs on a single process and does not support balancing or '
+                             'parallel writes.')
+        if MPI_SIZE > 1:
+            raise ValueError('Streaming conversion runs on a single process.')
+        gm = GeometryManager(name_uid, path=path_in_shp, allow_multipart=True, node_threshold=node_threshold,
+                             slc=[0, 1] if debug else None, driver_kwargs=driver_kwargs, dest_crs=dest_crs,
+                             properties=[], split_method=split_method, split_processes=split_processes,
+                             geometry_cache_nbytes=geometry_cache_nbytes)
+        if scan_sizes:
+            # Size the output dimensions exactly before writing. Elements exceeding the node threshold are split by
+            # the scan and again by the conversion.
+            sizes = get_esmf_format_sizes(gm)
+            log.info('ESMF format sizes (nodeCount, elementCount, connectionCount): {}, {:.1f} MB'.format(
+                sizes, get_esmf_format_nbytes(sizes) / 1024. ** 2))
+        else:
+            # Write to unlimited dimensions.
+            sizes = None
+        convert_to_esmf_format_stream(gm, path_out_nc, polygon_break_value=polygon_break_value,
+                                      face_uid_name=name_uid, dataset_kwargs=dataset_kwargs, sizes=sizes,
+                                      profile=profile, float32_tolerance=float32_tolerance)
+        return
+
     log.debug('loading flexible mesh')
     coll = from_shapefile(path_in_shp, name_uid, use_ragged_arrays=True, with_connectivity=with_connectivity,
                           allow_multipart=True, node_threshold=node_threshold, debug=debug,
-                          driver_kwargs=driver_kwargs, dest_crs=dest_crs)
+                          driver_kwargs=driver_kwargs, dest_crs=dest_crs, pack=pack, esmf_layout=True,
+                          balance=balance, split_method=split_method, split_processes=split_processes,
+                          geometry_cache_nbytes=geometry_cache_nbytes, pack_decimals=pack_decimals)
     log.debug('writing flexible mesh')
     convert_collection_to_esmf_format(coll, path_out_nc, polygon_break_value=polygon_break_value,
-                                      face_uid_name=name_uid, dataset_kwargs=dataset_kwargs)
+                                      face_uid_name=name_uid, dataset_kwargs=dataset_kwargs, parallel=parallel_write,
+                                      profile=profile, float32_tolerance=float32_tolerance)
     # validate_esmf_format(ds, name_uid, path_in_shp)
     log.debug('success')
 
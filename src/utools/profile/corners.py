@@ -0,0 +1,164 @@
+"""Benchmark the vectorized corner and bounds helpers against their original loop implementations."""
+import sys
+import time
+
+import numpy as np
+
+from utools.io.helpers import get_bounds_from_1d, get_extrapolated_corners_esmf, \
+    get_ocgis_corners_from_esmf_corners, get_is_increasing
+
+#: Longitude and latitude element counts used by :func:`utools.prep.create_netcdf_data.create_high_resolution_ucar_grid`.
+UCAR_GRID_SHAPE = (3840, 4608)
+
+
+def get_bounds_from_1d_loop(centroids):
+    mids = get_bounds_vector_from_centroids_loop(centroids)
+
+    # loop to fill the bounds array
+    bounds = np.zeros((centroids.shape[0], 2), dtype=centroids.dtype)
+    for ii in range(mids.shape[0]):
+        try:
+            bounds[ii, 0] = mids[ii]
+            bounds[ii, 1] = mids[ii + 1]
+        except IndexError:
+            break
+
+    return bounds
+
+
+def get_bounds_vector_from_centroids_loop(centroids):
+    if len(centroids) < 2:
+        raise ValueError('Centroid arrays must have length >= 2.')
+
+    # will hold the mean midpoints between coordinate elements
+    mids = np.zeros(centroids.shape[0] - 1, dtype=centroids.dtype)
+    # this is essentially a two-element span moving average kernel
+    for ii in range(mids.shape[0]):
+        mids[ii] = np.mean(centroids[ii:ii + 2])
+    # account for edge effects by averaging the difference of the midpoints. if there is only a single value, use the
+    # different of the original values instead.
+    if len(mids) == 1:
+        diff = np.diff(centroids)
+    else:
+        diff = np.mean(np.diff(mids))
+    # appends for the edges shifting the nearest coordinate by the mean difference
+    mids = np.append([mids[0] - diff], mids)
+    mids = np.append(mids, [mids[-1] + diff])
+
+    return mids
+
+
+def get_extrapolated_corners_esmf_loop(arr):
+    # the corners array has one additional row and column
+    corners = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=arr.dtype)
+
+    # fill the interior of the array first with a 2x2 moving window. then do edges.
+    for ii in range(arr.shape[0] - 1):
+        for jj in range(arr.shape[1] - 1):
+            window_values = arr[ii:ii + 2, jj:jj + 2]
+            corners[ii + 1, jj + 1] = np.mean(window_values)
+
+    # flag to determine if rows are increasing in value
+    row_increasing = get_is_increasing(arr[:, 0])
+    # flag to determine if columns are increasing in value
+    col_increasing = get_is_increasing(arr[0, :])
+
+    # the absolute difference of row and column elements
+    row_diff = np.mean(np.abs(np.diff(arr[:, 0])))
+    col_diff = np.mean(np.abs(np.diff(arr[0, :])))
+
+    # fill the rows accounting for increasing flag
+    for ii in range(1, corners.shape[0] - 1):
+        if col_increasing:
+            corners[ii, 0] = corners[ii, 1] - col_diff
+            corners[ii, -1] = corners[ii, -2] + col_diff
+        else:
+            corners[ii, 0] = corners[ii, 1] + col_diff
+            corners[ii, -1] = corners[ii, -2] - col_diff
+
+    # fill the columns accounting for increasing flag
+    for jj in range(1, corners.shape[1] - 1):
+        if row_increasing:
+            corners[0, jj] = corners[1, jj] - row_diff
+            corners[-1, jj] = corners[-2, jj] + row_diff
+        else:
+            corners[0, jj] = corners[1, jj] + row_diff
+            corners[-1, jj] = corners[-2, jj] - row_diff
+
+    # fill the extreme corners accounting for increasing flag
+    for row_idx in [0, -1]:
+        if col_increasing:
+            corners[row_idx, 0] = corners[row_idx, 1] - col_diff
+            corners[row_idx, -1] = corners[row_idx, -2] + col_diff
+        else:
+            corners[row_idx, 0] = corners[row_idx, 1] + col_diff
+            corners[row_idx, -1] = corners[row_idx, -2] - col_diff
+
+    return corners
+
+
+def get_ocgis_corners_from_esmf_corners_loop(ecorners):
+    # ESMF corners have an extra row and column.
+    base_shape = [xx - 1 for xx in ecorners.shape]
+    grid_corners = np.zeros(base_shape + [4], dtype=ecorners.dtype)
+    # Uppler left, upper right, lower right, lower left
+    slices = [(0, 0), (0, 1), (1, 1), (1, 0)]
+    for ii in range(base_shape[0]):
+        for jj in range(base_shape[1]):
+            corners = ecorners[ii:ii + 2, jj:jj + 2]
+            for kk, slc in enumerate(slices):
+                grid_corners[ii, jj, kk] = corners[slc]
+    grid_corners = np.ma.array(grid_corners, mask=False)
+    return grid_corners
+
+
+def run_benchmark(shape=UCAR_GRID_SHAPE, with_loops=True):
+    """
+    Time the corner and bounds helpers on a grid with the extent of the high resolution UCAR grid.
+
+    :param tuple shape: The grid shape as ``(latitude count, longitude count)``.
+    :param bool with_loops: If ``True``, also time the loop implementations and check the results are identical. The
+     loop implementations take several minutes on the full grid.
+    :returns: Timings in seconds keyed by ``(name, implementation)``.
+    :rtype: dict
+    """
+
+    lon = np.linspace(-133.50735, -60.492672, num=shape[1])
+    lat = np.linspace(20.077797, 57.772186, num=shape[0])
+    mlon, _ = np.meshgrid(lon, lat)
+
+    to_time = [('get_bounds_from_1d', get_bounds_from_1d, get_bounds_from_1d_loop, lon),
+               ('get_extrapolated_corners_esmf', get_extrapolated_corners_esmf, get_extrapolated_corners_esmf_loop,
+                mlon)]
+
+    ret = {}
+    ecorners = None
+    for name, vectorized, loop, arg in to_time:
+        ret[(name, 'vectorized')], actual = get_timing(vectorized, arg)
+        if with_loops:
+            ret[(name, 'loop')], desired = get_timing(loop, arg)
+            assert np.all(actual == desired)
+        if name == 'get_extrapolated_corners_esmf':
+            ecorners = actual
+
+    name = 'get_ocgis_corners_from_esmf_corners'
+    ret[(name, 'vectorized')], actual = get_timing(get_ocgis_corners_from_esmf_corners, ecorners)
+    if with_loops:
+        ret[(name, 'loop')], desired = get_timing(get_ocgis_corners_from_esmf_corners_loop, ecorners)
+        assert np.all(actual == desired)
+
+    return ret
+
+
+def get_timing(func, arg):
+    t1 = time.time()
+    ret = func(arg)
+    t2 = time.time()
+    return t2 - t1, ret
+
+
+if __name__ == '__main__':
+    # Pass "--no-loops" to only time the vectorized implementations.
+    timings = run_benchmark(with_loops='--no-loops' not in sys.argv)
+    for key in sorted(timings):
+        print '{}, {}: {:.3f} seconds'.format(key[0], key[1], timings[key])
@@ -0,0 +1,117 @@
+"""Benchmark the write time, file size, and read time of the ESMF format output profiles."""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import netCDF4 as nc
+import numpy as np
+
+from utools.constants import UgridToolsConstants
+from utools.io.helpers import convert_collection_to_esmf_format
+
+#: Default number of elements in the benchmark mesh.
+ELEMENT_COUNT = 2000000
+
+
+def get_quad_mesh(element_count):
+    """
+    Create an unpacked mesh of square elements in the layout read by
+    :func:`utools.io.helpers.convert_collection_to_esmf_format`.
+
+    :param int element_count: Number of elements in the mesh.
+    :rtype: dict
+    """
+
+    ncol = int(np.ceil(np.sqrt(element_count)))
+    ii = np.arange(element_count)
+    x = (ii % ncol).astype(float)
+    y = (ii // ncol).astype(float)
+
+    # Counter-clockwise corners for each element with no nodes shared between elements.
+    nodes = np.zeros((element_count, 4, 2))
+    nodes[:, :, 0] = x[:, None] + [0., 1., 1., 0.]
+    nodes[:, :, 1] = y[:, None] + [0., 0., 1., 1.]
+    # Perturb the nodes so coordinates compress like real geometries and not like a regular grid.
+    nodes += np.random.RandomState(1).uniform(-0.1, 0.1, size=nodes.shape)
+
+    ret = {'nodes': nodes.reshape(-1, 2),
+           'element_conn': np.arange(element_count * 4, dtype=np.int32),
+           'num_element_conn': np.repeat(np.int32(4), element_count),
+           'face_coordinates': np.column_stack([x + 0.5, y + 0.5]),
+           'face_areas': np.ones(element_count),
+           'uid': np.arange(1, element_count + 1, dtype=np.int32)}
+    return ret
+
+
+def run_benchmark(element_count=ELEMENT_COUNT, profiles=None, directory=None):
+    """
+    Write the same mesh with each output profile and read it back. ESMF is used to time reads if ``ESMF`` (ESMPy) can
+    be imported. Otherwise, reading every variable in full with ``netCDF4`` is timed instead.
+
+    :param int element_count: Number of elements in the benchmark mesh.
+    :param sequence profiles: Names of the profiles to benchmark. If ``None``, benchmark the library defaults (named
+     ``'default'``) and all profiles in :attr:`utools.constants.UgridToolsConstants.ESMF_FORMAT_PROFILES`.
+    :param str directory: Directory for the output files. If ``None``, use a temporary directory that is removed.
+    :returns: Write seconds, file size in bytes, and read seconds keyed by ``(profile, measure)``. The read method is
+     stored with the key ``('read', 'method')``.
+    :rtype: dict
+    """
+
+    if profiles is None:
+        profiles = ['default'] + sorted(UgridToolsConstants.ESMF_FORMAT_PROFILES.keys())
+    mesh = get_quad_mesh(element_count)
+
+    if directory is None:
+        out_dir = tempfile.mkdtemp(prefix='utools_output_profiles_')
+    else:
+        out_dir = directory
+    try:
+        read_method, read = get_reader()
+        ret = {('read', 'method'): read_method}
+        for profile in profiles:
+            path = os.path.join(out_dir, 'esmf_format_{}.nc'.format(profile))
+            ret[(profile, 'write')], _ = get_timing(convert_collection_to_esmf_format, mesh, path, face_uid_name='uid',
+                                                    profile=None if profile == 'default' else profile)
+            ret[(profile, 'nbytes')] = os.path.getsize(path)
+            ret[(profile, 'read')], _ = get_timing(read, path)
+    finally:
+        if directory is None:
+            shutil.rmtree(out_dir)
+
+    return ret
+
+
+def get_reader():
+    try:
+        import ESMF
+    except ImportError:
+        def read(path):
+            with nc.Dataset(path) as ds:
+                for var in ds.variables.values():
+                    var[:]
+
+        return 'netCDF4', read
+    else:
+        def read(path):
+            return ESMF.Mesh(filename=path, filetype=ESMF.FileFormat.ESMFMESH)
+
+        return 'ESMF', read
+
+
+def get_timing(func, *args, **kwargs):
+    t1 = time.time()
+    ret = func(*args, **kwargs)
+    t2 = time.time()
+    return t2 - t1, ret
+
+
+if __name__ == '__main__':
+    # Pass the element count as the first argument to change the mesh size.
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ELEMENT_COUNT
+    results = run_benchmark(element_count=count)
+    print 'read method: {}'.format(results.pop(('read', 'method')))
+    for name in sorted(set([k[0] for k in results])):
+        print '{}: write {:.3f} seconds, {:.1f} MB, read {:.3f} seconds'.format(
+            name, results[(name, 'write')], results[(name, 'nbytes')] / 1024. ** 2, results[(name, 'read')])
@@ -7,6 +7,7 @@ import numpy as np
 from utools.helpers import nc_scope
 from utools.io.mpi import MPI_RANK, create_sections, MPI_COMM, MPI_SIZE
 from utools.logging import log, log_entry_exit
+from utools.regrid.weight_cache import WeightCache, get_weight_cache_key
 
 
 @log_entry_exit
@@ -29,34 +30,85 @@ def create_weights_file(mpirun_exe_path, esmf_exe_path, path_in_source, path_in_
 
 
 @log_entry_exit
-def create_weighted_output(path_in_esmf_format, path_in_source, path_out_weights_nc, path_output_data, variable_name):
+def create_weighted_output(path_in_esmf_format, path_in_source, path_out_weights_nc, path_output_data, variable_name,
+                           sparse=True, time_block_size=None, weight_cache_directory=None,
+                           weight_cache_max_nbytes=None, balance=False):
+    """
+    Apply ESMF weights to a source variable and write the weighted values to a copy of the ESMF unstructured file.
+
+    :param str path_in_esmf_format: Path to the destination ESMF unstructured NetCDF file.
+    :param str path_in_source: Path to the source NetCDF file containing the variable to weight.
+    :param str path_out_weights_nc: Path to the ESMF weights NetCDF file.
+    :param str path_output_data: Path to the output NetCDF file.
+    :param str variable_name: Name of the variable to weight in the source file.
+    :param bool sparse: If ``True``, apply the weights as a single sparse matrix product across all time steps. If
+     ``False``, search the weight vectors for each destination element and time step. The results are the same.
+    :param int time_block_size: The number of time steps to read from the source variable at once when applying sparse
+     weights. If ``None``, read all time steps at once.
+    :param str weight_cache_directory: Path to a directory for caching the sparse form of the weights between runs. See
+     :class:`utools.regrid.weight_cache.WeightCache`. If ``None``, do not use a weight cache.
+    :param int weight_cache_max_nbytes: Maximum size of the weight cache directory in bytes.
+    :param bool balance: If ``True``, split destination elements so each rank applies approximately the same number
+     of weights. If ``False``, each rank receives the same number of destination elements.
+    """
     if MPI_RANK == 0:
         log.info('Copying/creating output file')
         shutil.copy2(path_in_esmf_format, path_output_data)
 
         with nc_scope(path_out_weights_nc) as ds:
             length = len(ds.dimensions['n_b'])
-            slices = create_sections(length)
+            if balance:
+                # Rows are one-based destination indices.
+                weights = np.bincount(ds.variables['row'][:] - 1, minlength=length)
+            else:
+                weights = None
+            slices = create_sections(length, weights=weights)
     else:
+        length = None
         slices = None
 
     log.info('Applying weights')
     section = MPI_COMM.scatter(slices, root=0)
     log.debug('section={}'.format(section))
 
+    if sparse and weight_cache_directory is not None:
+        length = MPI_COMM.bcast(length)
+        weight_cache = WeightCache(weight_cache_directory, max_nbytes=weight_cache_max_nbytes)
+    else:
+        weight_cache = None
+
     with nc_scope(path_in_source) as source:
-        with nc_scope(path_out_weights_nc) as ds:
-            row = ds.variables['row'][:]
-            col = ds.variables['col'][:]
-            S = ds.variables['S'][:]
-            ntime = len(source.dimensions['time'])
+        ntime = len(source.dimensions['time'])
+        if sparse:
+            if weight_cache is not None:
+                cache_key = get_weight_cache_key(path_out_weights_nc, source.variables[variable_name].shape[1:],
+                                                 length, section)
+                sparse_weights = weight_cache.get(cache_key)
+            else:
+                sparse_weights = None
+            if sparse_weights is None:
+                row, col, S = get_weights(path_out_weights_nc)
+                sparse_weights = get_sparse_weights(row, col, S, section)
+                if weight_cache is not None:
+                    weight_cache.put(cache_key, sparse_weights)
+            indptr, indices, data = sparse_weights
+
+            reader = SourceBlockReader(source.variables[variable_name], indices, time_block_size=time_block_size)
+            sparse_weights = (indptr, reader.buffer_indices, data)
+            voutput = np.zeros((ntime, section[1] - section[0]), dtype=float)
+            for start, stop, source_data in reader:
+                voutput[start:stop] = apply_sparse_weights(sparse_weights, source_data)
+            log.info('Source bytes read={}, peak buffer bytes={}'.format(reader.nbytes_read,
+                                                                         reader.peak_buffer_nbytes))
+        else:
+            row, col, S = get_weights(path_out_weights_nc)
             voutput = np.zeros((ntime, section[1] - section[0]), dtype=float)
             for idx_voutput, idx_dst in enumerate(range(*section)):
                 select = row == idx_dst + 1
                 idx_src = col[select]
                 s = S[select]
                 # assert np.isclose(s.sum(), 1.0)
-                for idx_time in range(len(source.dimensions['time'])):
+                for idx_time in range(ntime):
                     source_data = source.variables[variable_name][idx_time, :, :].flatten()[idx_src]
                     weighted_data = np.dot(s, source_data)
                     voutput[idx_time, idx_voutput] = weighted_data
@@ -79,6 +131,140 @@ def create_weighted_output(path_in_esmf_format, path_in_source, path_out_weights
                 output.variables[variable_name][:, section[0]:section[1]] = voutput
         MPI_COMM.Barrier()
 
+    # Entries are only evicted once all ranks are finished with the cache.
+    if weight_cache is not None and MPI_RANK == 0:
+        weight_cache.evict()
+
+
+def get_weights(path_weights):
+    """
+    :param str path_weights: Path to the ESMF weights NetCDF file.
+    :returns: The ``(row, col, S)`` weight vectors.
+    :rtype: tuple (:class:`numpy.ndarray`, :class:`numpy.ndarray`, :class:`numpy.ndarray`)
+    """
+
+    with nc_scope(path_weights) as ds:
+        return tuple([ds.variables[n][:] for n in ('row', 'col', 'S')])
+
+
+class SourceBlockReader(object):
+    """
+    Read blocks of time steps from a source variable keeping only the source elements referenced by a set of weights.
+    The source variable is read sequentially over the span of its first spatial dimension containing the referenced
+    elements.
+
+    >>> reader = SourceBlockReader(ds.variables['pr'], indices, time_block_size=30)
+    >>> for start, stop, block in reader:
+    >>>     print(block.shape)
+    (30, 412)
+
+    :param variable: The source variable with time as the leading dimension.
+    :type variable: :class:`netCDF4.Variable`
+    :param indices: Flattened source element indices referenced by the weights.
+    :type indices: :class:`numpy.ndarray`
+    :param int time_block_size: The number of time steps to read at once. If ``None``, read all time steps at once.
+    """
+
+    def __init__(self, variable, indices, time_block_size=None):
+        self.variable = variable
+        self.ntime = variable.shape[0]
+        self.time_block_size = max(min(time_block_size or self.ntime, self.ntime), 1)
+        self.nbytes_read = 0
+        self.peak_buffer_nbytes = 0
+
+        #: Unique flattened source indices stored in the block buffer.
+        self.columns = np.unique(indices)
+        #: Indices of the weights' source elements in the block buffer.
+        self.buffer_indices = np.searchsorted(self.columns, indices)
+
+        # Number of flattened elements for each index of the first spatial dimension.
+        row_size = int(np.prod(variable.shape[2:]))
+        if self.columns.shape[0] == 0:
+            self._row_slice = slice(0, 0)
+        else:
+            self._row_slice = slice(self.columns[0] // row_size, self.columns[-1] // row_size + 1)
+        self._selection = self.columns - self._row_slice.start * row_size
+        self._buffer = None
+
+    def __iter__(self):
+        for start in range(0, self.ntime, self.time_block_size):
+            stop = min(start + self.time_block_size, self.ntime)
+
+            # Nothing to read if the weights do not reference any source elements.
+            if self.columns.shape[0] == 0:
+                yield start, stop, np.zeros((stop - start, 0), dtype=float)
+                continue
+
+            block = np.ma.getdata(self.variable[start:stop, self._row_slice])
+            block = block.reshape(stop - start, -1)
+            self.nbytes_read += block.nbytes
+
+            # The buffer is allocated once and reused for each block.
+            if self._buffer is None:
+                self._buffer = np.zeros((self.time_block_size, self.columns.shape[0]), dtype=block.dtype)
+            buffer = self._buffer[0:stop - start]
+            np.take(block, self._selection, axis=1, out=buffer)
+            self.peak_buffer_nbytes = max(self.peak_buffer_nbytes, block.nbytes + self._buffer.nbytes)
+
+            yield start, stop, buffer
+
+
+def get_sparse_weights(row, col, S, section):
+    """
+    Create a compressed sparse row (CSR) weight matrix for a section of destination elements.
+
+    :param row: One-based destination indices from the ESMF weights file.
+    :type row: :class:`numpy.ndarray`
+    :param col: Source indices from the ESMF weights file.
+    :type col: :class:`numpy.ndarray`
+    :param S: Weight factors from the ESMF weights file.
+    :type S: :class:`numpy.ndarray`
+    :param section: Two-element sequence ``[start, stop]`` of zero-based destination indices.
+    :type section: sequence
+    :returns: A tuple ``(indptr, indices, data)``. Weights for the local destination element ``i`` are
+     ``data[indptr[i]:indptr[i + 1]]`` applied to source indices ``indices[indptr[i]:indptr[i + 1]]``.
+    :rtype: tuple (:class:`numpy.ndarray`, :class:`numpy.ndarray`, :class:`numpy.ndarray`)
+    """
+
+    row = np.ma.getdata(row)
+    n_dst = section[1] - section[0]
+
+    select = np.logical_and(row > section[0], row <= section[1])
+    local_row = row[select] - section[0] - 1
+    # A stable sort keeps the weight ordering within each row matching the source file.
+    order = np.argsort(local_row, kind='mergesort')
+    indices = np.ma.getdata(col)[select][order]
+    data = np.ma.getdata(S)[select][order]
+
+    indptr = np.zeros(n_dst + 1, dtype=np.int64)
+    np.cumsum(np.bincount(local_row, minlength=n_dst), out=indptr[1:])
+
+    return indptr, indices, data
+
+
+def apply_sparse_weights(sparse_weights, source_data):
+    """
+    Multiply source data by a CSR weight matrix created with :func:`get_sparse_weights`.
+
+    :param tuple sparse_weights: The ``(indptr, indices, data)`` weight matrix.
+    :param source_data: Two-dimensional source data with dimension ``(time, flattened source element)``.
+    :type source_data: :class:`numpy.ndarray`
+    :returns: Weighted data with dimension ``(time, destination element)``. Destination elements without weights are
+     zero.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    indptr, indices, data = sparse_weights
+    n_dst = indptr.shape[0] - 1
+
+    ret = np.zeros((source_data.shape[0], n_dst), dtype=float)
+    has_weights = indptr[:-1] < indptr[1:]
+    if np.any(has_weights):
+        products = np.ma.getdata(source_data)[:, indices] * data
+        # Rows without weights share their start offset with the next row and are excluded from the reduction.
+        ret[:, has_weights] = np.add.reduceat(products, indptr[:-1][has_weights], axis=1)
+    return ret
+
 
 @log_entry_exit
 def validate_weighted_output(path_output_data):
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from utools.constants import UgridToolsConstants
+from utools.logging import log
+
+
+class WeightCache(object):
+    """
+    Persist the rank-partitioned sparse form of ESMF weights files on disk. Entries are directories of ``.npy`` files
+    loaded as memory maps. The least recently used entries are evicted when the cache exceeds its size limit.
+
+    >>> cache = WeightCache('/scratch/weight_cache')
+    >>> key = get_weight_cache_key(path_weights, source_shape, element_count, section)
+    >>> sparse_weights = cache.get(key)
+
+    :param str directory: Path to the cache directory. It is created if it does not exist.
+    :param int max_nbytes: Maximum size of the cache directory in bytes. If ``None``, use
+     :attr:`utools.constants.UgridToolsConstants.WEIGHT_CACHE_MAX_NBYTES`.
+    """
+
+    _names = ('indptr', 'indices', 'data')
+
+    def __init__(self, directory, max_nbytes=None):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_nbytes = max_nbytes or UgridToolsConstants.WEIGHT_CACHE_MAX_NBYTES
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process may have created the directory.
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def get(self, key):
+        """
+        :param str key: The cache key.
+        :returns: The memory-mapped ``(indptr, indices, data)`` sparse weights or ``None`` if the key is not cached.
+        :rtype: tuple
+        """
+
+        path = self._get_entry_path_(key)
+        try:
+            ret = tuple([np.load(os.path.join(path, n + '.npy'), mmap_mode='r') for n in self._names])
+        except IOError:
+            log.debug('weight cache miss: {}'.format(key))
+            ret = None
+        else:
+            log.debug('weight cache hit: {}'.format(key))
+            # The entry modification time tracks its last use.
+            os.utime(path, None)
+        return ret
+
+    def put(self, key, sparse_weights):
+        """
+        :param str key: The cache key.
+        :param tuple sparse_weights: The ``(indptr, indices, data)`` sparse weights to cache.
+        """
+
+        path = self._get_entry_path_(key)
+        if os.path.exists(path):
+            return
+
+        # Write to a temporary directory and rename so readers never see a partial entry.
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            for name, arr in zip(self._names, sparse_weights):
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+            os.rename(tmp, path)
+        except OSError:
+            # Likely written concurrently by another process.
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache size is less than or equal to the size limit.
+
+        :returns: The keys of the removed entries.
+        :rtype: list of str
+        """
+
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            nbytes = sum([os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path)])
+            entries.append((os.path.getmtime(path), nbytes, key))
+        entries.sort()
+
+        total = sum([e[1] for e in entries])
+        ret = []
+        for _, nbytes, key in entries:
+            if total <= self.max_nbytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= nbytes
+            ret.append(key)
+        if len(ret) > 0:
+            log.info('Evicted {} entries from weight cache'.format(len(ret)))
+        return ret
+
+    def _get_entry_path_(self, key):
+        return os.path.join(self.directory, key)
+
+
+def get_weight_cache_key(path_weights, source_shape, element_count, section):
+    """
+    Create a cache key for the sparse weights of a section of destination elements. The weights file is identified by
+    its path, size, and modification time so the file does not need to be read.
+
+    :param str path_weights: Path to the ESMF weights NetCDF file.
+    :param sequence source_shape: Shape of the source grid excluding the time dimension.
+    :param int element_count: Number of elements in the destination ESMF unstructured file.
+    :param sequence section: Two-element sequence ``[start, stop]`` of destination indices.
+    :rtype: str
+    """
+
+    stat = os.stat(path_weights)
+    fingerprint = (os.path.abspath(path_weights), stat.st_size, stat.st_mtime, tuple(source_shape),
+                   int(element_count), tuple(section))
+    return hashlib.sha1(repr(fingerprint)).hexdigest()
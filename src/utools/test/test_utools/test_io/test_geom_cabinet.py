@@ -0,0 +1,176 @@
+import os
+import shutil
+import struct
+import time
+import zipfile
+
+import fiona
+import numpy as np
+from shapely import wkb
+from shapely.geometry import box, MultiPolygon, Polygon, mapping
+
+from utools.io.geom_cabinet import get_columnar_geometries, GeomCabinet, GeomCabinetIterator, get_layer_metadata, \
+    get_columnar_bounds, get_columnar_sizes, get_path_stamp, _LAYER_METADATA
+from utools.test.base import AbstractUToolsTest
+
+
+class Test(AbstractUToolsTest):
+    @property
+    def path_nhd_catchments_texas(self):
+        return os.path.join(self.path_bin, 'nhd_catchments_texas', 'nhd_catchments_texas.shp')
+
+    @property
+    def path_three_polygons(self):
+        return os.path.join(self.path_bin, 'three_polygons', 'three_polygons.shp')
+
+    def test_get_columnar_bounds(self):
+        geoms = [MultiPolygon([box(10, 10, 11, 11), box(12, 12, 13, 14)]), None, box(0, 1, 2, 3)]
+        # A polygon without rings.
+        empty = struct.pack('<BII', 1, 3, 0)
+        block = get_columnar_geometries([wkb.dumps(g) if g is not None else empty for g in geoms])
+
+        actual = get_columnar_bounds(block)
+
+        self.assertEqual(actual[[0, 2]].tolist(), [list(geoms[0].bounds), list(geoms[2].bounds)])
+        self.assertTrue(np.all(np.isnan(actual[1])))
+
+    def test_get_columnar_sizes(self):
+        with_hole = Polygon(box(0, 0, 4, 4).exterior.coords, [box(1, 1, 2, 2).exterior.coords])
+        multi = MultiPolygon([box(10, 10, 11, 11), Polygon([(12, 12), (13, 12), (13, 13)])])
+        empty = struct.pack('<BII', 1, 3, 0)
+        block = get_columnar_geometries([wkb.dumps(with_hole), empty, wkb.dumps(multi)])
+
+        node_counts, part_counts = get_columnar_sizes(block)
+
+        self.assertEqual(node_counts.tolist(), [4, 0, 7])
+        self.assertEqual(part_counts.tolist(), [1, 0, 2])
+
+    def test_get_columnar_geometries(self):
+        with_hole = Polygon(box(0, 0, 4, 4).exterior.coords, [box(1, 1, 2, 2).exterior.coords])
+        multi = MultiPolygon([box(10, 10, 11, 11), box(12, 12, 13, 13)])
+        polygon_z = Polygon([(20, 20, 1), (21, 20, 1), (21, 21, 1), (20, 20, 1)])
+        geoms = [with_hole, multi, polygon_z]
+
+        for big_endian in (False, True):
+            wkbs = [wkb.dumps(g, big_endian=big_endian) for g in geoms]
+
+            actual = get_columnar_geometries(wkbs)
+
+            self.assertEqual(actual['geometry_offsets'].tolist(), [0, 1, 3, 4])
+            self.assertEqual(actual['part_offsets'].tolist(), [0, 2, 3, 4, 5])
+            self.assertEqual(actual['ring_offsets'].tolist(), [0, 5, 10, 15, 20, 24])
+            desired = [with_hole.exterior, with_hole.interiors[0], multi[0].exterior, multi[1].exterior,
+                       polygon_z.exterior]
+            desired = np.vstack([np.array(ring.coords)[:, 0:2] for ring in desired])
+            self.assertNumpyAll(actual['coordinates'], desired)
+
+        # Mixed dimensions are read ring by ring.
+        actual = get_columnar_geometries([wkb.dumps(with_hole), wkb.dumps(polygon_z, big_endian=True)])
+        self.assertEqual(actual['coordinates'].shape, (14, 2))
+        self.assertEqual(actual['coordinates'][-1].tolist(), [20., 20.])
+
+        actual = get_columnar_geometries([])
+        self.assertEqual(actual['coordinates'].shape, (0, 2))
+        self.assertEqual(actual['geometry_offsets'].tolist(), [0])
+
+        with self.assertRaises(ValueError):
+            get_columnar_geometries([wkb.dumps(box(0, 0, 1, 1).exterior)])
+
+    def test_iter_blocks(self):
+        gc = GeomCabinet()
+        desired = list(gc.iter_geoms(path=self.path_three_polygons, uid='SPECIAL'))
+
+        actual = list(gc.iter_blocks('SPECIAL', path=self.path_three_polygons, block_size=2))
+
+        self.assertEqual([b['uid'].shape[0] for b in actual], [2, 1])
+        self.assertEqual(np.hstack([b['uid'] for b in actual]).tolist(),
+                         [d['properties']['SPECIAL'] for d in desired])
+        coordinates = np.vstack([b['coordinates'] for b in actual])
+        self.assertNumpyAll(coordinates, np.vstack([np.array(d['geom'].exterior.coords) for d in desired]))
+
+    def test_iter_blocks_null_geometry(self):
+        path = self.get_temporary_file_path('null_geometry.shp')
+        schema = {'geometry': 'Polygon', 'properties': {'UID': 'int'}}
+        with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema) as sink:
+            sink.write({'geometry': mapping(box(0, 0, 1, 1)), 'properties': {'UID': 1}})
+            sink.write({'geometry': None, 'properties': {'UID': 2}})
+
+        actual = list(GeomCabinet().iter_blocks('UID', path=path))
+
+        self.assertEqual(len(actual), 1)
+        self.assertEqual(actual[0]['uid'].tolist(), [1, 2])
+        node_counts, part_counts = get_columnar_sizes(actual[0])
+        self.assertEqual(node_counts.tolist(), [4, 0])
+        self.assertEqual(part_counts.tolist(), [1, 0])
+        self.assertTrue(np.all(np.isnan(get_columnar_bounds(actual[0])[1])))
+
+    def test_iter_geoms_properties(self):
+        path = self.path_nhd_catchments_texas
+        desired = list(GeomCabinetIterator(path=path, uid='GRIDCODE'))
+        self.assertEqual(desired[0]['properties'].keys(), ['GRIDCODE', 'FEATUREID', 'SOURCEFC', 'AreaSqKM'])
+
+        actual = list(GeomCabinetIterator(path=path, uid='GRIDCODE', properties=['AreaSqKM']))
+        self.assertEqual(len(actual), len(desired))
+        for a, d in zip(actual, desired):
+            self.assertEqual(a['properties'].keys(), ['GRIDCODE', 'AreaSqKM'])
+            self.assertEqual(a['properties']['AreaSqKM'], d['properties']['AreaSqKM'])
+            self.assertTrue(a['geom'].equals(d['geom']))
+
+        actual = list(GeomCabinetIterator(path=path, uid='GRIDCODE', properties=[], load_geoms=False))
+        self.assertEqual([a['properties'].items() for a in actual],
+                         [[('GRIDCODE', d['properties']['GRIDCODE'])] for d in desired])
+        self.assertNotIn('geom', actual[0])
+
+    def test_iter_geoms_slice(self):
+        path = self.path_nhd_catchments_texas
+        desired = [r['properties']['GRIDCODE'] for r in GeomCabinetIterator(path=path, uid='GRIDCODE')]
+
+        for slc in ([0, 5], [10, 20], [40, 43], [42, 50]):
+            actual = [r['properties']['GRIDCODE'] for r in GeomCabinetIterator(path=path, uid='GRIDCODE', slc=slc)]
+            self.assertEqual(actual, desired[slc[0]:slc[1]])
+
+            blocks = GeomCabinet().iter_blocks('GRIDCODE', path=path, slc=slc, block_size=4)
+            self.assertEqual(np.hstack([b['uid'] for b in blocks]).tolist(), desired[slc[0]:slc[1]])
+
+    def test_get_layer_metadata(self):
+        path = self.get_temporary_file_path('three_polygons.shp')
+        for fn in os.listdir(os.path.dirname(self.path_three_polygons)):
+            shutil.copy2(os.path.join(os.path.dirname(self.path_three_polygons), fn), self.path_current_tmp)
+
+        actual = get_layer_metadata(path)
+        self.assertEqual(actual['count'], 3)
+        self.assertEqual(actual['meta']['schema']['properties'].keys(), ['SPECIAL'])
+        self.assertEqual(len(actual['extent']), 4)
+        self.assertEqual(len(GeomCabinetIterator(path=path)), 3)
+
+        # Modifications to the returned metadata do not change the cached metadata.
+        actual['meta']['schema']['properties']['other'] = 'int'
+        self.assertEqual(get_layer_metadata(path)['meta']['schema']['properties'].keys(), ['SPECIAL'])
+
+        # The cached metadata is replaced when the file changes.
+        with fiona.open(path, 'a') as sink:
+            record = next(iter(fiona.open(self.path_three_polygons)))
+            sink.write(record)
+        later = time.time() + 10
+        os.utime(path, (later, later))
+        self.assertEqual(get_layer_metadata(path)['count'], 4)
+        self.assertEqual(get_layer_metadata(path, bcast=True)['count'], 4)
+
+    def test_get_layer_metadata_without_files(self):
+        # Sources without files on disk (i.e. database connection strings or virtual file system paths) are read
+        # without caching.
+        self.assertIsNone(get_path_stamp('PG:dbname=catchments'))
+        self.assertIsNone(get_path_stamp(self.path_current_tmp))
+
+        path_zip = self.get_temporary_file_path('three_polygons.zip')
+        with zipfile.ZipFile(path_zip, 'w') as archive:
+            directory = os.path.dirname(self.path_three_polygons)
+            for fn in os.listdir(directory):
+                archive.write(os.path.join(directory, fn), fn)
+        path = '/vsizip/{}/three_polygons.shp'.format(path_zip)
+
+        actual = get_layer_metadata(path)
+        self.assertEqual(actual['count'], 3)
+        self.assertIsNone(actual['stamp'])
+        self.assertNotIn((os.path.abspath(path), None), _LAYER_METADATA)
+        self.assertEqual(get_layer_metadata(path, bcast=True)['count'], 3)
@@ -1,13 +1,20 @@
 import os
+import shutil
+import tempfile
+import time
 
+import fiona
 from osgeo import osr
 from shapely.geometry import MultiPolygon
 from shapely.geometry import Polygon
 
-from utools.io.core import get_flexible_mesh
-from utools.io.geom_manager import GeometryManager
-from utools.io.helpers import convert_collection_to_esmf_format
-from utools.test.base import AbstractUToolsTest
+from utools.constants import UgridToolsConstants
+from utools.io import geom_manager
+from utools.io.core import get_flexible_mesh, from_shapefile
+from utools.io.geom_manager import GeometryManager, GeometryCache
+from utools.io.helpers import convert_collection_to_esmf_format, get_rtree_path, create_rtree_file
+from utools.io.mpi import MPI_COMM, MPI_RANK
+from utools.test.base import AbstractUToolsTest, attr
 
 
 class TestGeomManager(AbstractUToolsTest):
@@ -15,6 +22,134 @@ class TestGeomManager(AbstractUToolsTest):
     def path_nhd_catchments_texas(self):
         return os.path.join(self.path_bin, 'nhd_catchments_texas', 'nhd_catchments_texas.shp')
 
+    def test_geometry_cache(self):
+        polygons = [Polygon([(ii, 0), (ii + 1, 0), (ii + 1, 1)]) for ii in range(3)]
+        records = [{'geom': p, 'properties': {'UID': ii}} for ii, p in enumerate(polygons)]
+        # Each triangle has four coordinates.
+        cache = GeometryCache(128)
+        for record in records:
+            cache.put(record['properties']['UID'], record)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 128)
+        self.assertNotIn(0, cache)
+
+        # Using an entry protects it from eviction.
+        actual = cache.get(1)
+        actual['properties']['UID'] = 10
+        self.assertEqual(cache.get(1)['properties']['UID'], 1)
+        cache.put(0, records[0])
+        self.assertEqual(sorted(cache._records.keys()), [0, 1])
+
+        # Entries larger than the budget are not cached.
+        cache = GeometryCache(32)
+        cache.put(0, records[0])
+        self.assertEqual(len(cache), 0)
+
+    def test_iter_records_geometry_cache(self):
+        path = self.path_nhd_catchments_texas
+        gm = GeometryManager('GRIDCODE', path=path, allow_multipart=True)
+        desired = {uid: record for uid, record in gm.iter_records(return_uid=True)}
+        select_uid = sorted(desired.keys())[10:20]
+
+        gm = GeometryManager('GRIDCODE', path=path, allow_multipart=True, geometry_cache_nbytes=10 ** 8)
+        sliced_uid = [uid for uid, _ in gm.iter_records(return_uid=True, slc=[0, 15])]
+        self.assertEqual(len(gm.geometry_cache), len(set(sliced_uid)))
+        for _ in range(2):
+            actual = list(gm.iter_records(return_uid=True, select_uid=select_uid))
+            self.assertEqual([a[0] for a in actual], select_uid)
+            for uid, record in actual:
+                self.assertTrue(record['geom'].equals(desired[uid]['geom']))
+                self.assertEqual(record['properties'], desired[uid]['properties'])
+        self.assertEqual(len(gm.geometry_cache), len(set(sliced_uid + select_uid)))
+
+    def test_from_shapefile_geometry_cache(self):
+        src = os.path.dirname(self.path_nhd_catchments_texas)
+        for fn in os.listdir(src):
+            shutil.copy2(os.path.join(src, fn), self.path_current_tmp)
+        path = self.get_temporary_file_path(os.path.basename(self.path_nhd_catchments_texas))
+        desired = from_shapefile(path, 'GRIDCODE', allow_multipart=True, use_ragged_arrays=True)
+
+        caches = []
+
+        class CountingGeometryCache(GeometryCache):
+            def __init__(self, *args, **kwargs):
+                super(CountingGeometryCache, self).__init__(*args, **kwargs)
+                caches.append(self)
+
+        geom_manager.GeometryCache = CountingGeometryCache
+        try:
+            actual = from_shapefile(path, 'GRIDCODE', allow_multipart=True, use_ragged_arrays=True,
+                                    geometry_cache_nbytes=10 ** 8)
+        finally:
+            geom_manager.GeometryCache = GeometryCache
+
+        # Touching faces are found using the cached neighbor geometries.
+        self.assertEqual(len(caches), 1)
+        self.assertGreater(caches[0].hits, 0)
+        self.assertEqual([a.tolist() for a in actual['face_links']], [d.tolist() for d in desired['face_links']])
+
+    @attr('mpi')
+    def test_get_spatial_index(self):
+        # All ranks use the same copy of the source.
+        if MPI_RANK == 0:
+            src = os.path.dirname(self.path_nhd_catchments_texas)
+            for fn in os.listdir(src):
+                shutil.copy2(os.path.join(src, fn), self.path_current_tmp)
+        path = MPI_COMM.bcast(self.get_temporary_file_path(os.path.basename(self.path_nhd_catchments_texas)))
+
+        gm = GeometryManager('GRIDCODE', path=path, allow_multipart=True)
+        si = gm.get_spatial_index()
+        path_rtree = get_rtree_path(gm)
+        self.assertTrue(os.path.exists(path_rtree + '.idx'))
+
+        records = []
+        with fiona.open(path) as source:
+            for record in source:
+                records.append({'geometry': record['geometry'], 'properties': dict(record['properties'])})
+        desired_si = GeometryManager('GRIDCODE', records=records, allow_multipart=True).get_spatial_index()
+        for record in GeometryManager('GRIDCODE', records=records, allow_multipart=True).iter_records():
+            actual = sorted(si.iter_rtree_intersection(record['geom']))
+            self.assertEqual(actual, sorted(desired_si.iter_rtree_intersection(record['geom'])))
+            self.assertIn(record['properties']['GRIDCODE'], actual)
+
+        # The index is reused if the source is unchanged and rebuilt otherwise.
+        MPI_COMM.Barrier()
+        mtime = os.path.getmtime(path_rtree + '.json')
+        gm.get_spatial_index()
+        self.assertEqual(os.path.getmtime(path_rtree + '.json'), mtime)
+        MPI_COMM.Barrier()
+        if MPI_RANK == 0:
+            later = time.time() + 10
+            os.utime(path, (later, later))
+        MPI_COMM.Barrier()
+        gm.get_spatial_index()
+        with open(path_rtree + '.json') as f:
+            self.assertIn(str(int(os.path.getmtime(path))), f.read())
+        MPI_COMM.Barrier()
+
+    @attr('mpi')
+    def test_get_spatial_index_not_writable(self):
+        # A source in a directory that is not writable (or does not exist) is indexed in the fallback directory.
+        gm = GeometryManager('GRIDCODE', path='/proc/utools/catchments.shp')
+        actual = get_rtree_path(gm)
+        directory = UgridToolsConstants.RTREE_DIRECTORY or os.path.join(tempfile.gettempdir(), 'utools_rtree')
+        self.assertEqual(os.path.dirname(actual), directory)
+        self.assertTrue(os.path.basename(actual).startswith('catchments.'))
+
+        # The index is built in memory if it cannot be written.
+        path_file = MPI_COMM.bcast(self.get_temporary_file_path('file.txt'))
+        if MPI_RANK == 0:
+            open(path_file, 'w').close()
+        MPI_COMM.Barrier()
+        path_rtree = os.path.join(path_file, 'nhd_catchments_texas')
+        gm = GeometryManager('GRIDCODE', path=self.path_nhd_catchments_texas, allow_multipart=True)
+        si = create_rtree_file(gm, path_rtree)
+        self.assertFalse(os.path.exists(path_rtree + '.idx'))
+        records = list(gm.iter_records(return_uid=True))
+        for uid, record in records[0:5]:
+            self.assertIn(uid, list(si.iter_rtree_intersection(record['geom'])))
+        MPI_COMM.Barrier()
+
     def test_system_converting_coordinate_system(self):
         dest_crs_wkt = 'PROJCS["Sphere_Lambert_Conformal_Conic",GEOGCS["WGS 84",DATUM["unknown",SPHEROID["WGS84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]],PROJECTION["Lambert_Conformal_Conic_2SP"],PARAMETER["standard_parallel_1",30],PARAMETER["standard_parallel_2",60],PARAMETER["latitude_of_origin",40.0000076294],PARAMETER["central_meridian",-97],PARAMETER["false_easting",0],PARAMETER["false_northing",0],UNIT["Meter",1]]'
         sr = osr.SpatialReference()
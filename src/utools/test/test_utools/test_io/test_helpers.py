@@ -0,0 +1,383 @@
+import itertools
+import os
+import struct
+from collections import OrderedDict
+from unittest import SkipTest
+
+import fiona
+import netCDF4 as nc
+import numpy as np
+from shapely import wkb
+from shapely.geometry import box, MultiPolygon
+
+from utools.constants import UgridToolsConstants
+from utools.io.core import get_flexible_mesh
+from utools.io.geom_cabinet import get_columnar_geometries, get_columnar_sizes
+from utools.io.geom_manager import GeometryManager
+from utools.io.helpers import get_face_links_from_nodes, get_mapped_face_links, get_distributed_face_links, \
+    get_coordinate_dict_variables, get_packed_nodes, get_unique_rows, get_face_nodes_from_element_conn, \
+    get_node_counts, get_shapefile_node_counts, get_section_costs, get_variables, get_node_count, \
+    convert_collection_to_esmf_format, get_node_count_report, get_bounds_from_1d, get_extrapolated_corners_esmf, \
+    get_ocgis_corners_from_esmf_corners, get_esmf_format_sizes, get_esmf_format_nbytes, get_esmf_format_profile, \
+    get_float32_errors, check_float32_errors, get_halo_faces, get_connection_counts
+from utools.io.mpi import create_sections, MPI_SIZE, MPI_RANK, MPI_COMM, MPI_ENABLED
+from utools.profile.corners import get_bounds_from_1d_loop, get_extrapolated_corners_esmf_loop, \
+    get_ocgis_corners_from_esmf_corners_loop
+from utools.test.base import AbstractUToolsTest, attr
+
+
+class Test(AbstractUToolsTest):
+    def get_grid_polygons(self, n=3):
+        return [box(x, y, x + 1, y + 1) for y, x in itertools.product(range(n), range(n))]
+
+    def get_coordinates(self, polygons):
+        return [[np.array(p.exterior.coords)[0:-1]] for p in polygons]
+
+    @attr('mpi')
+    def test_convert_collection_to_esmf_format_parallel(self):
+        if not MPI_ENABLED or not (nc.__has_parallel4_support__ or nc.__has_pnetcdf_support__):
+            raise SkipTest('"netCDF4" parallel I/O support is required.')
+
+        records = [{'geom': p, 'properties': {'UID': ii}} for ii, p in enumerate(self.get_grid_polygons(n=4))]
+        gm = GeometryManager('UID', records=records)
+        coll = get_flexible_mesh(gm, 'mesh', True, with_connectivity=False, esmf_layout=True)
+
+        # All ranks write to the same files.
+        paths = MPI_COMM.bcast([self.get_temporary_file_path(fn) for fn in ('serial.nc', 'parallel.nc')])
+        for path, parallel in zip(paths, (False, True)):
+            convert_collection_to_esmf_format(coll, path, polygon_break_value=-8, face_uid_name='UID',
+                                              parallel=parallel)
+        MPI_COMM.Barrier()
+
+        if MPI_RANK == 0:
+            self.assertNcEqual(paths[0], paths[1])
+        MPI_COMM.Barrier()
+
+    @attr('mpi')
+    def test_convert_collection_to_esmf_format_profile(self):
+        records = [{'geom': p, 'properties': {'UID': ii}} for ii, p in enumerate(self.get_grid_polygons(n=4))]
+        gm = GeometryManager('UID', records=records)
+        coll = get_flexible_mesh(gm, 'mesh', True, with_connectivity=False, esmf_layout=True)
+
+        profiles = [None, 'fast-write', 'small-file', 'esmf-read-optimized']
+        paths = MPI_COMM.bcast([self.get_temporary_file_path('{}.nc'.format(p)) for p in profiles])
+        for path, profile in zip(paths, profiles):
+            convert_collection_to_esmf_format(coll, path, polygon_break_value=-8, face_uid_name='UID', profile=profile)
+        MPI_COMM.Barrier()
+
+        if MPI_RANK == 0:
+            for path in paths[1:]:
+                self.assertNcEqual(paths[0], path)
+            with nc.Dataset(paths[1]) as ds:
+                self.assertEqual(ds.variables['elementConn'].chunking(), 'contiguous')
+                self.assertFalse(ds.variables['elementConn'].filters()['zlib'])
+            with nc.Dataset(paths[2]) as ds:
+                var = ds.variables['nodeCoords']
+                self.assertEqual(var.filters()['complevel'], 9)
+                self.assertTrue(var.filters()['shuffle'])
+                # Chunks are clipped to the dimension size.
+                self.assertEqual(var.chunking(), [len(ds.dimensions['nodeCount']), 2])
+        MPI_COMM.Barrier()
+
+        with self.assertRaises(ValueError):
+            convert_collection_to_esmf_format(coll, paths[0], profile='unknown')
+
+    def test_get_bounds_from_1d(self):
+        actual = get_bounds_from_1d(np.array([1., 2., 3.]))
+        self.assertEqual(actual.tolist(), [[0.5, 1.5], [1.5, 2.5], [2.5, 3.5]])
+
+        vectors = [np.array([1, 2]), np.linspace(60., -20.5, 37), np.linspace(-133.5, -60.5, 461, dtype=np.float32)]
+        for centroids in vectors:
+            self.assertNumpyAll(get_bounds_from_1d(centroids), get_bounds_from_1d_loop(centroids))
+
+    @attr('mpi')
+    def test_get_coordinate_dict_variables(self):
+        cdict = OrderedDict()
+        cdict[5] = [np.array([[1., 2], [3., 4.], [5., 6.]]), np.array([[1., 2], [3., 4.], [5., 6.], [7., 8.]])]
+        cdict[6] = [np.array([[9., 10.], [11., 12.], [13., 14.]])]
+
+        element_conn, num_element_conn, coordinates, edge_nodes = get_coordinate_dict_variables(cdict, 10,
+                                                                                                idx_start=3)
+
+        self.assertEqual(element_conn.dtype, np.int32)
+        self.assertEqual(element_conn.tolist(), [3, 4, 5, -8, 6, 7, 8, 9, 10, 11, 12])
+        self.assertEqual(num_element_conn.tolist(), [8, 3])
+        self.assertNumpyAll(coordinates, np.vstack(cdict[5] + cdict[6]))
+        self.assertEqual(edge_nodes.tolist(), [[3, 4], [4, 5], [5, 3], [6, 7], [7, 8], [8, 9], [9, 6], [10, 11],
+                                               [11, 12], [12, 10]])
+
+        face_nodes = get_face_nodes_from_element_conn(element_conn, num_element_conn)
+        self.assertEqual([f.tolist() for f in face_nodes], [[3, 4, 5, -8, 6, 7, 8, 9], [10, 11, 12]])
+
+    @attr('mpi')
+    def test_get_distributed_face_links(self):
+        polygons = self.get_grid_polygons(n=6)
+        coordinates = self.get_coordinates(polygons)
+        desired = get_face_links_from_nodes(coordinates)
+
+        section = create_sections(len(polygons), size=MPI_SIZE)[MPI_RANK]
+        actual = get_distributed_face_links(coordinates[section[0]:section[1]], section)
+
+        self.assertEqual(actual.shape[0], section[1] - section[0])
+        for a, d in zip(actual, desired[section[0]:section[1]]):
+            self.assertEqual(a.tolist(), d.tolist())
+
+    @attr('mpi')
+    def test_get_distributed_face_links_interleaved(self):
+        # Columns of four faces are assigned to ranks in turn so every rank's extent covers the whole grid. Each rank
+        # owns two blocks of columns.
+        polygons = [box(x, y, x + 1, y + 1) for y in range(4) for x in range(8 * MPI_SIZE)]
+        owner = [(int(p.bounds[0]) // 4) % MPI_SIZE for p in polygons]
+        order = sorted(range(len(polygons)), key=lambda ii: owner[ii])
+        polygons = [polygons[ii] for ii in order]
+        owner = [owner[ii] for ii in order]
+        start = owner.index(MPI_RANK)
+        section = [start, start + owner.count(MPI_RANK)]
+        coordinates = self.get_coordinates(polygons)
+
+        actual = get_distributed_face_links(coordinates[section[0]:section[1]], section)
+
+        desired = get_face_links_from_nodes(coordinates)
+        for a, d in zip(actual, desired[section[0]:section[1]]):
+            self.assertEqual(a.tolist(), d.tolist())
+
+        # Only faces with bounds intersecting another rank's face bounds are sent to that rank.
+        face_bounds = np.array([p.bounds for p in polygons[section[0]:section[1]]])
+        actual = get_halo_faces(face_bounds, grid_size=8)
+        self.assertEqual(len(actual), MPI_SIZE)
+        for rank in range(MPI_SIZE):
+            desired = []
+            if rank != MPI_RANK:
+                others = [polygons[ii] for ii in range(len(polygons)) if owner[ii] == rank]
+                desired = [ii for ii, p in enumerate(polygons[section[0]:section[1]])
+                           if any([box(*p.bounds).intersects(box(*o.bounds)) for o in others])]
+            self.assertEqual(actual[rank].tolist(), desired)
+            # Faces in the middle two columns of a block are never halo faces.
+            self.assertLessEqual(len(desired), (section[1] - section[0]) // 2)
+
+    @attr('mpi')
+    def test_get_node_counts(self):
+        polygons = [box(0, 0, 1, 1), box(1, 0, 2, 1).buffer(1), box(2, 0, 3, 1)]
+        records = [{'geom': p, 'properties': {'UID': ii}} for ii, p in enumerate(polygons)]
+        gm = GeometryManager('UID', records=records)
+
+        actual = get_node_counts(gm)
+
+        self.assertEqual(actual.tolist(), [get_node_count(p) for p in polygons])
+
+    def test_get_node_count_report(self):
+        actual = get_node_count_report([5, 6, 14, 15], bins=2)
+        self.assertEqual(actual.splitlines(), ['Node count histogram (4 elements, max=15):', '  [5, 10]: 2',
+                                               '  [10, 15]: 2'])
+        self.assertIn('no elements', get_node_count_report([]))
+
+    def test_get_section_costs(self):
+        actual = get_section_costs([10, 1000, 10000])
+        self.assertNumpyAll(actual, np.array([10.1, 2000., 110000.]))
+
+    def test_get_shapefile_node_counts(self):
+        path = os.path.join(self.path_bin, 'three_polygons', 'three_polygons.shp')
+
+        actual = get_shapefile_node_counts(path)
+
+        with fiona.open(path) as source:
+            desired = [sum([len(ring) for ring in record['geometry']['coordinates']]) for record in source]
+        self.assertEqual(actual.tolist(), desired)
+
+    @attr('mpi')
+    def test_get_variables_balance(self):
+        # The first face is much more expensive to convert than the others. There are four faces per rank so the even
+        # split leaves no rank empty.
+        polygons = [box(0, 0, 1, 1).buffer(1, resolution=256)] + \
+                   [box(ii, 2, ii + 1, 3) for ii in range(4 * MPI_SIZE - 1)]
+        records = [{'geom': p, 'properties': {'UID': ii + 10}} for ii, p in enumerate(polygons)]
+
+        actual = {}
+        for balance in (False, True):
+            gm = GeometryManager('UID', records=[dict(r) for r in records])
+            result = get_variables(gm, with_connectivity=False, use_ragged_arrays=True, esmf_layout=True,
+                                   balance=balance)
+            face_ids, section, num_element_conn = result[5], result[8], result[10]
+            if balance and MPI_SIZE > 1 and MPI_RANK == 0:
+                self.assertEqual(section, [0, 1])
+            actual[balance] = [np.hstack(MPI_COMM.allgather(a)).tolist() for a in (face_ids, num_element_conn)]
+
+        self.assertEqual(actual[True], actual[False])
+        self.assertEqual(actual[True][0], range(10, 10 + len(polygons)))
+
+    @attr('mpi')
+    def test_get_packed_nodes(self):
+        polygons = self.get_grid_polygons(n=4)
+        section = create_sections(len(polygons), size=MPI_SIZE)[MPI_RANK]
+        cdict = OrderedDict()
+        for idx, coords in enumerate(self.get_coordinates(polygons)[section[0]:section[1]]):
+            cdict[idx] = coords
+        n_coords = sum([c[0].shape[0] for c in cdict.values()])
+        element_conn, num_element_conn, coordinates, edge_nodes = get_coordinate_dict_variables(cdict, n_coords)
+
+        element_conn, coordinates, edge_nodes = get_packed_nodes(element_conn, coordinates, edge_nodes)
+
+        all_coordinates = np.vstack(MPI_COMM.allgather(coordinates))
+        self.assertEqual(all_coordinates.shape, (25, 2))
+        self.assertEqual(len(set(map(tuple, all_coordinates.tolist()))), 25)
+        for fn, coords in zip(get_face_nodes_from_element_conn(element_conn, num_element_conn), cdict.values()):
+            self.assertEqual(fn.dtype, np.int32)
+            self.assertNumpyAll(all_coordinates[fn], coords[0])
+        self.assertNumpyAll(all_coordinates[edge_nodes[:, 0]], np.vstack([c[0] for c in cdict.values()]))
+
+    def test_get_unique_rows(self):
+        arr = np.array([[2., 1.], [1., 5.], [2., 1.], [1., 2.]])
+        unique, index, inverse = get_unique_rows(arr)
+        self.assertEqual(unique.tolist(), [[1., 2.], [1., 5.], [2., 1.]])
+        self.assertEqual(index.tolist(), [3, 1, 0])
+        self.assertEqual(inverse.tolist(), [2, 1, 2, 0])
+
+    @attr('mpi')
+    def test_get_esmf_format_sizes(self):
+        path = os.path.join(self.path_bin, 'nhd_catchments_texas', 'nhd_catchments_texas.shp')
+
+        def get_records():
+            # Managers modify their records so each manager gets a new list.
+            ret = []
+            with fiona.open(path) as source:
+                for record in source:
+                    ret.append({'geometry': record['geometry'], 'properties': dict(record['properties'])})
+            return ret
+
+        for node_threshold in (None, 600):
+            desired = GeometryManager('GRIDCODE', records=get_records(), allow_multipart=True,
+                                      node_threshold=node_threshold)
+            desired = get_variables(desired, use_ragged_arrays=True, with_connectivity=False, esmf_layout=True)
+            element_conn, num_element_conn = desired[9], desired[10]
+            desired = [MPI_COMM.allreduce(desired[3].shape[0]), MPI_COMM.allreduce(num_element_conn.shape[0]),
+                       MPI_COMM.allreduce(element_conn.shape[0])]
+
+            for kwds in [{'path': path}, {'records': get_records()}]:
+                gm = GeometryManager('GRIDCODE', allow_multipart=True, node_threshold=node_threshold, **kwds)
+                actual = get_esmf_format_sizes(gm, block_size=7)
+                self.assertEqual(actual, desired)
+
+        self.assertEqual(get_esmf_format_nbytes([10, 2, 11]), 10 * 16 + 2 * 32 + 11 * 4)
+
+    def test_get_connection_counts(self):
+        multi = MultiPolygon([box(10, 10, 11, 11), box(12, 12, 13, 13)])
+        # A polygon without rings.
+        empty = struct.pack('<BII', 1, 3, 0)
+        block = get_columnar_geometries([wkb.dumps(box(0, 0, 1, 1)), empty, wkb.dumps(multi)])
+
+        actual = get_connection_counts(*get_columnar_sizes(block))
+
+        self.assertEqual(actual.tolist(), [4, 0, 9])
+        self.assertEqual(get_connection_counts(0, 0), 0)
+
+    def test_get_esmf_format_profile(self):
+        actual = get_esmf_format_profile(None, [10, 2, 11])
+        self.assertIsNone(actual.format)
+        self.assertTrue(actual.fill)
+        self.assertEqual(actual.variables['elementConn'], {})
+
+        # Unlimited dimensions are always chunked.
+        actual = get_esmf_format_profile('fast-write', [None, None, None], face_uid_name='UID')
+        self.assertEqual(actual.format, 'NETCDF4')
+        self.assertFalse(actual.fill)
+        self.assertEqual(actual.variables['UID'], {'chunksizes': (UgridToolsConstants.STREAM_CHUNK_SIZE,)})
+        actual = get_esmf_format_profile('fast-write', [10, 2, 11])
+        self.assertEqual(actual.variables['nodeCoords'], {'contiguous': True})
+
+        actual = get_esmf_format_profile('esmf-read-optimized', [10, 0, None])
+        self.assertEqual(actual.variables['nodeCoords'],
+                         {'zlib': True, 'shuffle': True, 'complevel': 1, 'chunksizes': (10, 2)})
+        self.assertEqual(actual.variables['elementArea']['chunksizes'], (1,))
+        self.assertEqual(actual.variables['elementConn']['chunksizes'], (2 ** 21,))
+
+        with self.assertRaises(ValueError):
+            get_esmf_format_profile('unknown', [10, 2, 11])
+
+    @attr('mpi')
+    def test_get_float32_errors(self):
+        nodes = np.array([[1., 0.5], [-105.123456789, 30.1]])
+        face_coordinates = np.array([[2. ** 24 + 1, 0.]])
+        face_areas = np.array([0., 1. + 2. ** -30])
+
+        actual = get_float32_errors(nodes, face_coordinates, face_areas)
+        self.assertEqual(actual.keys(), ['nodeCoords', 'centerCoords', 'elementArea'])
+        self.assertAlmostEqual(actual['nodeCoords'], abs(np.float32(-105.123456789) - -105.123456789))
+        self.assertEqual(actual['centerCoords'], 1.)
+        self.assertEqual(actual['elementArea'], 2. ** -30 / (1. + 2. ** -30))
+
+        empty = get_float32_errors(np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0))
+        self.assertEqual(empty.values(), [0., 0., 0.])
+        actual = get_float32_errors(np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0), errors=actual)
+        self.assertEqual(actual['centerCoords'], 1.)
+
+        # Only the coordinate errors are checked against the tolerance.
+        errors = check_float32_errors(get_float32_errors(nodes, nodes, face_areas), 1e-5)
+        self.assertEqual(errors.keys(), actual.keys())
+        with self.assertRaises(ValueError):
+            check_float32_errors(actual, 1e-5)
+
+    def test_get_extrapolated_corners_esmf(self):
+        rs = np.random.RandomState(1)
+        lon = np.linspace(-133.5, -60.5, 47)
+        lat = np.linspace(20., 57.5, 31)
+        arrs = [np.meshgrid(lon, lat)[0], np.meshgrid(lon, lat[::-1])[1], np.meshgrid(lon[::-1], lat)[0]]
+        arrs.append(rs.rand(13, 9).astype(np.float32))
+
+        for arr in arrs:
+            actual = get_extrapolated_corners_esmf(arr)
+            self.assertNumpyAll(actual, get_extrapolated_corners_esmf_loop(arr))
+
+            actual = get_ocgis_corners_from_esmf_corners(actual)
+            self.assertEqual(actual.shape, arr.shape + (4,))
+            self.assertNumpyAll(actual, get_ocgis_corners_from_esmf_corners_loop(get_extrapolated_corners_esmf(arr)))
+
+        # Vectors use the bounds of the centroids.
+        actual = get_extrapolated_corners_esmf(np.array([[1., 2., 3.]]))
+        self.assertEqual(actual.tolist(), [[0.5, 1.5, 2.5, 3.5]] * 2)
+
+    def test_get_face_links_from_nodes(self):
+        polygons = self.get_grid_polygons()
+        # This polygon is disconnected from the grid.
+        polygons.append(box(10, 10, 11, 11))
+
+        actual = get_face_links_from_nodes(self.get_coordinates(polygons))
+
+        self.assertEqual(actual.dtype, object)
+        for idx, p in enumerate(polygons):
+            desired = [ii for ii, other in enumerate(polygons) if p.touches(other)]
+            if len(desired) == 0:
+                desired = [-1]
+            self.assertEqual(actual[idx].tolist(), desired)
+            self.assertEqual(actual[idx].dtype, np.int32)
+        self.assertEqual(actual[4].tolist(), [0, 1, 2, 3, 5, 6, 7, 8])
+
+        # At a T-junction the faces share part of an edge but no node. Only the default "touches" method links them.
+        polygons = [box(0, 0, 3, 1), box(1, 1, 2, 2)]
+        actual = get_face_links_from_nodes(self.get_coordinates(polygons))
+        self.assertEqual([a.tolist() for a in actual], [[-1], [-1]])
+        if MPI_SIZE == 1:
+            records = [{'geom': p, 'properties': {'UID': ii}} for ii, p in enumerate(polygons)]
+            desired = {None: [[1], [0]], 'touches': [[1], [0]], 'nodes': [[-1], [-1]]}
+            for method, links in desired.items():
+                kwds = {} if method is None else {'connectivity_method': method}
+                result = get_variables(GeometryManager('UID', records=records), use_ragged_arrays=True, **kwds)
+                self.assertEqual([a.tolist() for a in result[4]], links)
+
+    def test_get_face_links_from_nodes_multipart(self):
+        # The first face has two parts with one part touching the second face. The shared node between the parts of the
+        # first face does not create a self-link.
+        coordinates = [[np.array([[0., 0.], [1., 0.], [1., 1.]]), np.array([[1., 1.], [2., 1.], [2., 2.]])],
+                       [np.array([[2., 2.], [3., 2.], [3., 3.]])],
+                       [np.array([[1.000000001, 0.], [2., 0.], [1., -1.]])]]
+
+        actual = get_face_links_from_nodes(coordinates)
+        self.assertEqual([a.tolist() for a in actual], [[1, 2], [0], [0]])
+
+        actual = get_face_links_from_nodes(coordinates, decimals=10)
+        self.assertEqual([a.tolist() for a in actual], [[1], [0], [-1]])
+
+    def test_get_mapped_face_links(self):
+        face_ids = np.array([30, 10, 20])
+        face_links = {30: [10, 20], 10: [30], 20: [-1]}
+        actual = get_mapped_face_links(face_ids, face_links)
+        self.assertEqual([a.tolist() for a in actual], [[1, 2], [0], [-1]])
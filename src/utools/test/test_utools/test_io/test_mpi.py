@@ -0,0 +1,42 @@
+import numpy as np
+
+from utools.io.mpi import create_sections, get_offsets, MPI_RANK, MPI_SIZE
+from utools.test.base import AbstractUToolsTest, attr
+
+
+class Test(AbstractUToolsTest):
+    def test_create_sections(self):
+        actual = create_sections(10, size=3)
+        self.assertEqual(actual, [[0, 4], [4, 8], [8, 10]])
+
+        actual = create_sections(2, size=3)
+        self.assertEqual(actual, [[0, 1], [1, 2], [2, 2]])
+
+    def test_create_sections_weights(self):
+        actual = create_sections(10, size=3, weights=np.ones(10))
+        self.assertEqual(actual, [[0, 3], [3, 7], [7, 10]])
+
+        weights = np.ones(10)
+        weights[-1] = 8
+        actual = create_sections(10, size=3, weights=weights)
+        self.assertEqual(actual, [[0, 6], [6, 9], [9, 10]])
+
+        # Each section contains at least one element.
+        actual = create_sections(5, size=4, weights=[100, 0, 0, 0, 0])
+        self.assertEqual(actual, [[0, 1], [1, 2], [2, 3], [3, 5]])
+
+        # Fall back to even splits when there are fewer elements than sections.
+        actual = create_sections(2, size=3, weights=[1, 1])
+        self.assertEqual(actual, [[0, 1], [1, 2], [2, 2]])
+
+    @attr('mpi')
+    def test_get_offsets(self):
+        # Rank r has r + 1 nodes and 2 * r elements.
+        actual = get_offsets([MPI_RANK + 1, 2 * MPI_RANK])
+        starts = [sum(range(1, MPI_RANK + 1)), sum(range(0, 2 * MPI_RANK, 2))]
+        totals = [sum(range(1, MPI_SIZE + 1)), sum(range(0, 2 * MPI_SIZE, 2))]
+        self.assertEqual(actual[0].tolist(), starts)
+        self.assertEqual(actual[1].tolist(), totals)
+
+        actual = get_offsets(3)
+        self.assertEqual(actual, (3 * MPI_RANK, 3 * MPI_SIZE))
@@ -0,0 +1,46 @@
+import itertools
+
+import numpy as np
+from shapely.geometry import box, Point
+
+from utools.io.spatial_index import SpatialIndex
+from utools.test.base import AbstractUToolsTest
+
+
+class Test(AbstractUToolsTest):
+    def get_spatial_index(self):
+        geoms = {}
+        for ii, (y, x) in enumerate(itertools.product(range(3), range(3))):
+            geoms[ii + 10] = box(x, y, x + 1, y + 1)
+        si = SpatialIndex()
+        si.add(geoms.keys(), geoms.values())
+        return si, geoms
+
+    def test_query(self):
+        si, geoms = self.get_spatial_index()
+        query_geoms = [Point(0.5, 0.5).buffer(0.6), box(1.2, 1.2, 1.8, 1.8)]
+
+        query_index, uids = si.query(query_geoms, geoms)
+        actual = sorted(zip(query_index.tolist(), uids.tolist()))
+        self.assertEqual(actual, [(0, 10), (0, 11), (0, 13), (1, 14)])
+
+        # The buffered point's bounding box touches the corner of a box it does not intersect.
+        query_index, uids = si.query(query_geoms, geoms, predicate=None)
+        self.assertIn((0, 14), zip(query_index.tolist(), uids.tolist()))
+
+        query_index, uids = si.query([box(0, 0, 2, 2)], geoms, predicate='contains')
+        self.assertEqual(sorted(uids.tolist()), [10, 11, 13, 14])
+
+        query_index, uids = si.query([], geoms)
+        self.assertEqual(query_index.shape, (0,))
+
+    def test_query_bounds(self):
+        si, _ = self.get_spatial_index()
+        bounds = np.array([[0.1, 0.1, 0.2, 0.2], [10, 10, 11, 11], [1.5, 0.5, 2.5, 0.6]])
+
+        query_index, uids = si.query_bounds(bounds)
+
+        self.assertEqual(query_index.dtype, np.int64)
+        self.assertEqual(query_index.tolist(), [0, 2, 2])
+        self.assertEqual(uids[0], 10)
+        self.assertEqual(sorted(uids[1:].tolist()), [11, 12])
@@ -1,15 +1,19 @@
 import os
+from multiprocessing import Pool
 from unittest import SkipTest
 
 import fiona
 import numpy as np
 from shapely import wkt
-from shapely.geometry import shape
+from shapely.geometry import shape, box, Polygon, mapping
 
 from utools.helpers import write_fiona
+from utools.io import geom_manager
+from utools.io.core import get_flexible_mesh
 from utools.io.geom_manager import GeometryManager
-from utools.io.helpers import get_split_polygon_by_node_threshold
-from utools.io.mpi import MPI_RANK, MPI_COMM
+from utools.io.helpers import get_split_polygon_by_node_threshold, get_node_count, get_split_polygons, \
+    convert_to_esmf_format_stream, convert_collection_to_esmf_format
+from utools.io.mpi import MPI_RANK, MPI_COMM, MPI_SIZE
 from utools.prep.prep_shapefiles import convert_to_esmf_format
 from utools.test import long_lines
 from utools.test.base import AbstractUToolsTest, attr
@@ -60,6 +64,128 @@ class Test(AbstractUToolsTest):
 
         MPI_COMM.Barrier()
 
+    @attr('mpi')
+    def test_convert_to_esmf_format_float32(self):
+        name_uid = 'GRIDCODE'
+        paths = MPI_COMM.bcast([self.get_temporary_file_path(fn) for fn in ('float64.nc', 'float32.nc')])
+        convert_to_esmf_format(paths[0], self.path_in_shp, name_uid)
+        convert_to_esmf_format(paths[1], self.path_in_shp, name_uid, float32_tolerance=1e-5)
+
+        if MPI_RANK == 0:
+            with self.nc_scope(paths[0]) as dds:
+                with self.nc_scope(paths[1]) as ads:
+                    for name in ('nodeCoords', 'centerCoords', 'elementArea'):
+                        self.assertEqual(ads.variables[name].dtype, np.float32)
+                    for name in ('nodeCoords', 'centerCoords'):
+                        error = np.abs(ads.variables[name][:].astype(np.float64) - dds.variables[name][:])
+                        self.assertLessEqual(error.max(), 1e-5)
+                    self.assertNumpyAll(ads.variables['elementConn'][:], dds.variables['elementConn'][:])
+        MPI_COMM.Barrier()
+
+        # The conversion fails if the reduced precision exceeds the tolerance.
+        with self.assertRaises(ValueError):
+            convert_to_esmf_format(paths[1], self.path_in_shp, name_uid, float32_tolerance=1e-9)
+
+        if MPI_SIZE == 1:
+            actual = self.get_temporary_file_path('stream.nc')
+            convert_to_esmf_format(actual, self.path_in_shp, name_uid, stream=True, float32_tolerance=1e-5)
+            self.assertNcEqual(paths[1], actual)
+            with self.assertRaises(ValueError):
+                convert_to_esmf_format(actual, self.path_in_shp, name_uid, stream=True, float32_tolerance=1e-9)
+
+    def test_convert_to_esmf_format_pack_decimals(self):
+        if MPI_SIZE > 1:
+            raise SkipTest('serial only')
+
+        # The shared edge nodes of the second polygon are shifted slightly.
+        polygons = [box(0, 0, 1, 1), Polygon([(1 + 1e-6, 0), (2, 0), (2, 1), (1 + 1e-6, 1)])]
+        path_shp = self.get_temporary_file_path('shifted.shp')
+        schema = {'geometry': 'Polygon', 'properties': {'UID': 'int'}}
+        with fiona.open(path_shp, 'w', driver='ESRI Shapefile', schema=schema) as sink:
+            for uid, polygon in enumerate(polygons, start=1):
+                sink.write({'geometry': mapping(polygon), 'properties': {'UID': uid}})
+
+        for pack_decimals, desired in [(None, 8), (4, 6)]:
+            kwds = {} if pack_decimals is None else {'pack_decimals': pack_decimals}
+            path_out_nc = self.get_temporary_file_path('packed_{}.nc'.format(pack_decimals))
+            convert_to_esmf_format(path_out_nc, path_shp, 'UID', pack=True, **kwds)
+            with self.nc_scope(path_out_nc) as ds:
+                self.assertEqual(len(ds.dimensions['nodeCount']), desired)
+
+    def test_convert_to_esmf_format_stream(self):
+        if MPI_SIZE > 1:
+            raise SkipTest('serial only')
+
+        name_uid = 'GRIDCODE'
+        desired = self.get_temporary_file_path('desired.nc')
+        convert_to_esmf_format(desired, self.path_in_shp, name_uid)
+        actual = self.get_temporary_file_path('actual.nc')
+        convert_to_esmf_format(actual, self.path_in_shp, name_uid, stream=True)
+        for kwds in [{'balance': True}, {'parallel_write': True}, {'pack': True}]:
+            with self.assertRaises(ValueError):
+                convert_to_esmf_format(actual, self.path_in_shp, name_uid, stream=True, **kwds)
+
+        with self.nc_scope(desired) as dds:
+            sizes = [len(dds.dimensions[d]) for d in ('nodeCount', 'elementCount', 'connectionCount')]
+            with self.nc_scope(actual) as ads:
+                # The dimensions are sized by a scan before writing.
+                self.assertFalse(ads.dimensions['elementCount'].isunlimited())
+                for name, variable in dds.variables.items():
+                    self.assertEqual(ads.variables[name].ncattrs(), variable.ncattrs())
+                    self.assertNumpyAll(ads.variables[name][:], variable[:])
+
+        # Without the size scan the dimensions are unlimited.
+        unsized = self.get_temporary_file_path('unsized.nc')
+        convert_to_esmf_format(unsized, self.path_in_shp, name_uid, stream=True, scan_sizes=False)
+        with self.nc_scope(desired) as dds:
+            with self.nc_scope(unsized) as ads:
+                self.assertTrue(ads.dimensions['elementCount'].isunlimited())
+                for name, variable in dds.variables.items():
+                    self.assertNumpyAll(ads.variables[name][:], variable[:])
+
+        # Without sizes the dimensions are unlimited which requires the NETCDF4 format.
+        gm = GeometryManager(name_uid, path=self.path_in_shp, allow_multipart=True)
+        dataset_kwargs = {'format': 'NETCDF3_64BIT_OFFSET'}
+        with self.assertRaises(ValueError):
+            convert_to_esmf_format_stream(gm, actual, face_uid_name=name_uid, dataset_kwargs=dataset_kwargs)
+        convert_to_esmf_format_stream(gm, actual, face_uid_name=name_uid, block_size=10)
+        with self.nc_scope(desired) as dds:
+            with self.nc_scope(actual) as ads:
+                self.assertTrue(ads.dimensions['elementCount'].isunlimited())
+                for name, variable in dds.variables.items():
+                    self.assertNumpyAll(ads.variables[name][:], variable[:])
+
+        # Written counts must match provided sizes.
+        with self.assertRaises(ValueError):
+            convert_to_esmf_format_stream(gm, actual, face_uid_name=name_uid, dataset_kwargs=dataset_kwargs,
+                                          sizes=[sizes[0], sizes[1] + 1, sizes[2]])
+
+    def test_convert_to_esmf_format_stream_uid_dtype(self):
+        if MPI_SIZE > 1:
+            raise SkipTest('serial only')
+
+        def get_gm(uids):
+            records = [{'geom': box(ii, 0, ii + 1, 1), 'properties': {'UID': uid}} for ii, uid in enumerate(uids)]
+            return GeometryManager('UID', records=records)
+
+        large = [2 ** 40 + ii for ii in range(5)]
+        for uids, desired_dtype in [(range(1, 6), np.int32), (large, np.int64), (list('abcde'), str)]:
+            desired = self.get_temporary_file_path('desired.nc')
+            coll = get_flexible_mesh(get_gm(uids), 'mesh', True, with_connectivity=False, esmf_layout=True)
+            convert_collection_to_esmf_format(coll, desired, face_uid_name='UID')
+            actual = self.get_temporary_file_path('actual.nc')
+            convert_to_esmf_format_stream(get_gm(uids), actual, face_uid_name='UID', block_size=2)
+
+            for path in (desired, actual):
+                with self.nc_scope(path) as ds:
+                    self.assertEqual(ds.variables['UID'].dtype, desired_dtype)
+                    self.assertEqual(ds.variables['UID'][:].tolist(), uids)
+
+        # Identifiers in later blocks must fit the type set by the first block.
+        actual = self.get_temporary_file_path('overflow.nc')
+        with self.assertRaises(ValueError):
+            convert_to_esmf_format_stream(get_gm([1, 2] + large), actual, face_uid_name='UID', block_size=2)
+
     def test_get_split_polygon_by_node_threshold(self):
         mp = long_lines.mp
         geom = wkt.loads(mp)
@@ -69,6 +195,87 @@ class Test(AbstractUToolsTest):
         # write_fiona(actual, '01-assembled')
         self.assertAlmostEqual(geom.area, actual.area)
 
+        # Pieces over the threshold after the first split are split again.
+        actual = get_split_polygon_by_node_threshold(geom, 100)
+        self.assertAlmostEqual(geom.area, actual.area)
+        self.assertLessEqual(max([get_node_count(p) for p in actual]), 100)
+
+        # Polygons under the threshold are not modified.
+        actual = get_split_polygon_by_node_threshold(geom, 1000)
+        self.assertEqual([p.wkb for p in actual], [p.wkb for p in geom])
+
+        with self.assertRaises(ValueError):
+            get_split_polygon_by_node_threshold(geom, 10, split_method='foo')
+
+    def test_get_split_polygon_by_node_threshold_quadtree(self):
+        geom = wkt.loads(long_lines.mp)
+
+        for node_threshold in (10, 100):
+            actual = get_split_polygon_by_node_threshold(geom, node_threshold, split_method='quadtree')
+            self.assertAlmostEqual(geom.area, actual.area)
+            self.assertLessEqual(max([get_node_count(p) for p in actual]), node_threshold)
+
+        records = [{'geom': geom, 'properties': {'UID': 1}}, {'geom': box(0, 0, 1, 1), 'properties': {'UID': 2}}]
+        gm = GeometryManager('UID', records=records, allow_multipart=True, node_threshold=100,
+                             split_method='quadtree')
+        actual = list(gm.iter_records())
+        self.assertEqual(gm.split_node_counts.keys(), [1])
+        self.assertEqual(gm.split_node_counts[1], [get_node_count(p) for p in actual[0]['geom']])
+
+    def test_get_split_polygon_by_node_threshold_processes(self):
+        geom = wkt.loads(long_lines.mp)
+
+        def get_records():
+            # Enough records for several chunks with oversize records in each.
+            ret = []
+            for ii in range(200):
+                if ii % 50 == 0:
+                    ret.append({'geom': geom, 'properties': {'UID': ii}})
+                else:
+                    ret.append({'geom': box(ii, 0, ii + 1, 1), 'properties': {'UID': ii}})
+            return ret
+
+        desired = GeometryManager('UID', records=get_records(), allow_multipart=True, node_threshold=100)
+        desired = [r['geom'].wkb for r in desired.iter_records()]
+
+        gm = GeometryManager('UID', records=get_records(), allow_multipart=True, node_threshold=100,
+                             split_processes=2)
+        actual = list(gm.iter_records(return_uid=True))
+
+        self.assertEqual([a[0] for a in actual], range(200))
+        self.assertEqual([a[1]['geom'].wkb for a in actual], desired)
+        self.assertEqual(sorted(gm.split_node_counts.keys()), [0, 50, 100, 150])
+
+        # A pool is only started for records that need splitting and never for selections by unique identifier.
+        started = []
+
+        def pool_cls(*args, **kwargs):
+            started.append(args)
+            return Pool(*args, **kwargs)
+
+        geom_manager.Pool = pool_cls
+        try:
+            gm = GeometryManager('UID', records=get_records(), allow_multipart=True, node_threshold=100,
+                                 split_processes=2)
+            self.assertEqual(len(list(gm.iter_records(slc=[1, 50]))), 49)
+            # Record lists are not filtered by the selection, but the selected path still splits in this process.
+            self.assertEqual(len(list(gm.iter_records(select_uid=[0]))), 200)
+            self.assertEqual(started, [])
+            self.assertEqual(len(list(gm.iter_records())), 200)
+            self.assertEqual(started, [(2,)])
+        finally:
+            geom_manager.Pool = Pool
+
+    def test_get_split_polygons(self):
+        geom = Polygon([(0, 0), (4, 0), (4, 2)])
+
+        actual = get_split_polygons(geom, (2, 3))
+
+        self.assertEqual(len(actual), 6)
+        self.assertTrue(actual[1].equals(box(4. / 3, 0, 8. / 3, 1)))
+        self.assertTrue(actual[5].equals(box(8. / 3, 1, 4, 2)))
+        self.assertAlmostEqual(sum([a.area for a in actual]), 8)
+
     def test_dev_get_split_polygon_by_node_threshold_many_nodes(self):
         raise SkipTest('development only')
         self.set_debug()
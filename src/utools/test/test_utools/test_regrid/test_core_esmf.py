@@ -6,7 +6,8 @@ import numpy as np
 from utools.io.mpi import MPI_RANK, MPI_COMM
 from utools.prep.create_netcdf_data import create_source_netcdf_data, get_exact_field
 from utools.prep.prep_shapefiles import convert_to_esmf_format
-from utools.regrid.core_esmf import create_weights_file, create_weighted_output, validate_weighted_output
+from utools.regrid.core_esmf import create_weights_file, create_weighted_output, validate_weighted_output, \
+    get_sparse_weights, apply_sparse_weights, SourceBlockReader
 from utools.regrid.core_ocgis import create_linked_shapefile
 from utools.test.base import AbstractUToolsTest, attr
 
@@ -49,6 +50,65 @@ class Test(AbstractUToolsTest):
 
         MPI_COMM.Barrier()
 
+    def test_create_weighted_output_sparse(self):
+        """Test sparse weight application matches the element-by-element search."""
+
+        path_esmf_format = os.path.join(self.path_bin, 'test_esmf_format.nc')
+        path_weights_nc = os.path.join(self.path_bin, 'test_weights.nc')
+        path_src = self.get_temporary_file_path('exact.nc')
+
+        col = np.linspace(-95.0477, -94.7965, 27)
+        row = np.linspace(32.0012, 32.4288, 44)
+        ttime = np.array([100, 200, 300], dtype=np.float32)
+        create_source_netcdf_data(path_src, col, row, ttime)
+
+        actual = []
+        for ctr, (sparse, time_block_size, balance) in enumerate([(False, None, False), (True, None, False),
+                                                                  (True, 2, False), (True, None, True)]):
+            path_output_data = self.get_temporary_file_path('weighted_{}.nc'.format(ctr))
+            create_weighted_output(path_esmf_format, path_src, path_weights_nc, path_output_data, 'exact',
+                                   sparse=sparse, time_block_size=time_block_size, balance=balance)
+            with self.nc_scope(path_output_data) as ds:
+                actual.append(ds.variables['exact'][:])
+        for a in actual[1:]:
+            self.assertNumpyAllClose(actual[0], a)
+
+    def test_get_sparse_weights(self):
+        row = np.array([3, 1, 1, 3])
+        col = np.array([4, 0, 1, 2])
+        S = np.array([0.25, 0.5, 0.5, 0.75])
+
+        indptr, indices, data = get_sparse_weights(row, col, S, [0, 3])
+        self.assertEqual(indptr.tolist(), [0, 2, 2, 4])
+        self.assertEqual(indices.tolist(), [0, 1, 4, 2])
+        self.assertEqual(data.tolist(), [0.5, 0.5, 0.25, 0.75])
+
+        source_data = np.arange(10, dtype=float).reshape(2, 5)
+        actual = apply_sparse_weights((indptr, indices, data), source_data)
+        self.assertEqual(actual.tolist(), [[0.5, 0.0, 2.5], [5.5, 0.0, 7.5]])
+
+        indptr, indices, data = get_sparse_weights(row, col, S, [2, 3])
+        self.assertEqual(indptr.tolist(), [0, 2])
+        self.assertEqual(indices.tolist(), [4, 2])
+
+    def test_source_block_reader(self):
+        path_src = self.get_temporary_file_path('exact.nc')
+        create_source_netcdf_data(path_src, np.arange(5.), np.arange(4.), np.arange(5.))
+        indices = np.array([17, 6, 7, 6])
+
+        with self.nc_scope(path_src) as ds:
+            variable = ds.variables['exact']
+            desired = variable[:].reshape(5, -1)[:, indices]
+            reader = SourceBlockReader(variable, indices, time_block_size=2)
+            actual = [(start, stop, block[:, reader.buffer_indices].copy()) for start, stop, block in reader]
+
+        self.assertEqual([a[0:2] for a in actual], [(0, 2), (2, 4), (4, 5)])
+        self.assertNumpyAll(np.vstack([a[2] for a in actual]), desired.data)
+        self.assertEqual(reader.columns.tolist(), [6, 7, 17])
+        # Only the second through fourth latitude rows are read.
+        self.assertEqual(reader.nbytes_read, 5 * 3 * 5 * 4)
+        self.assertEqual(reader.peak_buffer_nbytes, 2 * 3 * 5 * 4 + 2 * 3 * 4)
+
     def test_weighted_output(self):
         path_in_shp = os.path.join(self.path_bin, 'nhd_catchments_texas', 'nhd_catchments_texas.shp')
         name_uid = 'GRIDCODE'
@@ -0,0 +1,67 @@
+import os
+import time
+
+import numpy as np
+
+from utools.prep.create_netcdf_data import create_source_netcdf_data
+from utools.regrid.core_esmf import create_weighted_output
+from utools.regrid.weight_cache import WeightCache, get_weight_cache_key
+from utools.test.base import AbstractUToolsTest
+
+
+class TestWeightCache(AbstractUToolsTest):
+    @property
+    def path_weights(self):
+        return os.path.join(self.path_bin, 'test_weights.nc')
+
+    def get_sparse_weights(self, n):
+        return np.arange(n + 1), np.arange(n), np.ones(n)
+
+    def test_get_put(self):
+        cache = WeightCache(self.get_temporary_file_path('cache'))
+        key = get_weight_cache_key(self.path_weights, (44, 27), 43, [0, 43])
+        self.assertIsNone(cache.get(key))
+
+        desired = self.get_sparse_weights(5)
+        cache.put(key, desired)
+        actual = cache.get(key)
+        for a, d in zip(actual, desired):
+            self.assertIsInstance(a, np.memmap)
+            self.assertEqual(a.tolist(), d.tolist())
+
+        # The section is part of the key.
+        self.assertNotEqual(key, get_weight_cache_key(self.path_weights, (44, 27), 43, [0, 20]))
+
+    def test_evict(self):
+        cache = WeightCache(self.get_temporary_file_path('cache'), max_nbytes=1)
+        for ctr, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, self.get_sparse_weights(10))
+            # Set modification times explicitly to avoid depending on file system time resolution.
+            mtime = time.time() - 100 + ctr
+            os.utime(os.path.join(cache.directory, key), (mtime, mtime))
+        nbytes = sum([os.path.getsize(os.path.join(cache.directory, 'a', fn)) for fn in os.listdir(
+            os.path.join(cache.directory, 'a'))])
+
+        # Touch the oldest entry so it is the most recently used.
+        cache.get('a')
+        cache.max_nbytes = nbytes
+        self.assertEqual(cache.evict(), ['b', 'c'])
+        self.assertIsNotNone(cache.get('a'))
+
+    def test_system_create_weighted_output(self):
+        path_esmf_format = os.path.join(self.path_bin, 'test_esmf_format.nc')
+        path_src = self.get_temporary_file_path('exact.nc')
+        create_source_netcdf_data(path_src, np.linspace(-95.0477, -94.7965, 27), np.linspace(32.0012, 32.4288, 44),
+                                  np.array([100, 200], dtype=np.float32))
+        cache_directory = self.get_temporary_file_path('cache')
+
+        actual = []
+        for ctr, directory in enumerate([None, cache_directory, cache_directory]):
+            path_output_data = self.get_temporary_file_path('weighted_{}.nc'.format(ctr))
+            create_weighted_output(path_esmf_format, path_src, self.path_weights, path_output_data, 'exact',
+                                   weight_cache_directory=directory)
+            with self.nc_scope(path_output_data) as ds:
+                actual.append(ds.variables['exact'][:])
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+        for a in actual[1:]:
+            self.assertNumpyAll(actual[0], a)
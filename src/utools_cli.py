@@ -34,9 +34,47 @@ def utools_cli():
 @click.option('-n', '--node-threshold', type=int, default=UgridToolsConstants.NODE_THRESHOLD,
               help='(default={}) Approximate limit on the number of nodes in an element part. The default node '
                    'threshold provides significant performance improvement.'.format(UgridToolsConstants.NODE_THRESHOLD))
+@click.option('--split-method', type=click.Choice(['grid', 'quadtree']), default=UgridToolsConstants.SPLIT_METHOD,
+              help='(default={}) Method used to split elements exceeding the node threshold. "quadtree" splits at '
+                   'node density medians for more even element parts.'.format(UgridToolsConstants.SPLIT_METHOD))
+@click.option('--split-processes', type=int, required=False,
+              help='Number of local processes used to split elements exceeding the node threshold. Intended for '
+                   'runs without MPI.')
 @click.option('--debug/--no-debug', required=False, default=False,
               help='If "--debug", execute in debug mode converting only the first record of the geometry container.')
-def convert(source_uid, source, esmf_format, feature_class, config_path, dest_crs_index, node_threshold, debug):
+@click.option('--pack/--no-pack', required=False, default=False,
+              help='If "--pack", de-duplicate nodes shared by elements.')
+@click.option('--pack-decimals', type=int, default=UgridToolsConstants.CONNECTIVITY_DECIMALS,
+              help='(default={}) Number of decimals used when rounding node coordinates to find shared nodes with '
+                   '"--pack". Decrease to merge nearly equal nodes.'.format(UgridToolsConstants.CONNECTIVITY_DECIMALS))
+@click.option('--balance/--no-balance', required=False, default=False,
+              help='If "--balance", assign elements to processes using element node counts so each process has a '
+                   'similar amount of work.')
+@click.option('--parallel-write/--no-parallel-write', required=False, default=False,
+              help='If "--parallel-write", write the output file from all processes at once using parallel I/O. '
+                   'Requires netCDF4 built with parallel I/O support.')
+@click.option('--stream/--no-stream', required=False, default=False,
+              help='If "--stream", convert and write blocks of elements so memory use does not grow with the input '
+                   'size. Runs on a single process and does not support "--pack", "--balance", or '
+                   '"--parallel-write".')
+@click.option('--scan-sizes/--no-scan-sizes', required=False, default=True,
+              help='If "--no-scan-sizes" with "--stream", do not scan the input to size the output dimensions. The '
+                   'scan splits elements exceeding the node threshold, so they are split twice. Unsized dimensions '
+                   'are unlimited and require the NETCDF4 file format.')
+@click.option('--profile', type=click.Choice(sorted(UgridToolsConstants.ESMF_FORMAT_PROFILES.keys())),
+              required=False,
+              help='Output profile setting the file format, compression, and chunking of the output file. Compressed '
+                   'profiles do not support "--parallel-write".')
+@click.option('--float32-tolerance', type=float, required=False,
+              help='Write coordinates and areas as float32 to reduce the file size. The conversion fails if a '
+                   'coordinate changes by more than this tolerance in coordinate units.')
+@click.option('--geometry-cache-nbytes', type=int, required=False,
+              help='Keep up to this many bytes of decoded geometries in memory so geometries read more than once are '
+                   'not decoded again.')
+def convert(source_uid, source, esmf_format, feature_class, config_path, dest_crs_index, node_threshold, split_method,
+            split_processes, debug, pack, pack_decimals, balance, parallel_write, stream, scan_sizes, profile,
+            float32_tolerance, geometry_cache_nbytes):
+    from utools.io.geom_cabinet import get_layer_metadata
     from utools.prep.prep_shapefiles import convert_to_esmf_format
 
     log_entry('info', 'Started converting to ESMF format: {}'.format(source), rank=0)
@@ -64,8 +102,15 @@ def convert(source_uid, source, esmf_format, feature_class, config_path, dest_cr
     else:
         dest_crs = None
 
+    # The metadata is read once and cached for the conversion on all processes.
+    count = get_layer_metadata(source, driver_kwargs=driver_kwargs, bcast=True)['count']
+    log_entry('info', 'Feature count: {}'.format(count), rank=0)
+
     convert_to_esmf_format(esmf_format, source, source_uid, node_threshold=node_threshold, driver_kwargs=driver_kwargs,
-                           debug=debug, dest_crs=dest_crs)
+                           debug=debug, dest_crs=dest_crs, pack=pack, pack_decimals=pack_decimals, balance=balance,
+                           parallel_write=parallel_write, split_method=split_method,
+                           split_processes=split_processes, stream=stream, scan_sizes=scan_sizes, profile=profile,
+                           float32_tolerance=float32_tolerance, geometry_cache_nbytes=geometry_cache_nbytes)
     log_entry('info', 'Finished converting to ESMF format: {}'.format(source), rank=0)
 
 
@@ -107,11 +152,19 @@ def merge(catchment_directory, weight_directory, master_path):
               help='Path to ESMF unstructured NetCDF file.')
 @click.option('-o', '--output', type=click.Path(writable=True), required=True,
               help='Path to the output file.')
-def apply(source, name, weights, esmf_format, output):
+@click.option('--time-block-size', type=int, required=False,
+              help='Number of time steps to read from the source variable at once. By default, all time steps are '
+                   'read at once.')
+@click.option('--weight-cache', type=click.Path(file_okay=False, writable=True), required=False,
+              help='Path to a directory for caching the sparse form of the weights between runs.')
+@click.option('--balance/--no-balance', required=False, default=False,
+              help='If "--balance", assign elements to processes using the number of weights per element.')
+def apply(source, name, weights, esmf_format, output, time_block_size, weight_cache, balance):
     from utools.regrid.core_esmf import create_weighted_output
 
     log_entry('info', 'Starting weight application for "weights": {}'.format(weights), rank=0)
-    create_weighted_output(esmf_format, source, weights, output, name)
+    create_weighted_output(esmf_format, source, weights, output, name, time_block_size=time_block_size,
+                           weight_cache_directory=weight_cache, balance=balance)
     log_entry('info', 'Finished weight application for "weights": {}'.format(weights), rank=0)
 
 